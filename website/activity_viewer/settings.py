@@ -11,7 +11,30 @@ SECRET_KEY = config('SECRET_KEY')
 
 DEBUG = config('DEBUG', default=False, cast=bool)
 
+# Cached pages older than this are served once more while they are computed again in the background
 CACHE_TIME = config('CACHE_TIME', default=3600, cast=int)
+# Pages and rankings are computed again when the data changes, see dashboard/caching.py.
+# This is only how long they are kept at most, set it to zero to not cache them at all.
+DATA_CACHE_TIME = config('DATA_CACHE_TIME', default=7 * 24 * 3600, cast=int)
+
+# Shared by every worker of the web server, so a page is only computed once for all of them
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': config('CACHE_DIR', default=os.path.join(BASE_DIR, 'cache')),
+        'TIMEOUT': CACHE_TIME,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    }
+}
+
+# Parquet dataset of the logs for the notebooks, see dashboard/export.py
+LOG_EXPORT_DIR = config('LOG_EXPORT_DIR', default=os.path.join(BASE_DIR, 'log_export'))
+
+# In-memory columns of the valid downloads that answer the dashboard aggregates, see dashboard/columnar.py
+LOG_COLUMNS = config('LOG_COLUMNS', default=False, cast=bool)
+LOG_COLUMNS_PATH = config('LOG_COLUMNS_PATH', default=os.path.join(BASE_DIR, 'log_columns'))
 
 ALLOWED_HOSTS = [
     'localhost',
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Log, Item, QueryCountAtTime, Experiment, Lab, Award
+from .models import Log, Item, QueryCountAtTime, Experiment, Lab, Award, LogFile, SyncMarker
 
 # This allows us to browse the models in our admin site
-admin.site.register([Log, Item, QueryCountAtTime, Experiment, Lab, Award])
+admin.site.register([Log, Item, QueryCountAtTime, Experiment, Lab, Award, LogFile, SyncMarker])
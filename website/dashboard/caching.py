@@ -0,0 +1,216 @@
+"""
+Caching of dashboard pages in the cache that every worker of the web server shares, see CACHES in the settings.
+Cached values hold the version of the data, which is bumped by every command that changes what the pages show,
+so pages are computed again exactly when new data arrives and are kept as long as DATA_CACHE_TIME otherwise.
+Pages that are stale, because the data changed or they are older than CACHE_TIME, are still served right away
+while a single background thread computes them again, so no visitor waits for a page that was cached before and
+a page is never computed by several requests at once. Requests for a page that is not cached while another request
+computes it wait a few seconds for it, and are asked to try again later after that.
+"""
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from functools import wraps
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.db import connections
+from django.db.models import F
+from django.test import RequestFactory
+from django.utils import timezone
+
+from dashboard.models import SyncMarker
+
+PAGE_CACHE_PREFIX = 'page'
+LOCK_CACHE_PREFIX = 'page_lock'
+# Longest a page may take to compute, after that another request may compute it as well
+LOCK_TIME = 15 * 60
+# How long a request for a page that is not cached waits for another request that computes it, it holds a worker
+LOCK_WAIT_TIME = 5
+LOCK_POLL_INTERVAL = 0.25
+# Seconds after which requests that waited in vain are asked to try again
+RETRY_AFTER = 5
+# Name of the sync marker whose value is the version of the data
+DATA_VERSION_MARKER = 'data_version'
+
+
+def get_data_version():
+    """
+    :return: Version of the data, 0 if it was never bumped
+    """
+    return SyncMarker.objects.filter(name=DATA_VERSION_MARKER).values_list('value', flat=True).first() or 0
+
+
+def bump_data_version():
+    """
+    Call after the data that the pages show changed, every page that was cached before is computed again.
+    """
+    now = timezone.now()
+    if not SyncMarker.objects.filter(name=DATA_VERSION_MARKER).update(value=F('value') + 1, time=now):
+        SyncMarker.objects.get_or_create(name=DATA_VERSION_MARKER, defaults={'time': now, 'value': 1})
+
+
+def get_versioned_cache_key(prefix, name, data_version=None):
+    """
+    :param name: Describes what is cached, like the path of a page
+    :param data_version: Version of the data the value was computed from, the current one if None
+    """
+    if data_version is None:
+        data_version = get_data_version()
+    return f'{prefix}:{data_version}:{md5(name.encode()).hexdigest()}'
+
+
+def get_page_cache_key(request):
+    """
+    :return: Key of a page, which is the same for every version of the data so stale pages can be found
+    """
+    return f'{PAGE_CACHE_PREFIX}:{md5(request.get_full_path().encode()).hexdigest()}'
+
+
+def is_fresh(cached, data_version):
+    """
+    :param cached: Tuple of the version of the data, the time and the response of a cached page
+    """
+    cached_version, computed_time, _ = cached
+    return cached_version == data_version and time.time() - computed_time < settings.CACHE_TIME
+
+
+def compute_page(view, request, args, kwargs, data_version):
+    """
+    :param data_version: Version of the data taken before the page is computed,
+                         so a sync that finishes meanwhile makes it stale right away
+    :return: Response of the view, which is cached if it was successful and holds nothing of the visitor
+    """
+    response = view(request, *args, **kwargs)
+    # Like UpdateCacheMiddleware, pages with a CSRF token or cookies are only valid for the visitor they were made for
+    if (response.status_code == 200 and not response.streaming and not response.cookies
+            and not request.META.get('CSRF_COOKIE_USED')):
+        cache.set(get_page_cache_key(request), (data_version, time.time(), response), settings.DATA_CACHE_TIME)
+    return response
+
+
+def get_lock_cache_key(request):
+    return f'{LOCK_CACHE_PREFIX}:{get_page_cache_key(request)}'
+
+
+def lock_page(request):
+    """
+    Only one request computes a page at a time. Adding to the file cache is not atomic,
+    but two requests would have to find the page stale within the same few microseconds.
+    :return: Whether the lock was taken, it has to be released with unlock_page then
+    """
+    return cache.add(get_lock_cache_key(request), True, LOCK_TIME)
+
+
+def unlock_page(request):
+    cache.delete(get_lock_cache_key(request))
+
+
+def get_refresh_request(request):
+    """
+    The visitor that found a page stale is answered before it is computed again, and their request is still used
+    by the middleware then. The page is computed from this request instead, which has nothing of the visitor,
+    like the requests that warm_cache makes.
+    :return: Anonymous GET request for the same page as the request
+    """
+    refresh_request = RequestFactory().get(request.get_full_path_info(), secure=request.is_secure(),
+                                           HTTP_HOST=request.get_host(),
+                                           SCRIPT_NAME=request.META.get('SCRIPT_NAME', ''))
+    refresh_request.resolver_match = request.resolver_match
+    return refresh_request
+
+
+def refresh_page(view, request, args, kwargs, data_version):
+    """
+    Compute a stale page again in the background, the lock of the page has to be taken.
+    :param request: Request from get_refresh_request, never the one of the visitor
+    """
+    try:
+        compute_page(view, request, args, kwargs, data_version)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        unlock_page(request)
+        # Connections of the thread are not closed by the request cycle
+        connections.close_all()
+
+
+def wait_for_page(request):
+    """
+    Wait a few seconds for another request that computes a page that is not cached.
+    :return: Tuple of whether the other request finished in time and the version, time and response of the page,
+             which is None if it could not be cached, like error pages
+    """
+    waited_time = 0
+    while waited_time < LOCK_WAIT_TIME:
+        time.sleep(LOCK_POLL_INTERVAL)
+        waited_time += LOCK_POLL_INTERVAL
+        cached = cache.get(get_page_cache_key(request))
+        if cached is not None or not cache.has_key(get_lock_cache_key(request)):
+            return True, cached
+    return False, None
+
+
+# Set in threads of the warm_cache command, which compute stale pages before they respond instead of in a thread
+# that would end with the command. Only code in the same process can set it, visitors never can.
+_synchronous = threading.local()
+
+
+@contextmanager
+def computing_stale_pages():
+    """
+    Pages requested in this context in the current thread are computed before the response when they are stale.
+    """
+    _synchronous.enabled = True
+    try:
+        yield
+    finally:
+        _synchronous.enabled = False
+
+
+def get_retry_response():
+    """
+    :return: Response asking to request the page again once it had time to be computed,
+             browsers load it again on their own with the Refresh header
+    """
+    response = HttpResponse('The page is being computed, try again in a few seconds.', status=503,
+                            content_type='text/plain')
+    response['Retry-After'] = RETRY_AFTER
+    response['Refresh'] = RETRY_AFTER
+    return response
+
+
+def cache_data_page(view):
+    """
+    Cache successful GET responses of a view until the data changes, instead of for a fixed time like cache_page.
+    Stale pages are served while they are computed again in the background, see the top of this file.
+    """
+
+    @wraps(view)
+    def cached_view(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        data_version = get_data_version()
+        cached = cache.get(get_page_cache_key(request))
+        if cached is not None and is_fresh(cached, data_version):
+            return cached[2]
+        if not lock_page(request):
+            # Another request computes the page already
+            if cached is None:
+                finished, cached = wait_for_page(request)
+                if not finished:
+                    return get_retry_response()
+            return view(request, *args, **kwargs) if cached is None else cached[2]
+        if cached is None or getattr(_synchronous, 'enabled', False):
+            try:
+                return compute_page(view, request, args, kwargs, data_version)
+            finally:
+                unlock_page(request)
+        threading.Thread(target=refresh_page, args=(view, get_refresh_request(request), args, kwargs, data_version),
+                         daemon=True).start()
+        return cached[2]
+
+    return cached_view
@@ -0,0 +1,155 @@
+"""
+Items that are downloaded together, counted by how many IP addresses downloaded both of them.
+The distinct pairs of IP address and item are read in one pass and make a sparse IP address by item matrix X,
+so X^T X is the item by item matrix of co-downloads. It is multiplied a block of items at a time
+and only the top of every row is kept in the ItemCoDownload table, so the whole matrix never is in memory.
+scipy is only needed to build co-downloads, the dashboard only reads the table.
+"""
+import numpy as np
+import pandas as pd
+from django.db import connection, transaction
+from tqdm import tqdm
+
+from dashboard.models import DailyDownload, Item, ItemCoDownload, Log
+from dashboard.rollups import is_rollup_ready
+
+# Other items kept per item
+TOP_AMOUNT = 10
+# Pairs downloaded together by fewer IP addresses say little about the items
+MIN_COUNT = 2
+# IP addresses with more items are mirrors or crawlers, they would make every item look downloaded with every other
+MAX_ITEMS_PER_IP = 1000
+# Rows of the co-download matrix multiplied at once
+BLOCK_SIZE = 2000
+# Rows fetched from the server side cursor at once
+FETCH_SIZE = 50000
+# Rows inserted into the table at once
+INSERT_SIZE = 5000
+# Every download is in the rollup, which is a lot smaller than the logs once it was built
+ROLLUP_DOWNLOADS_SQL = f'''
+FROM {DailyDownload._meta.db_table}
+WHERE item_id IS NOT NULL AND ip_address IS NOT NULL
+'''
+LOG_DOWNLOADS_SQL = f'''
+FROM {Log._meta.db_table}
+WHERE item_id IS NOT NULL AND ip_address IS NOT NULL
+  AND http_status = 200 AND NOT requester_type = {Log.REQUESTER_ENCODED_INSTANCE}
+'''
+PAIRS_SQL = 'SELECT DISTINCT host(ip_address), item_id {downloads}'
+# IP addresses that downloaded at most a given amount of items out of every item
+KEPT_IP_ADDRESSES_SQL = 'SELECT ip_address {downloads} GROUP BY ip_address HAVING COUNT(DISTINCT item_id) <= %s'
+
+
+def import_sparse():
+    try:
+        from scipy import sparse
+    except ImportError as error:
+        raise ImportError('scipy is needed to build co-downloads, install it with pip install scipy') from error
+    return sparse
+
+
+def read_download_pairs(item_ids=None, max_items_per_ip=None):
+    """
+    Stream the distinct pairs of IP address and item of valid downloads.
+    :param item_ids: Only pairs with these items, every item if None
+    :param max_items_per_ip: IP addresses that downloaded more items, counting items that were not asked for,
+                             are left out, all are kept if None
+    :return: Tuple of arrays of the code of the IP address and the item id of every pair
+    """
+    downloads = ROLLUP_DOWNLOADS_SQL if is_rollup_ready() else LOG_DOWNLOADS_SQL
+    sql, params = PAIRS_SQL.format(downloads=downloads), []
+    if item_ids is not None:
+        sql += ' AND item_id = ANY(%s)'
+        params.append(list(item_ids))
+    if max_items_per_ip is not None:
+        sql += f' AND ip_address IN ({KEPT_IP_ADDRESSES_SQL.format(downloads=downloads)})'
+        params.append(max_items_per_ip)
+    ip_codes, ip_code_chunks, item_id_chunks = {}, [], []
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        with tqdm() as progress:
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                ip_addresses, chunk_item_ids = zip(*rows)
+                ip_code_chunks.append(np.array([ip_codes.setdefault(ip, len(ip_codes)) for ip in ip_addresses],
+                                               np.int64))
+                item_id_chunks.append(np.array(chunk_item_ids, np.int64))
+                progress.update(len(rows))
+    if not ip_code_chunks:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return np.concatenate(ip_code_chunks), np.concatenate(item_id_chunks)
+
+
+def build_download_matrix(ip_codes, item_ids, max_items_per_ip=MAX_ITEMS_PER_IP):
+    """
+    :param max_items_per_ip: IP addresses that downloaded more items are left out, all are kept if None
+    :return: Tuple of the sparse matrix with a one for every IP address and item it downloaded,
+             with a column per item, and the item id of every column
+    """
+    sparse = import_sparse()
+    if max_items_per_ip is not None and len(ip_codes):
+        is_kept = np.bincount(ip_codes)[ip_codes] <= max_items_per_ip
+        ip_codes, item_ids = ip_codes[is_kept], item_ids[is_kept]
+    column_item_ids, columns = np.unique(item_ids, return_inverse=True)
+    matrix = sparse.csc_matrix((np.ones(len(columns), np.int32), (ip_codes, columns)),
+                               shape=(int(ip_codes.max()) + 1 if len(ip_codes) else 0, len(column_item_ids)))
+    return matrix, column_item_ids
+
+
+def iter_top_co_downloads(matrix, top_amount=TOP_AMOUNT, min_count=MIN_COUNT, block_size=BLOCK_SIZE):
+    """
+    Multiply the download matrix with itself a block of items at a time and keep the top of every row.
+    :param matrix: Download matrix from build_download_matrix
+    :return: Iterable of tuples of the column of an item, the column of another item and how many IP addresses
+             downloaded both, the other items of every item by highest count first
+    """
+    transposed = matrix.T.tocsr()
+    for block_start in tqdm(range(0, matrix.shape[1], block_size)):
+        block = (transposed[block_start:block_start + block_size] @ matrix).tocsr()
+        for row in range(block.shape[0]):
+            column = block_start + row
+            start, end = block.indptr[row], block.indptr[row + 1]
+            others, counts = block.indices[start:end], block.data[start:end]
+            is_kept = (others != column) & (counts >= min_count)
+            others, counts = others[is_kept], counts[is_kept]
+            # Ties are ordered by column, which is the order of the item ids
+            top = np.lexsort((others, -counts))[:top_amount]
+            for other, count in zip(others[top], counts[top]):
+                yield column, int(other), int(count)
+
+
+def save_co_downloads(matrix, column_item_ids, top_amount=TOP_AMOUNT):
+    """
+    Replace the co-downloads of every item with the top ones of the download matrix of all downloads.
+    :param matrix: Download matrix from build_download_matrix, with the item id of every column
+    :return: Amount of pairs of items that were saved
+    """
+    co_downloads = [ItemCoDownload(item_id=column_item_ids[column], other_item_id=column_item_ids[other], count=count)
+                    for column, other, count in iter_top_co_downloads(matrix, top_amount)]
+    with transaction.atomic():
+        ItemCoDownload.objects.all().delete()
+        ItemCoDownload.objects.bulk_create(co_downloads, batch_size=INSERT_SIZE)
+    return len(co_downloads)
+
+
+def get_co_download_matrix(item_ids, max_items_per_ip=MAX_ITEMS_PER_IP):
+    """
+    Co-downloads between a few items as a dense table, for example for a heatmap in a notebook.
+    :param item_ids: Ids of the items
+    :return: DataFrame with the name of an item on every row and column and how many IP addresses downloaded both
+             where they meet, zero on the diagonal
+    """
+    # Pairs are only read for the given items, so IP addresses are left out by their items among all pairs
+    ip_codes, pair_item_ids = read_download_pairs(item_ids, max_items_per_ip)
+    matrix, column_item_ids = build_download_matrix(ip_codes, pair_item_ids, max_items_per_ip=None)
+    co_downloads = np.zeros((len(item_ids), len(item_ids)), np.int64)
+    # Items that were never downloaded have no column, but are still in the table
+    rows = np.flatnonzero(np.isin(item_ids, column_item_ids))
+    columns = np.searchsorted(column_item_ids, np.asarray(item_ids)[rows])
+    co_downloads[np.ix_(rows, rows)] = (matrix.T @ matrix).toarray()[np.ix_(columns, columns)]
+    np.fill_diagonal(co_downloads, 0)
+    names = dict(Item.objects.filter(id__in=item_ids).values_list('id', 'name'))
+    labels = [names[item_id] for item_id in item_ids]
+    return pd.DataFrame(co_downloads, index=labels, columns=labels)
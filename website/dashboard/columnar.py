@@ -0,0 +1,414 @@
+"""
+In-memory columns of the valid downloads for the dashboard aggregates, see LogColumns.
+Every log only takes a few numbers, with times sorted so a range is found with a binary search,
+and stats and rankings are computed with vectorized NumPy operations instead of scanning the logs in Postgres.
+The columns are built from the database and kept in a snapshot directory with an uncompressed .npy file per array.
+The sync adds the logs of each ingest to it, and web processes map it again whenever it changes. The files are memory
+mapped read only, so every process of the web server shares the same pages of them in the page cache instead of
+reading its own copy. Turned off unless LOG_COLUMNS is set, it takes memory.
+"""
+import ipaddress
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max
+from tqdm import tqdm
+
+from dashboard.heavy_hitters import DIMENSION_ITEMS, DIMENSION_IP_ADDRESSES
+from dashboard.models import Log, Item, S3Key
+from dashboard.sketches import COHORT_ALL, get_cohort_item_ids
+
+# Rows fetched from the server side cursor at once
+FETCH_SIZE = 50000
+COLUMN_NAMES = ['times', 's3_keys', 'ip_addresses', 'requesters', 'object_sizes']
+# Derived from the columns whenever logs are added, see get_previous_rows
+PREVIOUS_ROW_NAMES = ['previous_requests', 'previous_sizes']
+# Missing foreign keys and sizes are stored as these, ids start at one
+NO_ID = 0
+NO_SIZE = -1
+# Every array of a snapshot is saved in its own file with this name and .npy
+ARRAY_NAMES = COLUMN_NAMES + PREVIOUS_ROW_NAMES + ['ip_values', 'key_items']
+# Holds the last log and item ids of a snapshot
+SNAPSHOT_INFO_NAME = 'snapshot.json'
+# File in the snapshot directory with the name of the directory of the current snapshot, replaced when a new one is
+# saved. Directories of older snapshots are deleted, the ones before the current one is kept for processes that
+# read the name just before it was replaced. Processes that have them mapped keep their files until they unmap them.
+CURRENT_NAME = 'current'
+SNAPSHOT_PREFIX = 'snapshot-'
+KEPT_SNAPSHOT_COUNT = 2
+LOGS_SQL = f'''
+SELECT (EXTRACT(EPOCH FROM time) * 1000000)::bigint, COALESCE(s3_key_id, {NO_ID}), host(ip_address),
+       COALESCE(requester_id, {NO_ID}), COALESCE(object_size, {NO_SIZE})
+FROM {Log._meta.db_table}
+WHERE id > %s AND id <= %s AND http_status = 200 AND NOT requester_type = {Log.REQUESTER_ENCODED_INSTANCE}
+'''
+KEY_ITEMS_SQL = f'''
+SELECT s3_key.id, item.id
+FROM {Item._meta.db_table} item JOIN {S3Key._meta.db_table} s3_key ON s3_key.value = item.s3_key
+WHERE item.id > %s
+'''
+
+# Columns of this process and the modification time of the current snapshot file when they were mapped
+_log_columns = None
+_snapshot_time = None
+
+
+def get_epoch_microseconds(time):
+    return int(time.timestamp() * 1000000)
+
+
+def sort_pairs(first, second):
+    """
+    :return: Tuple of the order of the rows sorted by pair, rows of the same pair by position,
+             and whether each row in that order has the same pair as the one before
+    """
+    # Sorts are stable, so rows of the same pair stay in the order they were in
+    order = np.lexsort((second, first))
+    first, second = first[order], second[order]
+    is_repeated = np.zeros(len(order), dtype=bool)
+    is_repeated[1:] = (first[1:] == first[:-1]) & (second[1:] == second[:-1])
+    return order, is_repeated
+
+
+def get_first_rows(first, second):
+    """
+    :return: Whether each row is the first one with its pair of values
+    """
+    order, is_repeated = sort_pairs(first, second)
+    is_first = np.empty(len(order), dtype=bool)
+    is_first[order] = ~is_repeated
+    return is_first
+
+
+def get_previous_rows(first, second):
+    """
+    :return: Position of the last row before each row with the same pair of values, -1 for the first one.
+             The rows of a range that are the first of their pair are those with a previous row before the range.
+    """
+    order, is_repeated = sort_pairs(first, second)
+    previous_rows = np.full(len(order), -1, np.int64)
+    previous_rows[order[1:][is_repeated[1:]]] = order[:-1][is_repeated[1:]]
+    return previous_rows
+
+
+def count_distinct(values):
+    return int(np.count_nonzero(np.bincount(values))) if len(values) else 0
+
+
+def get_ip_order(ip_values):
+    """
+    :return: Position of every IP address code when sorted like Postgres sorts inet, missing addresses last
+    """
+    def get_sort_key(code):
+        if not ip_values[code]:
+            return 1, 0, 0
+        ip = ipaddress.ip_address(ip_values[code])
+        return 0, ip.version, int(ip)
+
+    order = np.empty(len(ip_values), np.int64)
+    order[sorted(range(len(ip_values)), key=get_sort_key)] = np.arange(len(ip_values))
+    return order
+
+
+def get_top(counts, amount, order=None):
+    """
+    :param counts: Count of every key by its index
+    :param order: Position of every key among keys with the same count, by their index if None
+    :return: Tuple of the indexes of the keys with the highest counts, with every key that has the same count as the
+             last one, and the highest count of any other key, which is lower than all of theirs
+    """
+    counted = np.flatnonzero(counts)
+    top = counted[np.lexsort((counted if order is None else order[counted], -counts[counted]))]
+    if len(top) <= amount:
+        return top, 0
+    top_counts = counts[top]
+    end = np.searchsorted(-top_counts, -top_counts[amount - 1], 'right') if amount else 0
+    return top[:end], int(top_counts[end]) if len(top) > end else 0
+
+
+class LogSelection:
+    """
+    Columns of the valid downloads of a time range and filter.
+    """
+
+    def __init__(self, log_columns, rows):
+        """
+        :param rows: Slice of the rows of a range, or array of the positions of the rows of a filter
+        """
+        self.log_columns = log_columns
+        self.s3_keys = log_columns.s3_keys[rows]
+        self.ip_addresses = log_columns.ip_addresses[rows]
+        self.requesters = log_columns.requesters[rows]
+        self.object_sizes = log_columns.object_sizes[rows]
+        if isinstance(rows, slice):
+            # No sort needed, the first rows of a pair in the range are known from the rows before them
+            self.is_first_request = log_columns.previous_requests[rows] < rows.start
+            self.is_first_size = log_columns.previous_sizes[rows] < rows.start
+        else:
+            self.is_first_request = get_first_rows(self.s3_keys, self.ip_addresses)
+            self.is_first_size = get_first_rows(self.s3_keys, self.object_sizes)
+
+    def get_general_stats(self):
+        """
+        :return: The same stats as query.get_general_stats, where a missing value counts as a distinct one
+        """
+        sizes = self.object_sizes[self.is_first_size & (self.object_sizes != NO_SIZE)]
+        return {
+            'total_downloads': len(self.s3_keys),
+            'unique_request_count': int(np.count_nonzero(self.is_first_request)),
+            'unique_ips': count_distinct(self.ip_addresses),
+            'unique_files': count_distinct(self.s3_keys),
+            'unique_requesters': count_distinct(self.requesters),
+            # Every size of a file only counts once
+            'average_file_size': int(sizes.mean()) if len(sizes) else 0,
+        }
+
+    def get_source_stats(self):
+        """
+        :return: Tuple of the number of downloads and the number of distinct keys downloaded
+        """
+        return len(self.s3_keys), count_distinct(self.s3_keys)
+
+    def get_top_candidates(self, dimension, amount):
+        """
+        Same as heavy_hitters.get_top_candidates, but the candidates are exactly the top of the ranking.
+        Items are ranked by how many IP addresses downloaded them, IP addresses by their downloads.
+        :return: Tuple of the candidate keys and the highest count any other key has
+        """
+        if dimension == DIMENSION_ITEMS:
+            # Downloads without an IP address do not count, like COUNT(DISTINCT ip_address)
+            is_counted = (self.is_first_request & (self.ip_addresses != NO_ID) &
+                          (self.log_columns.key_items[self.s3_keys] != NO_ID))
+            top, other_count = get_top(np.bincount(self.s3_keys[is_counted]), amount)
+            return [int(key) for key in top], other_count
+        if dimension == DIMENSION_IP_ADDRESSES:
+            top, other_count = get_top(np.bincount(self.ip_addresses), amount, self.log_columns.get_ip_order())
+            return [self.log_columns.ip_values[code] or None for code in top], other_count
+        raise ValueError(f'Unknown dimension {dimension}')
+
+
+class LogColumns:
+    """
+    Valid downloads as one array per column, sorted by time. Times are microseconds since the epoch,
+    keys and requesters are their ids, IP addresses are codes into the ip_values array of their text.
+    """
+
+    def __init__(self, times, s3_keys, ip_addresses, requesters, object_sizes, previous_requests, previous_sizes,
+                 ip_values, key_items, last_log_id, last_item_id):
+        """
+        :param previous_requests: Last row before each row with the same key and IP address
+        :param previous_sizes: Last row before each row with the same key and object size
+        :param ip_values: Text of the IP address of every code, code zero is the empty text for missing ones
+        :param key_items: Id of the item of every key by its id, zero for keys without an item.
+                          Logs are linked to items by their key, so this is what their item is.
+        :param last_log_id: Highest log id that is in the columns
+        :param last_item_id: Highest item id that is in key_items
+        """
+        self.times = times
+        self.s3_keys = s3_keys
+        self.ip_addresses = ip_addresses
+        self.requesters = requesters
+        self.object_sizes = object_sizes
+        self.previous_requests = previous_requests
+        self.previous_sizes = previous_sizes
+        self.ip_values = ip_values
+        self.key_items = key_items
+        self.last_log_id = last_log_id
+        self.last_item_id = last_item_id
+        self.ip_order = None
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, np.int64), np.zeros(0, np.int32), np.zeros(0, np.uint32), np.zeros(0, np.int32),
+                   np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64), np.array(['']),
+                   np.zeros(1, np.int32), 0, 0)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+        :param path: Snapshot directory
+        :param mmap_mode: 'r' to map the arrays read only instead of reading them into the memory of the process,
+                          None to read them, which they have to be to add logs or items
+        """
+        snapshot_path = get_snapshot_path(path)
+        with open(os.path.join(snapshot_path, SNAPSHOT_INFO_NAME)) as file:
+            snapshot_info = json.load(file)
+        arrays = [np.load(os.path.join(snapshot_path, f'{name}.npy'), mmap_mode=mmap_mode) for name in ARRAY_NAMES]
+        return cls(*arrays, snapshot_info['last_log_id'], snapshot_info['last_item_id'])
+
+    def save(self, path):
+        """
+        Written into a directory of its own first, which is only made the current one once it is complete,
+        so processes loading the snapshot never see half of it.
+        :param path: Snapshot directory
+        """
+        os.makedirs(path, exist_ok=True)
+        snapshot_name = f'{SNAPSHOT_PREFIX}{time.time_ns()}'
+        partial_path = os.path.join(path, f'{snapshot_name}.part')
+        os.makedirs(partial_path)
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(partial_path, f'{name}.npy'), getattr(self, name), allow_pickle=False)
+        with open(os.path.join(partial_path, SNAPSHOT_INFO_NAME), 'w') as file:
+            json.dump({'last_log_id': self.last_log_id, 'last_item_id': self.last_item_id}, file)
+        os.replace(partial_path, os.path.join(path, snapshot_name))
+        current_path = os.path.join(path, CURRENT_NAME)
+        with open(f'{current_path}.part', 'w') as file:
+            file.write(snapshot_name)
+        os.replace(f'{current_path}.part', current_path)
+        snapshot_names = sorted(name for name in os.listdir(path) if name.startswith(SNAPSHOT_PREFIX))
+        for name in snapshot_names[:-KEPT_SNAPSHOT_COUNT]:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    def get_ip_order(self):
+        """
+        Ties in rankings of IP addresses are ordered by address, computed the first time it is needed.
+        """
+        if self.ip_order is None or len(self.ip_order) != len(self.ip_values):
+            self.ip_order = get_ip_order(self.ip_values)
+        return self.ip_order
+
+    def __len__(self):
+        return len(self.times)
+
+    def add_logs(self, last_log_id):
+        """
+        Add the valid downloads with ids up to the given one that are not in the columns yet.
+        Logs are fetched with a server side cursor and converted a chunk at a time.
+        :return: Amount of logs that were added
+        """
+        ip_codes = {value or None: code for code, value in enumerate(self.ip_values.tolist())}
+        chunks = []
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(LOGS_SQL, [self.last_log_id, last_log_id])
+            with tqdm() as progress:
+                while True:
+                    rows = cursor.fetchmany(FETCH_SIZE)
+                    if not rows:
+                        break
+                    times, s3_keys, ip_addresses, requesters, object_sizes = zip(*rows)
+                    chunks.append((np.array(times, np.int64), np.array(s3_keys, np.int32),
+                                   np.array([ip_codes.setdefault(ip, len(ip_codes)) for ip in ip_addresses],
+                                            np.uint32),
+                                   np.array(requesters, np.int32), np.array(object_sizes, np.int64)))
+                    progress.update(len(rows))
+        self.last_log_id = max(self.last_log_id, last_log_id)
+        if not chunks:
+            return 0
+        self.ip_values = np.array([value or '' for value in ip_codes])
+        added_count = sum(len(chunk[0]) for chunk in chunks)
+        columns = [np.concatenate([getattr(self, name)] + [chunk[index] for chunk in chunks])
+                   for index, name in enumerate(COLUMN_NAMES)]
+        # Logs are mostly loaded in time order, but files of a day can come in late
+        if not np.all(columns[0][:-1] <= columns[0][1:]):
+            order = np.argsort(columns[0], kind='stable')
+            columns = [column[order] for column in columns]
+        for name, column in zip(COLUMN_NAMES, columns):
+            setattr(self, name, column)
+        self.previous_requests = get_previous_rows(self.s3_keys, self.ip_addresses)
+        self.previous_sizes = get_previous_rows(self.s3_keys, self.object_sizes)
+        return added_count
+
+    def add_items(self):
+        """
+        Link keys to the items that were created since the last time, like ingest.link_logs_to_items does for logs.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(KEY_ITEMS_SQL, [self.last_item_id])
+            key_items = cursor.fetchall()
+        last_key = max([len(self.key_items) - 1, int(self.s3_keys.max()) if len(self) else 0] +
+                       [s3_key_id for s3_key_id, _ in key_items])
+        if last_key >= len(self.key_items):
+            self.key_items = np.concatenate([self.key_items, np.zeros(last_key + 1 - len(self.key_items), np.int32)])
+        if key_items:
+            s3_key_ids, item_ids = zip(*key_items)
+            self.key_items[list(s3_key_ids)] = item_ids
+            self.last_item_id = max(self.last_item_id, max(item_ids))
+
+    def get_rows(self, start_time=None, end_time=None):
+        """
+        :param start_time: Start of the range, every download if None
+        :param end_time: End of the range, which includes downloads at exactly this time like the logs do
+        :return: Slice of the rows in the range
+        """
+        if start_time is None:
+            return slice(0, len(self))
+        return slice(np.searchsorted(self.times, get_epoch_microseconds(start_time), 'left'),
+                     np.searchsorted(self.times, get_epoch_microseconds(end_time), 'right'))
+
+    def select(self, start_time=None, end_time=None, cohort=COHORT_ALL, requester_id=None, ip_address=None):
+        """
+        :param cohort: Only downloads of the items in this cohort, see sketches.COHORT_ITEM_FILTERS
+        :param requester_id: Only downloads of the requester with this id
+        :param ip_address: Only downloads of this IP address
+        """
+        rows = self.get_rows(start_time, end_time)
+        masks = []
+        if cohort != COHORT_ALL:
+            cohort_keys = np.isin(self.key_items, list(get_cohort_item_ids()[cohort]))
+            masks.append(cohort_keys[self.s3_keys[rows]])
+        if requester_id is not None:
+            masks.append(self.requesters[rows] == requester_id)
+        if ip_address is not None:
+            codes = np.flatnonzero(self.ip_values == ip_address)
+            # No code can be this high if the address never downloaded anything
+            masks.append(self.ip_addresses[rows] == (codes[0] if len(codes) else len(self.ip_values)))
+        if not masks:
+            return LogSelection(self, rows)
+        return LogSelection(self, np.arange(len(self))[rows][np.logical_and.reduce(masks)])
+
+
+def get_current_path(path):
+    """
+    :param path: Snapshot directory
+    """
+    return os.path.join(path, CURRENT_NAME)
+
+
+def get_snapshot_path(path):
+    """
+    :param path: Snapshot directory
+    :return: Directory of the arrays of the current snapshot
+    """
+    with open(get_current_path(path)) as file:
+        return os.path.join(path, file.read().strip())
+
+
+def refresh_log_columns(path=None, full=False):
+    """
+    Add the logs and items that are new since the snapshot was saved and save it again.
+    Run after every ingest, once its logs are committed.
+    :param path: Snapshot directory, LOG_COLUMNS_PATH in the settings if None
+    :param full: Build the columns from every log instead of the snapshot
+    :return: The refreshed columns and the amount of logs that were added
+    """
+    path = path or settings.LOG_COLUMNS_PATH
+    log_columns = (LogColumns.load(path) if os.path.exists(get_current_path(path)) and not full else
+                   LogColumns.empty())
+    # Logs that are committed while the columns are refreshed are left for the next time
+    last_log_id = Log.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    added_count = log_columns.add_logs(last_log_id)
+    log_columns.add_items()
+    log_columns.save(path)
+    return log_columns, added_count
+
+
+def get_log_columns():
+    """
+    :return: Columns from the snapshot, mapped again when it changed,
+             or None if they are turned off or there is no snapshot yet
+    """
+    global _log_columns, _snapshot_time
+    if not settings.LOG_COLUMNS:
+        return None
+    try:
+        snapshot_time = os.stat(get_current_path(settings.LOG_COLUMNS_PATH)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if snapshot_time != _snapshot_time:
+        _log_columns, _snapshot_time = LogColumns.load(settings.LOG_COLUMNS_PATH, 'r'), snapshot_time
+    return _log_columns
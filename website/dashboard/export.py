@@ -0,0 +1,262 @@
+"""
+Export of the logs joined with their items, experiments and labs into a Parquet dataset for the notebooks.
+The dataset is partitioned by month like the log table, one directory per month, and only months with logs that
+changed since the last export are written again. Text columns are dictionary encoded, so they take little space
+and are read back as pandas categories instead of millions of Python strings.
+pyarrow is only needed to export and read the dataset, the dashboard itself does not use it.
+"""
+import json
+import os
+import tempfile
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from dashboard.models import Log, Item, Experiment, Lab, Operation, S3Key, Requester, ErrorCode, Referrer, UserAgent, \
+    SyncMarker
+from dashboard.partitions import DEFAULT_PARTITION, get_next_month, get_partition_month, get_partition_names
+
+# Holds what every month looked like when it was exported, files starting with _ are not part of the dataset
+MANIFEST_NAME = '_manifest.json'
+PART_NAME = 'part-0.parquet'
+# Name a part is written under until it is complete, files starting with . are not part of the dataset either
+PARTIAL_PART_NAME = f'.{PART_NAME}.part'
+MONTH_FORMAT = '%Y-%m'
+# Sync markers of the months are named with this and the month, their value is how many of its logs were linked
+LINKED_MARKER_PREFIX = 'linked_logs_'
+# Bytes of CSV converted to Arrow at once
+READ_BLOCK_SIZE = 1 << 24
+# Name and type of every column of the dataset, category columns are dictionary encoded text
+EXPORT_COLUMNS = [
+    ('id', 'int64'),
+    ('time', 'timestamp'),
+    ('ip_address', 'category'),
+    ('requester_type', 'int16'),
+    ('http_status', 'int16'),
+    ('bytes_sent', 'int64'),
+    ('object_size', 'int64'),
+    ('total_time', 'int64'),
+    ('turn_around_time', 'int64'),
+    ('operation', 'category'),
+    ('s3_key', 'category'),
+    ('requester', 'category'),
+    ('error_code', 'category'),
+    ('referrer', 'category'),
+    ('user_agent', 'category'),
+    ('item_id', 'int64'),
+    ('item_name', 'category'),
+    ('dataset', 'category'),
+    ('dataset_type', 'category'),
+    ('file_format', 'category'),
+    ('file_type', 'category'),
+    ('date_uploaded', 'date'),
+    ('experiment', 'category'),
+    ('assay_title', 'category'),
+    ('assay_term_name', 'category'),
+    ('date_released', 'date'),
+    ('lab', 'category'),
+]
+LOG_TABLE = Log._meta.db_table
+EXPORT_SQL = f'''
+SELECT log.id, log.time AT TIME ZONE 'UTC', host(log.ip_address), log.requester_type, log.http_status, log.bytes_sent,
+       log.object_size, log.total_time, log.turn_around_time,
+       operation.value, s3_key.value, requester.value, error_code.value, referrer.value, user_agent.value,
+       log.item_id, item.name, item.dataset, item.dataset_type, item.file_format, item.file_type, item.date_uploaded,
+       experiment.name, experiment.assay_title, experiment.assay_term_name, experiment.date_released, lab.name
+FROM {LOG_TABLE} log
+LEFT JOIN {Operation._meta.db_table} operation ON operation.id = log.operation_id
+LEFT JOIN {S3Key._meta.db_table} s3_key ON s3_key.id = log.s3_key_id
+LEFT JOIN {Requester._meta.db_table} requester ON requester.id = log.requester_id
+LEFT JOIN {ErrorCode._meta.db_table} error_code ON error_code.id = log.error_code_id
+LEFT JOIN {Referrer._meta.db_table} referrer ON referrer.id = log.referrer_id
+LEFT JOIN {UserAgent._meta.db_table} user_agent ON user_agent.id = log.user_agent_id
+LEFT JOIN {Item._meta.db_table} item ON item.id = log.item_id
+LEFT JOIN {Experiment._meta.db_table} experiment ON experiment.id = item.experiment_id
+LEFT JOIN {Lab._meta.db_table} lab ON lab.id = item.lab_id
+WHERE log.time >= %s AND log.time < %s
+ORDER BY log.time
+'''
+# Logs are only ever added with higher ids, so a month got new logs if its highest log id changed.
+# It is read from the end of the primary key index of the partition of the month.
+PARTITION_STATE_SQL = 'SELECT MAX(id) FROM {partition}'
+# Logs of months without a partition yet, which are only ever a few
+DEFAULT_PARTITION_STATE_SQL = f'''
+SELECT to_char(time AT TIME ZONE 'UTC', 'YYYY-MM'), MAX(id)
+FROM {DEFAULT_PARTITION}
+GROUP BY 1
+'''
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError('pyarrow is needed for the log export, install it with pip install pyarrow') from error
+    return pyarrow
+
+
+def get_schema(pa):
+    types = {
+        'int16': pa.int16(),
+        'int64': pa.int64(),
+        'timestamp': pa.timestamp('us'),
+        'date': pa.date32(),
+        'category': pa.string(),
+    }
+    return pa.schema([(name, types[type_name]) for name, type_name in EXPORT_COLUMNS])
+
+
+def get_export_schema(pa, schema):
+    """
+    :param schema: Schema of the CSV that Postgres writes
+    :return: Schema of the Parquet files, with dictionary encoded text and times in UTC like the query converts them to
+    """
+    categories = {name for name, type_name in EXPORT_COLUMNS if type_name == 'category'}
+    return pa.schema([
+        (field.name, pa.dictionary(pa.int32(), field.type) if field.name in categories else
+         pa.timestamp('us', tz='UTC') if field.name == 'time' else field.type)
+        for field in schema
+    ])
+
+
+def count_linked_logs(month_counts):
+    """
+    Add to the amount of logs of each month that were linked to items after they were loaded.
+    Linking does not change the highest log id of a month, so this is how the export notices it.
+    :param month_counts: Iterable of tuples of the month as YYYY-MM and how many of its logs were linked
+    """
+    now = timezone.now()
+    for month, linked_count in month_counts:
+        name = f'{LINKED_MARKER_PREFIX}{month}'
+        if not SyncMarker.objects.filter(name=name).update(value=F('value') + linked_count, time=now):
+            SyncMarker.objects.create(name=name, time=now, value=linked_count)
+
+
+def get_linked_counts():
+    """
+    :return: Dictionary of the months as YYYY-MM to how many of their logs were linked since they were loaded
+    """
+    return {name[len(LINKED_MARKER_PREFIX):]: value for name, value in
+            SyncMarker.objects.filter(name__startswith=LINKED_MARKER_PREFIX).values_list('name', 'value')}
+
+
+def get_month_states():
+    """
+    Deleted logs are not noticed, export with full then.
+    :return: Dictionary of the months with logs as YYYY-MM to lists of their highest log id and count of linked logs
+    """
+    last_ids = {}
+    with connection.cursor() as cursor:
+        for partition in sorted(get_partition_names() - {DEFAULT_PARTITION}):
+            cursor.execute(PARTITION_STATE_SQL.format(partition=partition))
+            last_id, = cursor.fetchone()
+            if last_id is not None:
+                last_ids[f'{get_partition_month(partition):{MONTH_FORMAT}}'] = last_id
+        cursor.execute(DEFAULT_PARTITION_STATE_SQL)
+        last_ids.update(cursor.fetchall())
+    linked_counts = get_linked_counts()
+    return {month: [last_id, linked_counts.get(month, 0)] for month, last_id in last_ids.items()}
+
+
+def get_manifest_path(directory):
+    return os.path.join(directory, MANIFEST_NAME)
+
+
+def read_manifest(directory):
+    path = get_manifest_path(directory)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def write_manifest(directory, manifest):
+    partial_path = f'{get_manifest_path(directory)}.part'
+    with open(partial_path, 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(partial_path, get_manifest_path(directory))
+
+
+def get_month_directory(directory, month):
+    return os.path.join(directory, f'month={month}')
+
+
+def export_month(directory, month):
+    """
+    Write the logs of a month into its partition of the dataset. Postgres writes them as CSV with COPY,
+    which Arrow reads in blocks, so no log ever becomes a Python object.
+    :param month: Month as YYYY-MM
+    :return: Amount of logs that were written
+    """
+    pa = import_pyarrow()
+    schema = get_schema(pa)
+    start_time = datetime.strptime(month, MONTH_FORMAT).replace(tzinfo=dt_timezone.utc)
+    month_directory = get_month_directory(directory, month)
+    os.makedirs(month_directory, exist_ok=True)
+    with tempfile.TemporaryFile() as csv_file:
+        with connection.cursor() as cursor:
+            export_sql = cursor.cursor.mogrify(EXPORT_SQL, [start_time, get_next_month(start_time)]).decode()
+            cursor.cursor.copy_expert(f'COPY ({export_sql}) TO STDOUT WITH (FORMAT csv)', csv_file)
+        csv_file.seek(0)
+        reader = pa.csv.open_csv(
+            csv_file,
+            read_options=pa.csv.ReadOptions(column_names=schema.names, block_size=READ_BLOCK_SIZE),
+            # COPY writes NULL as an empty field and empty text quoted
+            convert_options=pa.csv.ConvertOptions(column_types=schema, strings_can_be_null=True,
+                                                  quoted_strings_can_be_null=False))
+        part_path = os.path.join(month_directory, PART_NAME)
+        partial_path = os.path.join(month_directory, PARTIAL_PART_NAME)
+        written_count = 0
+        with pa.parquet.ParquetWriter(partial_path, get_export_schema(pa, schema)) as writer:
+            for batch in reader:
+                writer.write_table(pa.Table.from_batches([batch]).cast(writer.schema))
+                written_count += batch.num_rows
+    os.replace(partial_path, part_path)
+    return written_count
+
+
+def export_logs(directory=None, full=False):
+    """
+    Export every month that has new logs or logs that were linked to items since the last export.
+    :param directory: Directory of the dataset, LOG_EXPORT_DIR in the settings if None
+    :param full: Export every month again, for example after item metadata changed
+    :return: Months that were exported
+    """
+    directory = directory or settings.LOG_EXPORT_DIR
+    os.makedirs(directory, exist_ok=True)
+    manifest = {} if full else read_manifest(directory)
+    month_states = get_month_states()
+    changed_months = sorted(month for month, state in month_states.items() if manifest.get(month) != state)
+    for month in changed_months:
+        written_count = export_month(directory, month)
+        print(f'Exported {written_count} logs of {month}')
+        manifest[month] = month_states[month]
+        write_manifest(directory, manifest)
+    # Months can only disappear if logs were deleted
+    for month in set(manifest) - set(month_states):
+        part_path = os.path.join(get_month_directory(directory, month), PART_NAME)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        del manifest[month]
+    write_manifest(directory, manifest)
+    return changed_months
+
+
+def read_log_export(columns=None, months=None, directory=None):
+    """
+    Open the exported logs as a DataFrame. The files are memory mapped and only the wanted columns are read,
+    text columns come back as categories.
+    :param columns: Names of the columns to read, all of them if None, see EXPORT_COLUMNS
+    :param months: Months to read as YYYY-MM, all of them if None
+    :param directory: Directory of the dataset, LOG_EXPORT_DIR in the settings if None
+    """
+    pa = import_pyarrow()
+    filters = [('month', 'in', list(months))] if months else None
+    table = pa.parquet.read_table(directory or settings.LOG_EXPORT_DIR, columns=columns, filters=filters,
+                                  memory_map=True, partitioning='hive')
+    return table.to_pandas()
@@ -10,5 +10,6 @@ class SelectTimeRangeForm(forms.Form):
     def clean(self):
         cleaned_data = super().clean()
         # Make sure that the start time is valid with regards to the end time
-        if cleaned_data.get('start_time') > cleaned_data.get('end_time'):
+        start_time, end_time = cleaned_data.get('start_time'), cleaned_data.get('end_time')
+        if start_time and end_time and start_time > end_time:
             self.add_error('end_time', 'End time must be after start time!')
@@ -0,0 +1,111 @@
+"""
+Offline geolocation of IP addresses from range databases, like the free DB-IP lite CSVs.
+The ranges are loaded into the IpLocationRange and IpIspRange tables, which have an index on the start of every range,
+so the range of an address is found with one binary search in the index: the last range that starts before it.
+Every new IP address of a sync is looked up in one statement and saved in IpAddress, so the dashboard never waits on
+an external service, and downloads by country or ISP are a join of the logs with IpAddress.
+"""
+import gzip
+
+from django.db import connection, transaction
+
+from dashboard.models import IpAddress, IpIspRange, IpLocationRange, Log
+
+IMPORT_TABLE = 'ip_range_import'
+# Columns of the CSVs, which have no header. These are the ones of dbip-city-lite and dbip-asn-lite.
+LOCATION_CSV_COLUMNS = '''
+start_ip inet, end_ip inet, continent text, country text, region text, city text, latitude numeric, longitude numeric
+'''
+ISP_CSV_COLUMNS = 'start_ip inet, end_ip inet, as_number bigint, as_organization text'
+LOCATION_SELECT_SQL = "start_ip, end_ip, COALESCE(country, ''), COALESCE(city, ''), latitude, longitude"
+# The ISP is written like the IP API it replaces wrote it, for example AS15169 Google LLC
+ISP_SELECT_SQL = "start_ip, end_ip, CONCAT_WS(' ', 'AS' || as_number, as_organization)"
+LOOKUP_COLUMNS = ['ip_address', 'isp', 'country', 'city', 'latitude', 'longitude']
+# Looks up the addresses of a query in the ranges
+SELECT_SQL = f'''
+SELECT new.ip_address, COALESCE(isp.isp, ''), COALESCE(location.country, ''), COALESCE(location.city, ''),
+       location.latitude, location.longitude
+FROM ({{ip_addresses_sql}}) new
+LEFT JOIN LATERAL (
+    SELECT * FROM {IpLocationRange._meta.db_table} WHERE start_ip <= new.ip_address ORDER BY start_ip DESC LIMIT 1
+) location ON location.end_ip >= new.ip_address
+LEFT JOIN LATERAL (
+    SELECT * FROM {IpIspRange._meta.db_table} WHERE start_ip <= new.ip_address ORDER BY start_ip DESC LIMIT 1
+) isp ON isp.end_ip >= new.ip_address
+'''
+# Saves the addresses of a query, those that are saved already are only looked up again if updating
+LOOKUP_SQL = f'''
+INSERT INTO {IpAddress._meta.db_table} ({', '.join(LOOKUP_COLUMNS)})
+{SELECT_SQL}
+WHERE %(update)s OR NOT EXISTS (
+    SELECT FROM {IpAddress._meta.db_table} saved WHERE saved.ip_address = new.ip_address
+)
+ON CONFLICT (ip_address) DO UPDATE
+SET isp = excluded.isp, country = excluded.country, city = excluded.city,
+    latitude = excluded.latitude, longitude = excluded.longitude
+'''
+LOG_IP_ADDRESSES_SQL = f'''
+SELECT DISTINCT ip_address FROM {Log._meta.db_table} WHERE id > %(after_log_id)s AND ip_address IS NOT NULL
+'''
+SINGLE_IP_ADDRESS_SQL = 'SELECT %(ip_address)s::inet AS ip_address'
+
+
+def open_csv(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def load_ranges(path, model, csv_columns, select_sql):
+    """
+    Replace the ranges of a model with the ones in a CSV. Postgres reads the file with COPY,
+    so the millions of ranges never become Python objects.
+    :param path: Path of the CSV, can be gzipped
+    :param csv_columns: Names and types of the columns of the CSV
+    :param select_sql: Columns of the model without the id, selected from the CSV
+    :return: Amount of ranges that were loaded
+    """
+    table = model._meta.db_table
+    fields = ', '.join(field.column for field in model._meta.concrete_fields if not field.primary_key)
+    with transaction.atomic(), connection.cursor() as cursor, open_csv(path) as file:
+        cursor.execute(f'CREATE TEMPORARY TABLE {IMPORT_TABLE} ({csv_columns}) ON COMMIT DROP')
+        cursor.cursor.copy_expert(f'COPY {IMPORT_TABLE} FROM STDIN WITH (FORMAT csv)', file)
+        cursor.execute(f'TRUNCATE {table}')
+        cursor.execute(f'INSERT INTO {table} ({fields}) SELECT {select_sql} FROM {IMPORT_TABLE}')
+        range_count = cursor.rowcount
+        # Dropped on commit as well, but that is later if this runs inside another transaction
+        cursor.execute(f'DROP TABLE {IMPORT_TABLE}')
+        cursor.execute(f'ANALYZE {table}')
+    return range_count
+
+
+def load_locations(path):
+    return load_ranges(path, IpLocationRange, LOCATION_CSV_COLUMNS, LOCATION_SELECT_SQL)
+
+
+def load_isps(path):
+    return load_ranges(path, IpIspRange, ISP_CSV_COLUMNS, ISP_SELECT_SQL)
+
+
+def look_up_ip_addresses(after_log_id=0, update=False):
+    """
+    Save the location and ISP of every IP address of the logs that is not saved yet.
+    Addresses that are in no range are saved without them, so they are not looked up again every sync.
+    :param after_log_id: Only addresses of logs with a higher id, like the ones a sync added
+    :param update: Look up addresses that are saved already as well, for example after loading new ranges
+    :return: Amount of addresses that were saved
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(LOOKUP_SQL.format(ip_addresses_sql=LOG_IP_ADDRESSES_SQL),
+                       {'after_log_id': after_log_id, 'update': update})
+        return cursor.rowcount
+
+
+def look_up_ip_address(ip_address):
+    """
+    Look up a single address without saving it, for addresses that were never in a sync.
+    Only addresses of logs are saved, so any address that is asked for does not add a row.
+    :param ip_address: Valid IP address
+    :return: Unsaved IP information of the address
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(SELECT_SQL.format(ip_addresses_sql=SINGLE_IP_ADDRESS_SQL), {'ip_address': ip_address})
+        return IpAddress(**dict(zip(LOOKUP_COLUMNS, cursor.fetchone())))
@@ -0,0 +1,150 @@
+"""
+Space-Saving summaries of the most downloaded items and most active IP addresses, one per day, dimension and cohort
+in the DailyHeavyHitter table. A summary only keeps a fixed amount of keys with counts that are never too low.
+Summaries of several days are merged to pick a few candidates for the top of a ranking,
+which are then counted exactly instead of every key.
+See Metwally et al., Efficient Computation of Frequent and Top-k Elements in Data Streams.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from tqdm import tqdm
+
+from dashboard.metadata import get_sync_time, set_sync_time
+from dashboard.models import DailyDownload, DailyHeavyHitter
+from dashboard.rollups import get_rollup_days
+from dashboard.sketches import COHORT_ALL, get_cohort_item_ids
+
+# Keys kept per summary, rankings are only taken from summaries up to a fraction of this
+CAPACITY = 500
+DIMENSION_ITEMS = 'items'
+DIMENSION_IP_ADDRESSES = 'ip_addresses'
+# Set once the summaries were built from the whole rollup, rankings only use them after that
+HEAVY_HITTER_MARKER = 'daily_heavy_hitters'
+
+# Only ever goes from False to True
+_heavy_hitters_ready = False
+
+
+def encode_key(key):
+    """
+    JSON object keys have to be strings, downloads without an IP address are kept under an empty one.
+    """
+    return '' if key is None else str(key)
+
+
+def decode_key(dimension, key):
+    if dimension == DIMENSION_ITEMS:
+        return int(key)
+    return key or None
+
+
+class SpaceSaving:
+
+    def __init__(self, counters=None):
+        """
+        :param counters: Dictionary of keys to lists of their count and error, like in the database
+        """
+        self.counters = counters or {}
+
+    @classmethod
+    def from_counts(cls, counts):
+        """
+        :param counts: Counter with the exact counts of keys
+        :return: Summary of the keys with the highest counts, every key left out has a count that is not higher
+        """
+        return cls({key: [count, 0] for key, count in counts.most_common(CAPACITY)})
+
+    def get_floor(self):
+        """
+        :return: Highest count that a key which is not in the summary can have
+        """
+        return min(count for count, _ in self.counters.values()) if len(self.counters) >= CAPACITY else 0
+
+    def merge(self, other):
+        """
+        Keys that are only in one summary might have had up to the floor of the other one,
+        which is added to both their count and error.
+        """
+        floor, other_floor = self.get_floor(), other.get_floor()
+        merged = {}
+        for key in self.counters.keys() | other.counters.keys():
+            count, error = self.counters.get(key, (floor, floor))
+            other_count, other_error = other.counters.get(key, (other_floor, other_floor))
+            merged[key] = [count + other_count, error + other_error]
+        top_keys = sorted(merged, key=lambda key: merged[key][0], reverse=True)[:CAPACITY]
+        self.counters = {key: merged[key] for key in top_keys}
+
+
+def rebuild_daily_heavy_hitters(start_day=None, end_day=None, days=None):
+    """
+    Build the summaries again from the daily rollup, with exact counts for every day.
+    Items are ranked by unique downloads, so they count one for every IP address that downloaded them.
+    IP addresses are ranked by total downloads.
+    :param start_day: First day to rebuild, every day if None
+    :param end_day: Day after the last one to rebuild
+    :param days: Days to rebuild instead of a range, like the ones a sync loaded logs for
+    """
+    if days is None:
+        days = get_rollup_days(start_day, end_day)
+    cohort_downloads = {COHORT_ALL: DailyDownload.objects.all()}
+    cohort_downloads.update({cohort: DailyDownload.objects.filter(item_id__in=item_ids)
+                             for cohort, item_ids in get_cohort_item_ids().items()})
+    for day in tqdm(days):
+        rows = []
+        for cohort, downloads in cohort_downloads.items():
+            downloads = downloads.filter(day=day)
+            item_counts = Counter({encode_key(s3_key_id): count for s3_key_id, count in downloads
+                                   .values_list('s3_key_id')
+                                   .annotate(count=Count('ip_address', distinct=True))})
+            ip_counts = Counter({encode_key(ip_address): count for ip_address, count in downloads
+                                 .values_list('ip_address')
+                                 .annotate(count=Sum('downloads'))})
+            rows.extend(DailyHeavyHitter(day=day, dimension=dimension, cohort=cohort,
+                                         counters=SpaceSaving.from_counts(counts).counters)
+                        for dimension, counts in ((DIMENSION_ITEMS, item_counts), (DIMENSION_IP_ADDRESSES, ip_counts))
+                        if counts)
+        with transaction.atomic():
+            DailyHeavyHitter.objects.filter(day=day).delete()
+            DailyHeavyHitter.objects.bulk_create(rows)
+
+
+def get_top_candidates(dimension, cohort, amount, start_day=None, end_day=None):
+    """
+    Merge the summaries of the days in a range and pick the keys that are most likely at the top.
+    A key's count over the range is at most the sum of its counts on the days it is in a summary
+    and the floors of the days it is not in, and this upper bound is what candidates are picked by.
+    :param start_day: First day of the range, every day if None
+    :param end_day: Day after the last one of the range
+    :return: Tuple of the candidate keys, with every key that is tied with the last one, and the highest count any
+             other key can have, which is lower than the bound of every candidate
+    """
+    summaries = DailyHeavyHitter.objects.filter(dimension=dimension, cohort=cohort)
+    if start_day is not None:
+        summaries = summaries.filter(day__gte=start_day, day__lt=end_day)
+    # Every key gets the floors of all days, so only what is above the floor on each day is summed up
+    total_floor, excess = 0, Counter()
+    for counters in summaries.values_list('counters', flat=True).iterator():
+        floor = SpaceSaving(counters).get_floor()
+        total_floor += floor
+        for key, (count, _) in counters.items():
+            excess[key] += count - floor
+    top = excess.most_common()
+    end = min(amount, len(top))
+    while 0 < end < len(top) and top[end][1] == top[end - 1][1]:
+        end += 1
+    candidates = [decode_key(dimension, key) for key, _ in top[:end]]
+    return candidates, total_floor + (top[end][1] if len(top) > end else 0)
+
+
+def set_heavy_hitters_ready():
+    set_sync_time(HEAVY_HITTER_MARKER, timezone.now())
+
+
+def is_heavy_hitters_ready():
+    global _heavy_hitters_ready
+    if not _heavy_hitters_ready:
+        _heavy_hitters_ready = get_sync_time(HEAVY_HITTER_MARKER) is not None
+    return _heavy_hitters_ready
@@ -0,0 +1,602 @@
+"""
+Streaming ingest of S3 server access logs into the Log table.
+Log files are read line by line, parsed into typed Log column values and bulk loaded with PostgreSQL COPY.
+Nothing is buffered except the rows of the batch that is currently being loaded, so memory stays flat.
+"""
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone as dt_timezone
+from itertools import chain, islice
+
+from django.db import connection, connections, transaction
+from django.db.models import Max, Min
+from django.db.models.functions import MD5
+from django.utils import timezone
+from tqdm import tqdm
+
+from dashboard.export import count_linked_logs
+from dashboard.heavy_hitters import rebuild_daily_heavy_hitters
+from dashboard.metadata import get_sync_value, set_sync_time
+from dashboard.models import ClientLogValue, Item, Log, LogFile, S3Key
+from dashboard.partitions import ensure_log_partitions, get_month, get_next_month
+from dashboard.rollups import add_daily_downloads, link_daily_downloads_to_items, get_day, get_download_days
+from dashboard.sketches import rebuild_daily_sketches, get_cohort_item_ids
+
+LOG_BUCKET = 'encode-public-logs'
+LOG_BUCKET_REGION = 'us-west-2'
+# Only full and partial downloads are put into the database, everything else in the logs is skipped
+GET_OPERATION = 'REST.GET.OBJECT'
+ENCODED_INSTANCE = 'encoded-instance'
+# How many rows are sent in a single COPY. Objects are never split across batches so this is a lower bound.
+BATCH_SIZE = 50000
+# How many log objects are handed to a worker process at once when loading in parallel
+OBJECTS_PER_TASK = 200
+# Tasks allowed to wait for each worker. Listing stops when the queue is full, so memory is capped.
+TASKS_PER_WORKER = 2
+# Written by the Go script that used to load logs. Only read when the ledger is still empty.
+LAST_KEY_FILE = 'LastLogS3Key.txt'
+# Range of log ids that one statement links to items, each range is its own short transaction
+LINK_ID_RANGE = 500000
+# Name of the sync marker whose value is the id of the last log that the sketches and heavy hitters include
+SUMMARY_MARKER = 'daily_summaries'
+
+# Columns of the log table in the order that rows are sent with COPY
+LOG_COLUMNS = (
+    'bucket',
+    'time',
+    'ip_address',
+    'requester',
+    'requester_type',
+    'request_id',
+    'operation',
+    's3_key',
+    'item_id',
+    'request_uri',
+    'http_status',
+    'error_code',
+    'bytes_sent',
+    'object_size',
+    'total_time',
+    'turn_around_time',
+    'referrer',
+    'user_agent',
+    'version_id',
+)
+LogRow = namedtuple('LogRow', LOG_COLUMNS)
+# A log file in the bucket or on disk, key is the path relative to the root
+LogObject = namedtuple('LogObject', ('key', 'size'))
+
+# Columns that hold the id of their value in a lookup table, rows are parsed with the text and encoded right before COPY
+VALUE_COLUMNS = {field: Log._meta.get_field(field).related_model for field in Log.VALUE_FIELDS}
+
+COPY_STATEMENT = (f'COPY {Log._meta.db_table} '
+                  f'({", ".join(Log._meta.get_field(column).column for column in LOG_COLUMNS)}) FROM STDIN')
+# Characters that have a special meaning in the COPY text format. Postgres text can not hold NUL at all.
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': None})
+COPY_NULL = '\\N'
+
+# Fields are separated by spaces, except for the time which is in brackets and a few others which are quoted
+FIELD_PATTERN = re.compile(r'\[[^\]]*\]|"(?:[^"\\]|\\.)*"|\S+')
+MONTHS = {name: number for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+
+class LogField:
+    """
+    Index of each field in a split log line.
+    See https://docs.aws.amazon.com/AmazonS3/latest/dev/LogFormat.html for the full format.
+    """
+    BUCKET_OWNER = 0
+    BUCKET = 1
+    TIME = 2
+    IP = 3
+    REQUESTER = 4
+    REQUEST_ID = 5
+    OPERATION = 6
+    S3_KEY = 7
+    REQUEST_URI = 8
+    HTTP_STATUS = 9
+    ERROR_CODE = 10
+    BYTES_SENT = 11
+    OBJECT_SIZE = 12
+    TOTAL_TIME = 13
+    TURN_AROUND_TIME = 14
+    REFERRER = 15
+    USER_AGENT = 16
+    VERSION_ID = 17
+
+
+def get_text(field):
+    return None if field == '-' else field
+
+
+def get_quoted_text(field):
+    return get_text(field[1:-1])
+
+
+def get_int(field):
+    return None if field == '-' else int(field)
+
+
+def get_time(field):
+    """
+    Parse a bracketed log time such as [06/Feb/2019:00:00:38 +0000].
+    Slicing is a lot faster than strptime and S3 always writes the times in UTC.
+    """
+    return datetime(int(field[8:12]), MONTHS[field[4:7]], int(field[1:3]),
+                    int(field[13:15]), int(field[16:18]), int(field[19:21]), tzinfo=dt_timezone.utc)
+
+
+def parse_log_line(line, key_to_item_id):
+    """
+    :param line: Raw line from an S3 access log file
+    :param key_to_item_id: Maps S3 keys to the ids of their items, so logs can be linked without a query
+    :return: Typed column values for the log table, or None if the line is not a download
+    """
+    fields = FIELD_PATTERN.findall(line)
+    if len(fields) <= LogField.VERSION_ID or fields[LogField.OPERATION] != GET_OPERATION:
+        return None
+    requester = get_text(fields[LogField.REQUESTER])
+    s3_key = get_text(fields[LogField.S3_KEY])
+    return LogRow(
+        bucket=get_text(fields[LogField.BUCKET]),
+        time=get_time(fields[LogField.TIME]),
+        ip_address=get_text(fields[LogField.IP]),
+        requester=requester,
+        requester_type=(Log.REQUESTER_ENCODED_INSTANCE if requester and ENCODED_INSTANCE in requester
+                        else Log.REQUESTER_DEFAULT),
+        request_id=fields[LogField.REQUEST_ID],
+        operation=GET_OPERATION,
+        s3_key=s3_key,
+        item_id=key_to_item_id.get(s3_key),
+        request_uri=get_quoted_text(fields[LogField.REQUEST_URI]),
+        http_status=get_int(fields[LogField.HTTP_STATUS]),
+        error_code=get_text(fields[LogField.ERROR_CODE]),
+        bytes_sent=get_int(fields[LogField.BYTES_SENT]),
+        object_size=get_int(fields[LogField.OBJECT_SIZE]),
+        total_time=get_int(fields[LogField.TOTAL_TIME]),
+        turn_around_time=get_int(fields[LogField.TURN_AROUND_TIME]),
+        referrer=get_quoted_text(fields[LogField.REFERRER]),
+        user_agent=get_quoted_text(fields[LogField.USER_AGENT]),
+        version_id=get_text(fields[LogField.VERSION_ID]),
+    )
+
+
+def parse_log_lines(lines, key_to_item_id):
+    """
+    Generator that turns raw log lines into rows, skipping anything that is not a download.
+    """
+    for line in lines:
+        # Cheap check before splitting, most lines in the bucket are not downloads
+        if GET_OPERATION not in line:
+            continue
+        row = parse_log_line(line, key_to_item_id)
+        if row:
+            yield row
+
+
+def get_key_to_item_id():
+    return dict(Item.objects.values_list('s3_key', 'id'))
+
+
+class LocalLogSource:
+    """
+    Log files in a local directory, for example one that was filled with aws s3 sync.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def list_objects(self, start_after=None):
+        paths = []
+        for root, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                paths.append(os.path.relpath(os.path.join(root, file_name), self.directory))
+        # Sort so that keys are in the same order they would be listed in the bucket
+        for key in sorted(paths):
+            if start_after is None or key > start_after:
+                yield LogObject(key, os.path.getsize(os.path.join(self.directory, key)))
+
+    def open_lines(self, log_object):
+        with open(os.path.join(self.directory, log_object.key), 'r', encoding='utf-8', errors='replace') as file:
+            yield from file
+
+    def __str__(self):
+        return self.directory
+
+
+class S3LogSource:
+    """
+    Log files in the public log bucket. Objects are streamed from the response body, never saved to disk.
+    """
+
+    def __init__(self, bucket=LOG_BUCKET, region=LOG_BUCKET_REGION):
+        self.bucket = bucket
+        self.region = region
+        self._client = None
+
+    @property
+    def client(self):
+        # Created lazily so that the source can be sent to other processes before it is used
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3', region_name=self.region)
+        return self._client
+
+    def __getstate__(self):
+        # Clients can not be pickled, worker processes make their own
+        return dict(self.__dict__, _client=None)
+
+    def list_objects(self, start_after=None):
+        list_kwargs = {'Bucket': self.bucket}
+        if start_after:
+            list_kwargs['StartAfter'] = start_after
+        for page in self.client.get_paginator('list_objects_v2').paginate(**list_kwargs):
+            for s3_object in page.get('Contents', ()):
+                yield LogObject(s3_object['Key'], s3_object['Size'])
+
+    def open_lines(self, log_object):
+        body = self.client.get_object(Bucket=self.bucket, Key=log_object.key)['Body']
+        for line in body.iter_lines():
+            yield line.decode('utf-8', 'replace')
+
+    def __str__(self):
+        return f's3://{self.bucket}'
+
+
+# Ids of the values that are known to be in each lookup table. Every process fills its own as it loads batches.
+_value_ids = {column: {} for column in VALUE_COLUMNS}
+# Lookup of each row column, None for columns that are sent as they are
+_column_value_ids = tuple(_value_ids.get(column) for column in LOG_COLUMNS)
+
+
+def ensure_value_ids(rows):
+    """
+    Make sure every value of the lookup columns in the rows has an id, creating the values that are missing.
+    This commits on its own before the rows are loaded. The ids stay valid even if loading the rows fails.
+    """
+    for column, model in VALUE_COLUMNS.items():
+        value_ids = _value_ids[column]
+        index = LogRow._fields.index(column)
+        missing = {row[index] for row in rows if row[index] is not None and row[index] not in value_ids}
+        if missing:
+            model.objects.bulk_create([model(value=value) for value in missing], ignore_conflicts=True)
+            value_ids.update(get_value_ids(model, missing))
+
+
+def get_value_ids(model, values):
+    """
+    :return: Pairs of each of the values and its id in the lookup table of the model
+    """
+    if not issubclass(model, ClientLogValue):
+        return model.objects.filter(value__in=values).values_list('value', 'id')
+    # Only the hash of these values is indexed, see ClientLogValue
+    hashes = [hashlib.md5(value.encode('utf-8')).hexdigest() for value in values]
+    return [(value, value_id) for value, value_id in (model.objects
+                                                     .annotate(value_md5=MD5('value'))
+                                                     .filter(value_md5__in=hashes)
+                                                     .values_list('value', 'id'))
+            if value in values]
+
+
+def encode_row(row):
+    return [value if value_ids is None or value is None else value_ids[value]
+            for value_ids, value in zip(_column_value_ids, row)]
+
+
+def is_valid_download(row):
+    return (row.http_status == 200 and row.requester_type != Log.REQUESTER_ENCODED_INSTANCE
+            and row.s3_key is not None)
+
+
+def get_downloads(rows):
+    """
+    :return: Generator of the rollup values of the rows that are valid downloads, see add_daily_downloads
+    """
+    s3_key_ids, requester_ids = _value_ids['s3_key'], _value_ids['requester']
+    return ((get_day(row.time), s3_key_ids[row.s3_key], row.ip_address, requester_ids.get(row.requester), row.item_id)
+            for row in rows if is_valid_download(row))
+
+
+def format_copy_value(value):
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, str):
+        return value.translate(COPY_ESCAPES)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def copy_rows(cursor, rows):
+    """
+    Load rows into the log table with a single COPY statement. Their values must already have ids, see ensure_value_ids.
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(map(format_copy_value, encode_row(row))))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(COPY_STATEMENT, buffer)
+
+
+class LogBatch:
+    """
+    Rows of whole log objects that are loaded together in a single transaction.
+    """
+
+    def __init__(self):
+        self.objects = []
+        self.row_counts = []
+        self.rows = []
+
+    def add(self, log_object, rows):
+        self.objects.append(log_object)
+        self.row_counts.append(len(rows))
+        self.rows.extend(rows)
+
+
+def iter_batches(source, log_objects, key_to_item_id, batch_size=BATCH_SIZE):
+    """
+    Group the parsed rows of whole log objects into batches of at least batch_size rows.
+    Objects that can not be read are marked as failed in the ledger and left out.
+    """
+    batch = LogBatch()
+    for log_object in log_objects:
+        try:
+            rows = list(parse_log_lines(source.open_lines(log_object), key_to_item_id))
+        except Exception as error:
+            print(f'[{os.getpid()}] Could not read {log_object.key}: {error}', flush=True)
+            mark_failed([log_object])
+            continue
+        batch.add(log_object, rows)
+        if len(batch.rows) >= batch_size:
+            yield batch
+            batch = LogBatch()
+    if batch.objects:
+        yield batch
+
+
+def get_start_after():
+    """
+    :return: Key to continue listing the bucket after, everything up to it is already in the ledger
+    """
+    with connection.cursor() as cursor:
+        # Compare bytes like S3 does when it lists keys, not with the locale of the database
+        cursor.execute(f'SELECT MAX(key COLLATE "C") FROM {LogFile._meta.db_table}')
+        last_key = cursor.fetchone()[0]
+    if last_key is None and os.path.exists(LAST_KEY_FILE):
+        # Left behind by the Go script that loaded logs before the ledger existed
+        with open(LAST_KEY_FILE, 'r') as file:
+            last_key = file.read().strip() or None
+    return last_key
+
+
+def get_unfinished_objects():
+    """
+    :return: Objects in the ledger that failed to load or were still pending when a run stopped
+    """
+    return [LogObject(key, size) for key, size in (LogFile.objects
+                                                    .exclude(status=LogFile.STATUS_LOADED)
+                                                    .order_by('key')
+                                                    .values_list('key', 'size'))]
+
+
+def mark_pending(log_objects):
+    LogFile.objects.bulk_create([LogFile(key=log_object.key, size=log_object.size) for log_object in log_objects],
+                                ignore_conflicts=True)
+
+
+def mark_loaded(log_objects, row_counts):
+    log_files = LogFile.objects.in_bulk([log_object.key for log_object in log_objects], field_name='key')
+    for log_object, row_count in zip(log_objects, row_counts):
+        log_file = log_files[log_object.key]
+        log_file.size = log_object.size
+        log_file.row_count = row_count
+        log_file.status = LogFile.STATUS_LOADED
+        log_file.time_updated = timezone.now()
+    LogFile.objects.bulk_update(log_files.values(), ['size', 'row_count', 'status', 'time_updated'])
+
+
+def mark_failed(log_objects):
+    (LogFile.objects
+     .filter(key__in=[log_object.key for log_object in log_objects])
+     .update(status=LogFile.STATUS_FAILED, time_updated=timezone.now()))
+
+
+def load_batch(cursor, batch):
+    """
+    Load the rows of a batch, add them to the daily rollup and mark its objects as loaded, all or nothing.
+    The sketches and heavy hitters are only rebuilt after every batch is in, see update_daily_summaries.
+    """
+    ensure_log_partitions({get_month(row.time) for row in batch.rows})
+    ensure_value_ids(batch.rows)
+    with transaction.atomic():
+        copy_rows(cursor, batch.rows)
+        add_daily_downloads(cursor, get_downloads(batch.rows))
+        mark_loaded(batch.objects, batch.row_counts)
+
+
+def load_objects(source, log_objects, key_to_item_id, batch_size=BATCH_SIZE):
+    """
+    Parse and COPY the given log objects on the connection of the current process.
+    The objects must already be in the ledger.
+    :return: Amount of rows that were loaded
+    """
+    row_count = 0
+    with connection.cursor() as cursor:
+        for batch in iter_batches(source, log_objects, key_to_item_id, batch_size):
+            try:
+                load_batch(cursor, batch)
+            except Exception as error:
+                # The transaction was rolled back so none of the rows are in, the next sync tries these again
+                print(f'[{os.getpid()}] Failed to load {len(batch.objects)} files, first key: {batch.objects[0].key}: '
+                      f'{error}', flush=True)
+                mark_failed(batch.objects)
+                continue
+            row_count += len(batch.rows)
+            print(f'[{os.getpid()}] Inserted {len(batch.rows)} logs from {len(batch.objects)} files, '
+                  f'last key: {batch.objects[-1].key}', flush=True)
+    return row_count
+
+
+# Set once in every worker process, the map is too big to send along with each task
+_worker_key_to_item_id = None
+
+
+def _init_worker(barrier):
+    global _worker_key_to_item_id
+    # The parent closes its connections before forking, this makes sure a worker never queries on one of them
+    connections.close_all()
+    _worker_key_to_item_id = get_key_to_item_id()
+    # No worker takes a task before every one of them is forked, see load_tasks_in_parallel
+    barrier.wait()
+
+
+def _is_started():
+    return True
+
+
+def _load_objects_in_worker(source, log_objects, batch_size):
+    return load_objects(source, log_objects, _worker_key_to_item_id, batch_size)
+
+
+def load_tasks_in_parallel(source, tasks, workers, batch_size=BATCH_SIZE):
+    """
+    Spread tasks of log objects across a pool of processes, each parsing and loading on its own database connection.
+    Only a bounded amount of tasks is queued at once, so listing a huge bucket does not fill up memory.
+    :return: Amount of rows that were loaded
+    """
+    # Listing the first task uses the database, so it has to happen before the pool is started
+    tasks = iter(tasks)
+    first_task = next(tasks, None)
+    if first_task is None:
+        return 0
+    # Workers must open their own connections, a socket shared with the parent would be corrupted.
+    # Close it before forking, it reopens on the next query.
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    pending, row_count = set(), 0
+    with ProcessPoolExecutor(workers, context, _init_worker, (context.Barrier(workers),)) as executor:
+        # Before Python 3.11 workers are forked one at a time as tasks are submitted, and listing tasks marks them
+        # pending in between. Workers wait for each other before taking a task, so these submits fork every worker
+        # before the parent uses the database again.
+        wait([executor.submit(_is_started) for _ in range(workers)])
+        for task_objects in chain([first_task], tasks):
+            if len(pending) >= workers * TASKS_PER_WORKER:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                row_count += sum(future.result() for future in done)
+            pending.add(executor.submit(_load_objects_in_worker, source, task_objects, batch_size))
+        row_count += sum(future.result() for future in wait(pending).done)
+    return row_count
+
+
+def iter_tasks(source):
+    """
+    Split the objects that still have to be loaded into tasks. Unfinished objects from earlier runs come first.
+    Every object is put in the ledger as pending before its task is handed out,
+    so objects of a run that crashes are retried by the next one instead of being skipped.
+    """
+    log_objects = chain(get_unfinished_objects(), source.list_objects(get_start_after()))
+    for task_objects in iter(lambda: list(islice(log_objects, OBJECTS_PER_TASK)), []):
+        mark_pending(task_objects)
+        yield task_objects
+
+
+def ingest_logs(source, batch_size=BATCH_SIZE, workers=1):
+    """
+    Load every log object in the source that is not loaded yet according to the ledger.
+    :param source: Where to read log files from, either the bucket or a local directory
+    :param batch_size: Minimum amount of rows sent in one COPY
+    :param workers: Amount of processes to parse and load with. Parsing is CPU bound so this should be the core count.
+    :return: Amount of rows that were loaded
+    """
+    print(f'Reading logs from {source} with {workers} worker(s)')
+    # New logs almost always land in this month or the next, create them up front so loading never has to
+    this_month = get_month(timezone.now())
+    ensure_log_partitions([this_month, get_next_month(this_month)])
+    tasks = iter_tasks(source)
+    if workers > 1:
+        return load_tasks_in_parallel(source, tasks, workers, batch_size)
+    key_to_item_id = get_key_to_item_id()
+    return sum(load_objects(source, task_objects, key_to_item_id, batch_size) for task_objects in tasks)
+
+
+def get_last_item_id():
+    """
+    :return: Highest item id, items that are created afterwards have higher ones. Zero if there are no items.
+    """
+    return Item.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+
+
+def rebuild_daily_summaries(days):
+    """
+    Build the sketches and heavy hitters of some days again from the daily rollup.
+    """
+    if days:
+        rebuild_daily_sketches(days=days)
+        rebuild_daily_heavy_hitters(days=days)
+
+
+def update_daily_summaries(after_log_id=0):
+    """
+    Rebuild the sketches and heavy hitters of the days that logs were loaded for since the last time.
+    This runs once every batch is loaded instead of in the transaction of each one, where parallel loads would
+    wait for each other on the rows of the same days, and every day is only rebuilt once.
+    The id of the last log that was included is kept, so days are rebuilt by the next sync if one fails before.
+    :param after_log_id: Logs with a higher id are new, only used if the summaries were never updated like this
+    :return: Amount of days that were rebuilt
+    """
+    summary_log_id = get_sync_value(SUMMARY_MARKER)
+    if summary_log_id is not None:
+        after_log_id = summary_log_id
+    last_log_id = Log.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    days = get_download_days(after_log_id, last_log_id)
+    rebuild_daily_summaries(days)
+    set_sync_time(SUMMARY_MARKER, timezone.now(), last_log_id)
+    return len(days)
+
+
+def link_logs_to_items(after_item_id=0, id_range=LINK_ID_RANGE):
+    """
+    Link logs without an item to the item with their S3 key.
+    Logs are loaded before the metadata sync knows about every file, those logs would keep a null item forever.
+    The log table is walked in ranges of ids with one set based update each, so rows are only locked briefly.
+    The daily rollup is linked as well, and the days that it linked to items of a cohort are rebuilt,
+    since the sketches and heavy hitters of the cohort did not include them.
+    :param after_item_id: Only link to items with a higher id, usually the ones the last metadata sync created
+    :param id_range: Amount of log ids covered by one update
+    :return: Amount of logs that were linked
+    """
+    if not Item.objects.filter(id__gt=after_item_id).exists():
+        return 0
+    linked_downloads = link_daily_downloads_to_items(after_item_id)
+    cohort_item_ids = set().union(*get_cohort_item_ids().values())
+    rebuild_daily_summaries(sorted({day for day, item_id in linked_downloads if item_id in cohort_item_ids}))
+    first_id, last_id = Log.objects.filter(item__isnull=True).aggregate(Min('id'), Max('id')).values()
+    if first_id is None:
+        return 0
+    linked_count = 0
+    with connection.cursor() as cursor:
+        for start in tqdm(range(first_id, last_id + 1, id_range)):
+            with transaction.atomic():
+                # Counted by month for the export, which can not tell from the logs that some were linked
+                cursor.execute(f'''
+                    WITH linked AS (
+                        UPDATE {Log._meta.db_table} log SET item_id = item.id
+                        FROM {Item._meta.db_table} item JOIN {S3Key._meta.db_table} s3_key ON s3_key.value = item.s3_key
+                        WHERE log.id >= %s AND log.id < %s AND log.item_id IS NULL
+                          AND log.s3_key_id = s3_key.id AND item.id > %s
+                        RETURNING log.time
+                    )
+                    SELECT to_char(time AT TIME ZONE 'UTC', 'YYYY-MM'), COUNT(*) FROM linked GROUP BY 1
+                ''', [start, start + id_range, after_item_id])
+                month_counts = cursor.fetchall()
+                count_linked_logs(month_counts)
+            linked_count += sum(count for _, count in month_counts)
+    return linked_count
@@ -1,4 +1,5 @@
 import os
+from itertools import islice
 
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -8,6 +9,8 @@ from tqdm import tqdm
 from dashboard.models import AnalysisLabItem, Log
 
 DEFAULT_FILE = 'access_creation_dates.csv'
+# Rows fetched from the server side cursor and turned into a DataFrame at once
+CHUNK_SIZE = 50000
 
 
 class Command(BaseCommand):
@@ -39,38 +42,46 @@ class Command(BaseCommand):
             action='store_true'
         )
 
+    @staticmethod
+    def get_dates_df(chunk):
+        """
+        :param chunk: List of tuples of an S3 key and the time it was first downloaded
+        :return: DataFrame of the keys with their creation and access dates and the time in between
+        """
+        df = pd.DataFrame.from_records(chunk, columns=['s3_key', 'time'])
+        # We are taking the date of creation to be that of what is in the s3 key so we do not have to do
+        # additional querying to the encode server.
+        df['created'] = pd.to_datetime(df['s3_key'].str.split('/').str[:3].str.join('/'), format='%Y/%m/%d')
+        df['accessed'] = pd.to_datetime(df['time'], utc=True).dt.tz_localize(None).dt.normalize()
+        df['delta'] = df['accessed'] - df['created']
+        return df[['s3_key', 'created', 'accessed', 'delta']]
+
     @staticmethod
     def get_df_from_db():
         # Logs that are from the specific experiment, people downloading files from that exact one.
         # Also only raw downloads no head requests. Also exclude any of developer downloaders.
         logs = (Log.objects
-                .filter(operation='REST.GET.OBJECT')
-                .filter(item_name__in=AnalysisLabItem.objects.values_list('name', flat=True))
-                .exclude(requester='arn:aws:iam::265191883777:user/admin2'))
-        rows = []
-
-        # Do not check for distinct rows
-        # for log in tqdm(logs.iterator(), total=logs.count()):
-        #     created = pd.to_datetime('/'.join(log.s3_key.split('/')[:3]), format='%Y/%m/%d')
-        #     accessed = pd.to_datetime(log.time.date())
-        #     rows.append([log.s3_key, created, accessed, accessed - created])
-
+                .filter(operation__value='REST.GET.OBJECT')
+                .filter(item__name__in=AnalysisLabItem.objects.values_list('name', flat=True))
+                .exclude(requester__value='arn:aws:iam::265191883777:user/admin2'))
         # A distinct s3 key (file name in Amazon) and ip address represent a unique download.
         # The goal is to filter out when the same user downloads a file multiple times.
-        distinct_logs = logs.values_list('s3_key', 'ip_address').distinct()
-        for s3_key, ip_address in tqdm(distinct_logs.iterator(), total=distinct_logs.count()):
-            # There will be multiple rows with the name key and ip address most of the time.
-            # They will have different download times so just take the first one.
-            # TODO maybe take average in future? sqlite does not support however
-            duplicate_rows = logs.filter(s3_key=s3_key, ip_address=ip_address)
-            first = duplicate_rows.order_by('time').first()
-            # Pandas likes it when the the datetime is in their own type.
-            # We are taking the date of creation to be that of what is in the s3 key so we do not have to do
-            # additional querying to the encode server.
-            created = pd.to_datetime('/'.join(first.s3_key.split('/')[:3]), format='%Y/%m/%d')
-            accessed = pd.to_datetime(first.time.date())
-            rows.append([s3_key, created, accessed, accessed - created])
-        return pd.DataFrame(rows, columns=['s3_key', 'created', 'accessed', 'delta'])
+        # There will be multiple rows with the same key and ip address most of the time, DISTINCT ON keeps the
+        # first download of each in a single query. The iterator streams them through a server side cursor.
+        # TODO maybe take average in future? sqlite does not support however
+        first_downloads = (logs
+                           .order_by('s3_key__value', 'ip_address', 'time')
+                           .distinct('s3_key__value', 'ip_address')
+                           .values_list('s3_key__value', 'time')
+                           .iterator(chunk_size=CHUNK_SIZE))
+        dfs = []
+        with tqdm() as progress:
+            for chunk in iter(lambda: list(islice(first_downloads, CHUNK_SIZE)), []):
+                dfs.append(Command.get_dates_df(chunk))
+                progress.update(len(chunk))
+        if not dfs:
+            return Command.get_dates_df([])
+        return pd.concat(dfs, ignore_index=True)
 
     def handle(self, *args, **options):
         if options['items']:
@@ -92,8 +103,7 @@ class Command(BaseCommand):
             file_name = options['csv']
             if os.path.exists(file_name):
                 print(f'Reading from CSV file {file_name}')
-                read = pd.read_csv(file_name, parse_dates=['created', 'accessed'], date_parser=pd.to_datetime)
-                log_df = log_df.append(read)
+                log_df = pd.read_csv(file_name, parse_dates=['created', 'accessed'])
             else:
                 print(f'[Warning] File not found: {file_name}')
         else:
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.caching import bump_data_version
+from dashboard.co_downloads import build_download_matrix, read_download_pairs, save_co_downloads, TOP_AMOUNT, \
+    MAX_ITEMS_PER_IP
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds which items are downloaded together most often from all downloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top',
+            default=TOP_AMOUNT,
+            type=int,
+            help='Amount of other items kept per item'
+        )
+        parser.add_argument(
+            '--max-items-per-ip',
+            default=MAX_ITEMS_PER_IP,
+            type=int,
+            help='Leave out IP addresses that downloaded more items, like mirrors and crawlers'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Reading pairs of IP addresses and items...')
+        # Every item is read, so IP addresses with too many items are left out while the matrix is built
+        ip_codes, item_ids = read_download_pairs()
+        try:
+            matrix, column_item_ids = build_download_matrix(ip_codes, item_ids, options['max_items_per_ip'])
+        except ImportError as error:
+            raise CommandError(error)
+        self.stdout.write(f'Multiplying the downloads of {matrix.shape[0]} IP addresses and {matrix.shape[1]} '
+                          f'items...')
+        saved_count = save_co_downloads(matrix, column_item_ids, options['top'])
+        self.stdout.write(f'Saved {saved_count} pairs of items that are downloaded together')
+        bump_data_version()
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.export import export_logs
+
+
+class Command(BaseCommand):
+    help = 'Exports the logs with their items, experiments and labs into a Parquet dataset partitioned by month'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--directory',
+            default=settings.LOG_EXPORT_DIR,
+            type=str,
+            help='Directory of the dataset, LOG_EXPORT_DIR by default'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Export every month again instead of only those with logs that changed since the last export'
+        )
+
+    def handle(self, *args, **options):
+        print(f'Exporting logs to {options["directory"]}...')
+        try:
+            exported_months = export_logs(options['directory'], options['full'])
+        except ImportError as error:
+            raise CommandError(error)
+        print(f'Exported {len(exported_months)} months')
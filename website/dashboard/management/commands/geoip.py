@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.caching import bump_data_version
+from dashboard.geoip import load_locations, load_isps, look_up_ip_addresses
+
+
+class Command(BaseCommand):
+    help = 'Loads IP range databases and looks up the location and ISP of the IP addresses of the logs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--locations',
+            type=str,
+            help='CSV of IP ranges and their location like dbip-city-lite, can be gzipped'
+        )
+        parser.add_argument(
+            '--isps',
+            type=str,
+            help='CSV of IP ranges and their ISP like dbip-asn-lite, can be gzipped'
+        )
+
+    def handle(self, *args, **options):
+        if options['locations']:
+            print(f'Loaded {load_locations(options["locations"])} location ranges')
+        if options['isps']:
+            print(f'Loaded {load_isps(options["isps"])} ISP ranges')
+        # Addresses that were looked up in the old ranges are looked up again in the new ones
+        update = bool(options['locations'] or options['isps'])
+        print('Looking up IP addresses...')
+        print(f'Looked up {look_up_ip_addresses(update=update)} IP addresses')
+        bump_data_version()
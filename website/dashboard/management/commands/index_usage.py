@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+# Partitions have their own copy of every index, their statistics are added up under the index of the parent table
+INDEX_USAGE_SQL = '''
+SELECT COALESCE(parent_table.relname, stats.relname) AS table_name,
+       COALESCE(parent_index.relname, stats.indexrelname) AS index_name,
+       SUM(stats.idx_scan) AS scans,
+       SUM(stats.idx_tup_read) AS tuples_read,
+       SUM(pg_relation_size(stats.indexrelid)) AS size
+FROM pg_stat_user_indexes stats
+         LEFT JOIN pg_inherits ON pg_inherits.inhrelid = stats.indexrelid
+         LEFT JOIN pg_class parent_index ON parent_index.oid = pg_inherits.inhparent
+         LEFT JOIN pg_index ON pg_index.indexrelid = parent_index.oid
+         LEFT JOIN pg_class parent_table ON parent_table.oid = pg_index.indrelid
+WHERE COALESCE(parent_table.relname, stats.relname) LIKE %s
+GROUP BY 1, 2
+ORDER BY scans, size DESC
+'''
+
+
+class Command(BaseCommand):
+    help = 'Reports how often each index was scanned, to find indexes that no query uses'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            default='dashboard_%',
+            type=str,
+            help='Only report indexes of tables with names like this pattern'
+        )
+        parser.add_argument(
+            '--unused',
+            action='store_true',
+            help='Only report indexes that were never scanned'
+        )
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Reset the statistics of the whole database afterwards, to measure from now on'
+        )
+
+    @staticmethod
+    def format_size(size):
+        for unit in ['B', 'kB', 'MB', 'GB']:
+            if size < 1024:
+                return f'{size:.0f} {unit}'
+            size /= 1024
+        return f'{size:.1f} TB'
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()')
+            stats_reset, = cursor.fetchone()
+            print(f'Index usage since {stats_reset or "the database was created"}')
+            cursor.execute(INDEX_USAGE_SQL, [options['table']])
+            print(f'{"Table":<32}{"Index":<56}{"Scans":>12}{"Tuples read":>16}{"Size":>12}')
+            for table_name, index_name, scans, tuples_read, size in cursor.fetchall():
+                if options['unused'] and scans:
+                    continue
+                print(f'{table_name:<32}{index_name:<56}{scans:>12}{tuples_read:>16}{self.format_size(size):>12}')
+            if options['reset']:
+                cursor.execute('SELECT pg_stat_reset()')
+                print('Reset statistics')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.caching import bump_data_version
+from dashboard.ingest import link_logs_to_items, LINK_ID_RANGE
+
+
+class Command(BaseCommand):
+    help = 'Links logs that were loaded before their item existed to it'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--after-item-id',
+            default=0,
+            type=int,
+            help='Only link logs to items with a higher id'
+        )
+        parser.add_argument(
+            '--id-range',
+            default=LINK_ID_RANGE,
+            type=int,
+            help='Amount of log ids updated in one statement'
+        )
+
+    def handle(self, *args, **options):
+        print('Linking logs to items...')
+        linked_count = link_logs_to_items(options['after_item_id'], options['id_range'])
+        print(f'Linked {linked_count} logs')
+        bump_data_version()
@@ -0,0 +1,51 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from dashboard.caching import bump_data_version
+from dashboard.heavy_hitters import rebuild_daily_heavy_hitters, set_heavy_hitters_ready
+from dashboard.ingest import SUMMARY_MARKER
+from dashboard.metadata import set_sync_time
+from dashboard.query import get_last_log_id
+from dashboard.rollups import rebuild_daily_downloads, set_rollup_ready
+from dashboard.sketches import rebuild_daily_sketches, set_sketches_ready
+
+
+def parse_day(text):
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily download rollup from the logs and the sketches and heavy hitters from the rollup'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start',
+            type=parse_day,
+            help='First day to rebuild as YYYY-MM-DD, defaults to the first download'
+        )
+        parser.add_argument(
+            '--end',
+            type=parse_day,
+            help='Day after the last one to rebuild as YYYY-MM-DD, defaults to after the last download'
+        )
+
+    def handle(self, *args, **options):
+        rebuild_start = timezone.now()
+        last_log_id = get_last_log_id()
+        print('Rebuilding daily downloads...')
+        rebuild_daily_downloads(options['start'], options['end'])
+        print('Rebuilding daily sketches...')
+        rebuild_daily_sketches(options['start'], options['end'])
+        print('Rebuilding daily heavy hitters...')
+        rebuild_daily_heavy_hitters(options['start'], options['end'])
+        # The dashboard only reads the rollup and summaries once they were built from all logs
+        if not options['start'] and not options['end']:
+            set_rollup_ready()
+            set_sketches_ready()
+            set_heavy_hitters_ready()
+            # The sync rebuilds the days of logs that are loaded after this
+            set_sync_time(SUMMARY_MARKER, rebuild_start, last_log_id)
+        print('Finished rebuilding daily downloads, sketches and heavy hitters')
+        bump_data_version()
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from dashboard.columnar import refresh_log_columns
+
+
+class Command(BaseCommand):
+    help = 'Adds the logs and items that are new since the last time to the snapshot of the in-memory columns'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default=settings.LOG_COLUMNS_PATH,
+            type=str,
+            help='Snapshot directory, LOG_COLUMNS_PATH by default'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Build the columns from every log instead of adding to the snapshot'
+        )
+
+    def handle(self, *args, **options):
+        print(f'Refreshing the columns in {options["path"]}...')
+        log_columns, added_count = refresh_log_columns(options['path'], options['full'])
+        print(f'Added {added_count} logs, the columns have {len(log_columns)} logs')
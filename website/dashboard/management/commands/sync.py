@@ -1,14 +1,21 @@
-import json
 import os
-import sys
-import subprocess
-from datetime import datetime
+from datetime import datetime, timedelta
+from urllib.parse import quote
 
 import requests
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from tqdm import tqdm
+from django.utils import timezone
 
-from dashboard.models import Experiment, Award, Lab, Item
+from dashboard.caching import bump_data_version
+from dashboard.columnar import refresh_log_columns
+from dashboard.geoip import look_up_ip_addresses
+from dashboard.ingest import ingest_logs, LocalLogSource, S3LogSource, BATCH_SIZE, get_last_item_id, \
+    link_logs_to_items, update_daily_summaries
+from dashboard.metadata import MetadataLoader, iter_graph, save_chunks, READ_SIZE, METADATA_MARKER, get_sync_time, \
+    set_sync_time, get_experiment_name
+from dashboard.query import get_last_log_id
+from dashboard.warming import warm_cache
 
 ITEM_FIELDS = [
     'assay_title',
@@ -29,6 +36,17 @@ EXPERIMENT_FIELDS = [
     'assay_term_name',
     'date_released',
 ]
+# ENCODE has no general modification date, so this is what an incremental sync of items filters on.
+# Experiments are few compared to files and are always all requested, so every change to them is picked up.
+ITEM_DATE_FIELDS = ['date_created']
+# Dates are compared by day and in the time zone of the ENCODE server, so go back a bit to not miss anything
+SINCE_MARGIN = timedelta(days=1)
+# Changes to items that do not move their creation date are picked up by requesting all of them this often
+FULL_SYNC_INTERVAL = timedelta(days=7)
+# Name of the sync marker holding when the last metadata sync that requested all items started
+FULL_METADATA_MARKER = 'metadata_full'
+# Experiments requested by accession at once, the accessions have to fit into the URL
+EXPERIMENT_REQUEST_SIZE = 100
 
 
 class Command(BaseCommand):
@@ -51,6 +69,34 @@ class Command(BaseCommand):
             '--skip',
             action='store_true'
         )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Get all items instead of only those that were created since the last sync, '
+                 f'which is done every {FULL_SYNC_INTERVAL.days} days anyway'
+        )
+        parser.add_argument(
+            '--logs',
+            type=str,
+            help='Directory of log files to load instead of the bucket'
+        )
+        parser.add_argument(
+            '--batch-size',
+            default=BATCH_SIZE,
+            type=int,
+            help='Minimum amount of logs sent to the database in one COPY'
+        )
+        parser.add_argument(
+            '--no-warm',
+            action='store_true',
+            help='Do not compute the default pages into the cache after the sync, see the warm_cache command'
+        )
+        parser.add_argument(
+            '--workers',
+            default=1,
+            type=int,
+            help='Amount of processes that parse and load log files in parallel'
+        )
 
     @staticmethod
     def add_fields_to_search(base_url, fields):
@@ -59,106 +105,101 @@ class Command(BaseCommand):
         return base_url
 
     @staticmethod
-    def get_json_from_url(option, object_type, fields):
+    def get_changed_since_query(date_fields, since):
+        """
+        :return: Advanced query matching objects with any of the date fields on or after the given time
+        """
+        since_date = (since - SINCE_MARGIN).date()
+        return ' OR '.join(f'{field}:[{since_date} TO *]' for field in date_fields)
+
+    @staticmethod
+    def get_experiment_results(names):
+        """
+        Request experiments by accession, for those that items reference but the experiment search did not return.
+        """
+        print(f'Getting {len(names)} missing experiments')
+        for start in range(0, len(names), EXPERIMENT_REQUEST_SIZE):
+            query = f'accession:({" OR ".join(names[start:start + EXPERIMENT_REQUEST_SIZE])})'
+            yield from Command.get_json_from_url(None, 'Experiment', EXPERIMENT_FIELDS, query)
+
+    @staticmethod
+    def get_json_from_url(option, object_type, fields, query=None):
+        """
+        Stream the @graph entries of a search one at a time, from a cached file if there is one or else from the server.
+        When downloading, entries are handed out while the rest of the response is still coming in.
+        """
         file_name = option
         if file_name and os.path.exists(file_name):
             print(f'Loading from file {file_name}')
             with open(file_name, 'r') as file:
-                json_result = json.load(file)
+                yield from iter_graph(iter(lambda: file.read(READ_SIZE), ''))
         else:
             url = Command.add_fields_to_search(
                 f'https://www.encodeproject.org/search/?type={object_type}&format=json&limit=all', fields)
+            if query:
+                url += f'&advancedQuery={quote(query)}'
             print(f'Using url: {url}')
-            json_result = requests.get(url).json()
-            if file_name:
-                print(f'Saving to file {file_name}')
-                with open(file_name, 'w') as file:
-                    json.dump(json_result, file)
-        return json_result['@graph']
-
-    @staticmethod
-    def add_items_and_experiments(items_result, experiment_result_dict):
-        for item_json in tqdm(items_result):
-            if 's3_uri' not in item_json:
-                continue
-            s3_uri_split = item_json['s3_uri'].split('/')
-            item_name = s3_uri_split[-1]
-            s3_key = '/'.join(s3_uri_split[3:])
-            file_format = item_json.get('file_format')
-            file_type = item_json.get('file_format_type')
-            date_uploaded = datetime.strptime(item_json['date_created'].split('T')[0], '%Y-%m-%d')
-            # Experiment information
-            data_set_type = item_json['dataset'].split('/')[1]
-            data_set_name = item_json['dataset'].split('/')[2]
-            if data_set_type == 'experiments':
-                experiment_json = experiment_result_dict.get(data_set_name)
-                assay_title = experiment_json.get('assay_title') if experiment_json else None
-                assay_term_name = experiment_json.get('assay_term_name') if experiment_json else None
-                date_released = experiment_json.get('date_released') if experiment_json else None
-                experiment, _ = Experiment.objects.get_or_create(name=data_set_name, defaults={
-                    'name': data_set_name,
-                    'date_released': date_released,
-                    'assay_title': assay_title,
-                    'assay_term_name': assay_term_name,
-                })
-            else:
-                experiment = None
-            # Getting award, lab, and PI information from JSON
-            award = item_json.get('award')
-            award_name = award.get('name') if award else None
-            pi = award.get('pi') if award else None
-            lab = pi.get('lab') if pi else None
-            lab_name = lab.get('name') if lab else None
-            project = award.get('project') if award else None
-            rfa = award.get('rfa') if award else None
-            award_status = award.get('status') if award else None
-            pi_name = pi.get('title') if pi else None
-            # Award
-            if award_name:
-                db_award, _ = Award.objects.get_or_create(name=award_name, defaults={
-                    'name': award_name,
-                    'pi': pi_name,
-                    'project': project,
-                    'rfa': rfa,
-                    'status': award_status
-                })
-            else:
-                db_award = None
-            if lab_name:
-                # Lab
-                db_lab, _ = Lab.objects.get_or_create(name=lab_name, defaults={
-                    'name': lab_name
-                })
-            else:
-                db_lab = None
-            # Item
-            Item.objects.get_or_create({
-                's3_key': s3_key,
-                'name': item_name,
-                'dataset': data_set_name,
-                'dataset_type': data_set_type,
-                'experiment': experiment,
-                'file_format': file_format,
-                'file_type': file_type,
-                'award': db_award,
-                'lab': db_lab,
-                'date_uploaded': date_uploaded
-            }, s3_key=s3_key)
+            with requests.get(url, stream=True) as response:
+                response.raise_for_status()
+                response.encoding = 'utf-8'
+                chunks = response.iter_content(READ_SIZE, decode_unicode=True)
+                if file_name:
+                    print(f'Saving to file {file_name}')
+                    chunks = save_chunks(chunks, file_name)
+                yield from iter_graph(chunks)
+                # Read what comes after the array as well, otherwise the saved file would be incomplete
+                for _ in chunks:
+                    pass
 
     def handle(self, *args, **options):
+        last_item_id = None
         if options['skip']:
             print('Skipping synchronization of items and experiments...')
         else:
             print('Getting items and experiments...')
+            # Taken before anything is requested, so whatever changes during the sync is requested again next time
+            sync_start = timezone.now()
+            since = get_sync_time(METADATA_MARKER)
+            full_since = get_sync_time(FULL_METADATA_MARKER)
+            full = options['full'] or not since or not full_since or sync_start - full_since >= FULL_SYNC_INTERVAL
+            item_query = None
+            if not full:
+                print(f'Only getting items that were created since {since - SINCE_MARGIN:%Y-%m-%d}')
+                item_query = self.get_changed_since_query(ITEM_DATE_FIELDS, since)
             # Add items and experiments into the database so we can link logs to them
-            item_results = self.get_json_from_url(options['items'], 'File', ITEM_FIELDS)
+            # Items are streamed straight into the loader, they are only requested once experiments are read
+            item_results = self.get_json_from_url(options['items'], 'File', ITEM_FIELDS, item_query)
             experiment_json = self.get_json_from_url(options['experiments'], 'Experiment', EXPERIMENT_FIELDS)
             experiment_result_dict = {}
             for result in experiment_json:
-                experiment_result_dict[result['@id'].split('/')[2]] = result
+                experiment_result_dict[get_experiment_name(result)] = result
             print('Adding items and experiments...')
-            self.add_items_and_experiments(item_results, experiment_result_dict)
-        print('Running Go command...')
+            last_item_id = get_last_item_id()
+            MetadataLoader(experiment_result_dict, self.get_experiment_results).load(item_results)
+            set_sync_time(METADATA_MARKER, sync_start)
+            if full:
+                set_sync_time(FULL_METADATA_MARKER, sync_start)
+        print('Loading logs...')
         start = datetime.now()
-        subprocess.run(['go', 'run', 'go/extract.go'], cwd=os.getcwd())
+        last_log_id = get_last_log_id()
+        source = LocalLogSource(options['logs']) if options['logs'] else S3LogSource()
+        row_count = ingest_logs(source, options['batch_size'], options['workers'])
+        print(f'Loaded {row_count} logs')
         print(f'Finished logs in {datetime.now() - start}')
+        if last_item_id is not None:
+            # Logs loaded by earlier syncs can be for files that only now have an item
+            print('Linking logs to new items...')
+            print(f'Linked {link_logs_to_items(last_item_id)} logs')
+        print('Rebuilding daily sketches and heavy hitters...')
+        print(f'Rebuilt {update_daily_summaries(last_log_id)} days')
+        print('Looking up new IP addresses...')
+        print(f'Looked up {look_up_ip_addresses(last_log_id)} IP addresses')
+        if settings.LOG_COLUMNS:
+            print('Adding new logs to the in-memory columns...')
+            _, added_count = refresh_log_columns()
+            print(f'Added {added_count} logs')
+        bump_data_version()
+        if not options['no_warm']:
+            print('Warming the cache...')
+            statuses = warm_cache()
+            print(f'Warmed {sum(status_code == 200 for _, status_code in statuses)} of {len(statuses)} pages')
@@ -1,7 +1,11 @@
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 
+from dashboard.caching import bump_data_version
+from dashboard.metadata import get_sync_value, set_sync_time
 from dashboard.models import QueryCountAtTime
-from dashboard.query import calculate_query_count_intervals, BERNSTEIN_EXPERIMENT_FILTER_KWARGS
+from dashboard.query import calculate_query_counts, save_query_counts, get_last_log_id, \
+    BERNSTEIN_EXPERIMENT_FILTER_KWARGS, HISTOGRAM_WIDTHS
 
 
 class Command(BaseCommand):
@@ -10,22 +14,35 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
             '--dataset',
-            nargs=1,
+            default='all',
+            choices=['all', 'bernstein'],
             type=str,
         )
+        parser.add_argument(
+            '--width',
+            default=QueryCountAtTime.WIDTH_DAY,
+            choices=list(HISTOGRAM_WIDTHS),
+            type=str,
+            help='Length of time that each reading counts the queries of'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Count every reading again instead of only those with new logs since the last run'
+        )
 
     def handle(self, *args, **options):
-        data_set = options['dataset'] or 'all'
-        print(f'Starting post-process for {data_set}')
+        data_set, width = options['dataset'], options['width']
+        print(f'Starting post-process for {data_set} by {width}')
         filter_args = BERNSTEIN_EXPERIMENT_FILTER_KWARGS if data_set == 'bernstein' else {}
-        readings = calculate_query_count_intervals(**filter_args)
-        for time, count in readings:
-            at_time = QueryCountAtTime.objects.filter(data_set=data_set, time=time)
-            # If the reading already exists for this time update it, or else create a new object
-            if at_time.exists():
-                print(f'Updated query count reading at time {time} with count {count}')
-                at_time.update(count=count)
-            else:
-                print(f'Created query count reading at time {time} with count {count}')
-                QueryCountAtTime.objects.create(data_set=data_set, time=time, count=count)
+        # Logs are marked by id, the id of the last one is taken first so logs added while counting are counted
+        # next time
+        marker_name = f'query_counts_{data_set}_{width}'
+        after_log_id = None if options['full'] else get_sync_value(marker_name)
+        last_log_id = get_last_log_id()
+        readings = calculate_query_counts(width, after_log_id, **filter_args)
+        save_query_counts(data_set, width, readings)
+        set_sync_time(marker_name, timezone.now(), last_log_id)
+        print(f'Saved {len(readings)} query count readings')
+        bump_data_version()
         print('Finished post-process')
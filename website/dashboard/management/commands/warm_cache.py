@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.warming import warm_cache, TABLE_PAGE_COUNT, WORKER_COUNT
+
+
+class Command(BaseCommand):
+    help = 'Computes the default dashboard pages, their stats and the first pages of their tables into the cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pages',
+            default=TABLE_PAGE_COUNT,
+            type=int,
+            help='Amount of pages of every table to compute'
+        )
+        parser.add_argument(
+            '--workers',
+            default=WORKER_COUNT,
+            type=int,
+            help='Amount of pages computed at once, each one runs its own queries'
+        )
+
+    def handle(self, *args, **options):
+        print('Warming the cache...')
+        statuses = warm_cache(options['pages'], options['workers'])
+        for url, status_code in statuses:
+            if status_code != 200:
+                print(f'{url} failed with status {status_code}')
+        print(f'Warmed {sum(status_code == 200 for _, status_code in statuses)} of {len(statuses)} pages')
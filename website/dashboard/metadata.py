@@ -0,0 +1,277 @@
+"""
+Loading of File and Experiment objects from the ENCODE search into the Item, Experiment, Award and Lab tables.
+"""
+import json
+import os
+from datetime import datetime
+
+from django.db.models import Q
+from tqdm import tqdm
+
+from dashboard.models import Experiment, Award, Lab, Item, SyncMarker
+
+# How many items are parsed before missing rows are created and changed ones are updated
+BATCH_SIZE = 5000
+# Characters read from a search result at once. Results are never held in memory as a whole.
+READ_SIZE = 1 << 16
+GRAPH_KEY = '"@graph"'
+# Name of the sync marker holding when the last metadata sync that went through started
+METADATA_MARKER = 'metadata'
+# Fields of an item that are compared with what is in the database to find out if it changed
+ITEM_UPDATE_FIELDS = [
+    'name',
+    'dataset',
+    'dataset_type',
+    'experiment_id',
+    'file_format',
+    'file_type',
+    'award_id',
+    'lab_id',
+    'date_uploaded',
+]
+EXPERIMENT_UPDATE_FIELDS = [
+    'date_released',
+    'assay_title',
+    'assay_term_name',
+]
+
+
+def get_sync_time(name):
+    """
+    :return: When the sync with this marker name last went through, or None if it never did
+    """
+    return SyncMarker.objects.filter(name=name).values_list('time', flat=True).first()
+
+
+def set_sync_time(name, time, value=None):
+    SyncMarker.objects.update_or_create(name=name, defaults={'time': time, 'value': value})
+
+
+def get_sync_value(name):
+    """
+    :return: Value of the sync marker with this name, or None if there is none
+    """
+    return SyncMarker.objects.filter(name=name).values_list('value', flat=True).first()
+
+
+def parse_date(text):
+    return datetime.strptime(text.split('T')[0], '%Y-%m-%d').date() if text else None
+
+
+def iter_graph(chunks):
+    """
+    Incrementally parse the @graph array of an ENCODE search result, yielding one entry at a time.
+    Only the entry that is currently being parsed is kept in memory, not the whole result.
+    :param chunks: Iterable of consecutive pieces of the JSON text, for example from a file or an HTTP response
+    """
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    buffer = ''
+    # Skip ahead to the start of the array, the key can be split across two chunks
+    while True:
+        key_index = buffer.find(GRAPH_KEY)
+        array_index = buffer.find('[', key_index) if key_index >= 0 else -1
+        if array_index >= 0:
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buffer = (buffer[key_index:] if key_index >= 0 else buffer[-len(GRAPH_KEY):]) + chunk
+    buffer, position = buffer[array_index + 1:], 0
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            # Read to the end, chunks that are saved as they pass through are only complete then
+            for _ in chunks:
+                pass
+            return
+        try:
+            entry, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The entry is not complete yet, read more of it
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield entry
+
+
+def save_chunks(chunks, file_name):
+    """
+    Write chunks to a file as they pass through. The file only gets its name once everything was written,
+    so a download that was cut off is never mistaken for a complete one.
+    """
+    partial_file_name = f'{file_name}.part'
+    with open(partial_file_name, 'w') as file:
+        for chunk in chunks:
+            file.write(chunk)
+            yield chunk
+    os.replace(partial_file_name, file_name)
+
+
+def get_experiment_name(experiment_json):
+    """
+    :return: Accession of an experiment from its path, like ENCSR000AAA for /experiments/ENCSR000AAA/
+    """
+    return experiment_json['@id'].split('/')[2]
+
+
+def parse_item(item_json):
+    """
+    :return: Tuple of the item field values, the experiment name, the award values and the lab name,
+             or None if the file is not in the S3 bucket
+    """
+    if 's3_uri' not in item_json:
+        return None
+    s3_uri_split = item_json['s3_uri'].split('/')
+    data_set_type = item_json['dataset'].split('/')[1]
+    data_set_name = item_json['dataset'].split('/')[2]
+    item = {
+        's3_key': '/'.join(s3_uri_split[3:]),
+        'name': s3_uri_split[-1],
+        'dataset': data_set_name,
+        'dataset_type': data_set_type,
+        'file_format': item_json.get('file_format'),
+        'file_type': item_json.get('file_format_type'),
+        'date_uploaded': parse_date(item_json['date_created']),
+    }
+    experiment_name = data_set_name if data_set_type == 'experiments' else None
+    # Getting award, lab, and PI information from JSON
+    award_json = item_json.get('award')
+    award = None
+    lab_name = None
+    if award_json:
+        pi = award_json.get('pi')
+        lab = pi.get('lab') if pi else None
+        lab_name = lab.get('name') if lab else None
+        if award_json.get('name'):
+            award = {
+                'name': award_json.get('name'),
+                'pi': pi.get('title') if pi else None,
+                'project': award_json.get('project'),
+                'rfa': award_json.get('rfa'),
+                'status': award_json.get('status'),
+            }
+    return item, experiment_name, award, lab_name
+
+
+class MetadataLoader:
+    """
+    Bulk loads items and everything they reference.
+    The keys of existing rows are read into dictionaries once up front, so looking them up costs no queries.
+    Missing rows are created with bulk_create in batches and items that changed are updated with bulk_update.
+    """
+
+    def __init__(self, experiment_result_dict, get_experiment_results=None, batch_size=BATCH_SIZE):
+        """
+        :param experiment_result_dict: Maps experiment names to their JSON from the search, used to fill them in
+        :param get_experiment_results: Called with a list of experiment names that are not in the dictionary,
+                                       returns an iterable of their JSON from the search. Without it experiments
+                                       that are not in the dictionary are created without their fields.
+        """
+        self.experiment_result_dict = experiment_result_dict
+        self.get_experiment_results = get_experiment_results
+        self.batch_size = batch_size
+        self.experiment_ids = dict(Experiment.objects.values_list('name', 'id'))
+        self.award_ids = dict(Award.objects.values_list('name', 'id'))
+        self.lab_ids = dict(Lab.objects.values_list('name', 'id'))
+        # Only a hash of the values is kept for every item to save memory, it is enough to tell if one changed
+        self.items = {s3_key: (item_id, hash(tuple(values))) for s3_key, item_id, *values in
+                      Item.objects.values_list('s3_key', 'id', *ITEM_UPDATE_FIELDS).iterator()}
+        self.created_count = 0
+        self.updated_count = 0
+
+    def get_experiment(self, name):
+        experiment_json = self.experiment_result_dict.get(name) or {}
+        return Experiment(name=name,
+                          date_released=parse_date(experiment_json.get('date_released')),
+                          assay_title=experiment_json.get('assay_title'),
+                          assay_term_name=experiment_json.get('assay_term_name'))
+
+    @staticmethod
+    def create_missing(model, ids, rows_by_name):
+        """
+        Create rows with names that are not in the database yet and remember their ids.
+        Ids are not set by bulk_create when conflicts are ignored, so they are read back in one query.
+        """
+        missing = {name: row for name, row in rows_by_name.items() if name not in ids}
+        if missing:
+            model.objects.bulk_create(missing.values(), ignore_conflicts=True)
+            ids.update(model.objects.filter(name__in=missing).values_list('name', 'id'))
+
+    def add_experiment_results(self, names):
+        """
+        Get the JSON of experiments that are not in the dictionary from the search.
+        """
+        names = [name for name in names if name not in self.experiment_result_dict]
+        if names and self.get_experiment_results:
+            for result in self.get_experiment_results(names):
+                self.experiment_result_dict[get_experiment_name(result)] = result
+
+    def load_batch(self, parsed_items):
+        self.add_experiment_results({name for _, name, _, _ in parsed_items
+                                     if name and name not in self.experiment_ids})
+        self.create_missing(Experiment, self.experiment_ids,
+                            {name: self.get_experiment(name) for _, name, _, _ in parsed_items if name})
+        self.create_missing(Award, self.award_ids,
+                            {award['name']: Award(**award) for _, _, award, _ in parsed_items if award})
+        self.create_missing(Lab, self.lab_ids,
+                            {name: Lab(name=name) for _, _, _, name in parsed_items if name})
+        new_items, changed_items = {}, {}
+        for item, experiment_name, award, lab_name in parsed_items:
+            item['experiment_id'] = self.experiment_ids[experiment_name] if experiment_name else None
+            item['award_id'] = self.award_ids[award['name']] if award else None
+            item['lab_id'] = self.lab_ids[lab_name] if lab_name else None
+            values_hash = hash(tuple(item[field] for field in ITEM_UPDATE_FIELDS))
+            existing = self.items.get(item['s3_key'])
+            if existing is None:
+                new_items[item['s3_key']] = Item(**item)
+            elif existing[0] is not None and existing[1] != values_hash:
+                changed_items[item['s3_key']] = Item(id=existing[0], **item)
+            self.items[item['s3_key']] = (existing[0] if existing else None, values_hash)
+        if new_items:
+            Item.objects.bulk_create(new_items.values(), ignore_conflicts=True)
+            self.created_count += len(new_items)
+        if changed_items:
+            Item.objects.bulk_update(changed_items.values(), ITEM_UPDATE_FIELDS, batch_size=self.batch_size)
+            self.updated_count += len(changed_items)
+
+    def update_experiments(self):
+        """
+        Update experiments in the database that the search returned different values for.
+        Experiments that are not in the database yet are only created once an item references them.
+        Experiments that were created without their fields are requested again, so they are repaired.
+        """
+        self.add_experiment_results(Experiment.objects.filter(
+            Q(assay_title__isnull=True) | Q(assay_term_name__isnull=True)).values_list('name', flat=True))
+        names = list(self.experiment_result_dict)
+        changed_experiments = []
+        for start in range(0, len(names), self.batch_size):
+            for experiment in Experiment.objects.filter(name__in=names[start:start + self.batch_size]):
+                new_experiment = self.get_experiment(experiment.name)
+                if any(getattr(experiment, field) != getattr(new_experiment, field)
+                       for field in EXPERIMENT_UPDATE_FIELDS):
+                    new_experiment.id = experiment.id
+                    changed_experiments.append(new_experiment)
+        if changed_experiments:
+            Experiment.objects.bulk_update(changed_experiments, EXPERIMENT_UPDATE_FIELDS, batch_size=self.batch_size)
+        print(f'Updated {len(changed_experiments)} experiments')
+
+    def load(self, items_result):
+        """
+        :param items_result: Iterable of file JSON from the ENCODE search
+        """
+        self.update_experiments()
+        batch = []
+        for item_json in tqdm(items_result):
+            parsed_item = parse_item(item_json)
+            if parsed_item:
+                batch.append(parsed_item)
+            if len(batch) >= self.batch_size:
+                self.load_batch(batch)
+                batch = []
+        if batch:
+            self.load_batch(batch)
+        print(f'Created {self.created_count} items and updated {self.updated_count}')
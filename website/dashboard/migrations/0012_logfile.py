@@ -0,0 +1,24 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0011_auto_20190802_0709'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.TextField(max_length=64, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('row_count', models.PositiveIntegerField(default=0)),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Loaded'), (2, 'Failed')], db_index=True, default=0)),
+                ('time_updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
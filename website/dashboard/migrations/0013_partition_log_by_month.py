@@ -0,0 +1,88 @@
+from django.db import migrations, models
+
+# Logs are moved into a table that is partitioned by month on time, so ranged queries only scan the months they cover.
+# Postgres can not turn an existing table into a partitioned one, so the old table is renamed and copied over.
+# Indexes and foreign keys are recreated on the new table with the same names, which propagates them to every month.
+PARTITION_LOG_SQL = '''
+ALTER TABLE dashboard_log RENAME TO dashboard_log_unpartitioned;
+CREATE TABLE dashboard_log (LIKE dashboard_log_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+    PARTITION BY RANGE (time);
+-- Every primary key and unique index of a partitioned table has to include the partition key
+ALTER TABLE dashboard_log ALTER COLUMN time SET NOT NULL;
+ALTER SEQUENCE dashboard_log_id_seq OWNED BY dashboard_log.id;
+-- Catches logs for months that do not have a partition yet, they are moved out once one is created
+CREATE TABLE dashboard_log_default PARTITION OF dashboard_log DEFAULT;
+DO $$
+DECLARE
+    -- Months are worked out in UTC no matter what time zone the session uses
+    month timestamp;
+BEGIN
+    FOR month IN SELECT generate_series(date_trunc('month', MIN(time) AT TIME ZONE 'UTC'), MAX(time) AT TIME ZONE 'UTC',
+                                        '1 month')
+                 FROM dashboard_log_unpartitioned LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF dashboard_log FOR VALUES FROM (%L) TO (%L)',
+                       'dashboard_log_' || to_char(month, '"y"YYYY"m"MM'),
+                       month AT TIME ZONE 'UTC', (month + interval '1 month') AT TIME ZONE 'UTC');
+    END LOOP;
+END $$;
+INSERT INTO dashboard_log SELECT * FROM dashboard_log_unpartitioned WHERE time IS NOT NULL;
+-- Logs without a time fit in no partition, they are kept aside instead of being dropped with the old table
+DO $$
+BEGIN
+    IF EXISTS (SELECT FROM dashboard_log_unpartitioned WHERE time IS NULL) THEN
+        CREATE TABLE dashboard_log_without_time AS SELECT * FROM dashboard_log_unpartitioned WHERE time IS NULL;
+    END IF;
+END $$;
+CREATE TEMPORARY TABLE dashboard_log_definitions ON COMMIT DROP AS
+    SELECT format('CREATE INDEX %I ON dashboard_log %s', index_class.relname,
+                  substring(pg_get_indexdef(index_class.oid) FROM ' USING .*')) AS definition
+    FROM pg_index
+             JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+    WHERE pg_index.indrelid = 'dashboard_log_unpartitioned'::regclass AND NOT pg_index.indisprimary
+    UNION ALL
+    SELECT format('ALTER TABLE dashboard_log ADD CONSTRAINT %I %s', conname, pg_get_constraintdef(oid))
+    FROM pg_constraint
+    WHERE conrelid = 'dashboard_log_unpartitioned'::regclass AND contype = 'f';
+DROP TABLE dashboard_log_unpartitioned;
+ALTER TABLE dashboard_log ADD CONSTRAINT dashboard_log_pkey PRIMARY KEY (id, time);
+DO $$
+DECLARE
+    definition text;
+BEGIN
+    FOR definition IN SELECT * FROM dashboard_log_definitions LOOP
+        EXECUTE definition;
+    END LOOP;
+END $$;
+ANALYZE dashboard_log;
+'''
+
+
+def report_logs_without_time(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM dashboard_log WHERE time IS NULL')
+        count, = cursor.fetchone()
+    if count:
+        print(f'\nKeeping {count} logs without a time in dashboard_log_without_time, they fit in no partition')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0012_logfile'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(report_logs_without_time),
+                migrations.RunSQL(PARTITION_LOG_SQL),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='log',
+                    name='time',
+                    field=models.DateTimeField(db_index=True),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0013_partition_log_by_month'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncMarker',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField(max_length=32, unique=True)),
+                ('time', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,167 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Log columns with the lookup tables their distinct values are moved into
+VALUE_TABLES = {
+    'bucket': 'dashboard_bucket',
+    'requester': 'dashboard_requester',
+    'operation': 'dashboard_operation',
+    's3_key': 'dashboard_s3key',
+    'error_code': 'dashboard_errorcode',
+    'referrer': 'dashboard_referrer',
+    'user_agent': 'dashboard_useragent',
+}
+# Sent by clients and can be longer than a btree index entry, so these are unique on the md5 hash of the value
+HASHED_COLUMNS = ['referrer', 'user_agent']
+# Only these are filtered on by the dashboard, the old text indexes on the others were never used
+INDEXED_COLUMNS = ['requester', 's3_key']
+
+# Every log is rewritten once to set all of the ids in the same pass, instead of once per column.
+# Dropping the text columns does not give back the space, the next migration rewrites the table for that.
+ENCODE_LOG_VALUES_SQL = ''.join(
+    f'CREATE UNIQUE INDEX {VALUE_TABLES[column]}_value_md5 ON {VALUE_TABLES[column]} (md5(value));\n'
+    for column in HASHED_COLUMNS
+) + ''.join(
+    f'INSERT INTO {table} (value) SELECT DISTINCT {column} FROM dashboard_log WHERE {column} IS NOT NULL;\n'
+    for column, table in VALUE_TABLES.items()
+) + ''.join(
+    f'ANALYZE {table};\n' for table in VALUE_TABLES.values()
+) + 'ALTER TABLE dashboard_log {};\n'.format(', '.join(
+    f'ADD COLUMN {column}_id integer' for column in VALUE_TABLES
+)) + 'UPDATE dashboard_log log SET {};\n'.format(', '.join(
+    f'{column}_id = (SELECT id FROM {table} WHERE md5(value) = md5(log.{column}) AND value = log.{column})'
+    if column in HASHED_COLUMNS else f'{column}_id = (SELECT id FROM {table} WHERE value = log.{column})'
+    for column, table in VALUE_TABLES.items()
+)) + 'ALTER TABLE dashboard_log {};\n'.format(', '.join(
+    f'DROP COLUMN {column}' for column in VALUE_TABLES
+)) + ''.join(
+    f'ALTER TABLE dashboard_log ADD CONSTRAINT dashboard_log_{column}_id_fk_{table}_id FOREIGN KEY ({column}_id) '
+    f'REFERENCES {table} (id) DEFERRABLE INITIALLY DEFERRED;\n'
+    for column, table in VALUE_TABLES.items()
+) + ''.join(
+    f'CREATE INDEX dashboard_log_{column}_id ON dashboard_log ({column}_id);\n' for column in INDEXED_COLUMNS
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0014_syncmarker'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Bucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.TextField(unique=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ErrorCode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.TextField(unique=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Operation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.TextField(unique=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Referrer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.TextField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Requester',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.TextField(unique=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='S3Key',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.TextField(unique=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.TextField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(ENCODE_LOG_VALUES_SQL),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='log',
+                    name='bucket',
+                    field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='dashboard.bucket'),
+                ),
+                migrations.AlterField(
+                    model_name='log',
+                    name='error_code',
+                    field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='dashboard.errorcode'),
+                ),
+                migrations.AlterField(
+                    model_name='log',
+                    name='operation',
+                    field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='dashboard.operation'),
+                ),
+                migrations.AlterField(
+                    model_name='log',
+                    name='referrer',
+                    field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='dashboard.referrer'),
+                ),
+                migrations.AlterField(
+                    model_name='log',
+                    name='requester',
+                    field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='dashboard.requester'),
+                ),
+                migrations.AlterField(
+                    model_name='log',
+                    name='s3_key',
+                    field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='dashboard.s3key'),
+                ),
+                migrations.AlterField(
+                    model_name='log',
+                    name='user_agent',
+                    field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='dashboard.useragent'),
+                ),
+            ],
+        ),
+    ]
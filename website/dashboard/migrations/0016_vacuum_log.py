@@ -0,0 +1,16 @@
+from django.db import migrations
+
+# Dropped columns keep taking up space until the table is rewritten, which VACUUM FULL does for every partition.
+# It can not run inside of a transaction, so this migration is not atomic.
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('dashboard', '0015_encode_log_values'),
+    ]
+
+    operations = [
+        migrations.RunSQL('VACUUM FULL ANALYZE dashboard_log'),
+    ]
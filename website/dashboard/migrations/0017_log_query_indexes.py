@@ -0,0 +1,47 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:24
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0016_vacuum_log'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='log',
+            name='http_status',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='log',
+            name='object_size',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='log',
+            name='request_id',
+            field=models.TextField(max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='log',
+            name='requester_type',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='log',
+            name='time',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddIndex(
+            model_name='log',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['time'], name='log_time_brin'),
+        ),
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(condition=models.Q(('http_status', 200), models.Q(_negated=True, requester_type=1)), fields=['time', 's3_key', 'ip_address', 'item', 'requester', 'object_size'], name='log_download_covering'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0017_log_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyDownload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('ip_address', models.GenericIPAddressField(db_index=True, null=True)),
+                ('downloads', models.PositiveIntegerField()),
+                ('item', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='dashboard.item')),
+                ('requester', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='dashboard.requester')),
+                ('s3_key', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='dashboard.s3key')),
+            ],
+        ),
+        # The ingest upserts into the rollup on this index. Unique constraints do not work with nullable columns.
+        # Any address can be in a log, so whether it is missing is part of the key instead of a placeholder address.
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX dashboard_dailydownload_unique ON dashboard_dailydownload "
+            "(day, s3_key_id, (ip_address IS NULL), COALESCE(ip_address, '0.0.0.0'), COALESCE(requester_id, 0))",
+            'DROP INDEX dashboard_dailydownload_unique',
+        ),
+    ]
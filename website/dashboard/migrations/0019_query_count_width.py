@@ -0,0 +1,29 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0018_dailydownload'),
+    ]
+
+    operations = [
+        # Old readings are counts of overlapping four day windows, not buckets. update_times computes them again.
+        migrations.RunSQL('DELETE FROM dashboard_querycountattime', migrations.RunSQL.noop),
+        migrations.AddField(
+            model_name='querycountattime',
+            name='width',
+            field=models.TextField(choices=[('hour', 'Hour'), ('day', 'Day'), ('week', 'Week')], default='day', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='syncmarker',
+            name='value',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='querycountattime',
+            constraint=models.UniqueConstraint(fields=('data_set', 'width', 'time'), name='query_count_unique_bucket'),
+        ),
+    ]
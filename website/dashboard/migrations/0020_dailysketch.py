@@ -0,0 +1,27 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0019_query_count_width'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySketch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('dimension', models.TextField(max_length=32)),
+                ('cohort', models.TextField(max_length=16)),
+                ('registers', models.BinaryField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailysketch',
+            constraint=models.UniqueConstraint(fields=('day', 'dimension', 'cohort'), name='daily_sketch_unique'),
+        ),
+    ]
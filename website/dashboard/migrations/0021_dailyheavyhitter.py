@@ -0,0 +1,27 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0020_dailysketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyHeavyHitter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('dimension', models.TextField(max_length=32)),
+                ('cohort', models.TextField(max_length=16)),
+                ('counters', models.JSONField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailyheavyhitter',
+            constraint=models.UniqueConstraint(fields=('day', 'dimension', 'cohort'), name='daily_heavy_hitter_unique'),
+        ),
+    ]
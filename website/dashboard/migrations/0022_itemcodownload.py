@@ -0,0 +1,27 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0021_dailyheavyhitter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemCoDownload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField()),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='co_downloads', to='dashboard.item')),
+                ('other_item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='dashboard.item')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='itemcodownload',
+            constraint=models.UniqueConstraint(fields=('item', 'other_item'), name='item_co_download_unique'),
+        ),
+    ]
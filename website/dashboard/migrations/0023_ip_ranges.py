@@ -0,0 +1,44 @@
+# Generated by Django 3.1.12 on 2026-10-18 13:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0022_itemcodownload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IpIspRange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_ip', models.GenericIPAddressField(db_index=True)),
+                ('end_ip', models.GenericIPAddressField()),
+                ('isp', models.TextField(max_length=64)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IpLocationRange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_ip', models.GenericIPAddressField(db_index=True)),
+                ('end_ip', models.GenericIPAddressField()),
+                ('country', models.TextField(max_length=32)),
+                ('city', models.TextField(max_length=32)),
+                ('latitude', models.DecimalField(decimal_places=6, max_digits=9, null=True)),
+                ('longitude', models.DecimalField(decimal_places=6, max_digits=9, null=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='ipaddress',
+            name='latitude',
+            field=models.DecimalField(decimal_places=6, max_digits=9, null=True),
+        ),
+        migrations.AlterField(
+            model_name='ipaddress',
+            name='longitude',
+            field=models.DecimalField(decimal_places=6, max_digits=9, null=True),
+        ),
+    ]
@@ -11,19 +11,59 @@ class IpAddress(models.Model):
     isp = models.TextField(max_length=64)
     country = models.TextField(max_length=32)
     city = models.TextField(max_length=32)
-    latitude = models.DecimalField(decimal_places=6, max_digits=9)
-    longitude = models.DecimalField(decimal_places=6, max_digits=9)
+    latitude = models.DecimalField(decimal_places=6, max_digits=9, null=True)
+    longitude = models.DecimalField(decimal_places=6, max_digits=9, null=True)
+
+
+class IpLocationRange(models.Model):
+    """
+    Where the IP addresses from the start to the end of a range are, loaded from a range database,
+    see dashboard/geoip.py. Ranges do not overlap, so the range of an address is the last one that starts before it.
+    """
+    start_ip = models.GenericIPAddressField(db_index=True)
+    end_ip = models.GenericIPAddressField()
+    country = models.TextField(max_length=32)
+    city = models.TextField(max_length=32)
+    latitude = models.DecimalField(decimal_places=6, max_digits=9, null=True)
+    longitude = models.DecimalField(decimal_places=6, max_digits=9, null=True)
+
+
+class IpIspRange(models.Model):
+    """
+    Which ISP the IP addresses from the start to the end of a range belong to, see dashboard/geoip.py.
+    """
+    start_ip = models.GenericIPAddressField(db_index=True)
+    end_ip = models.GenericIPAddressField()
+    isp = models.TextField(max_length=64)
 
 
 class QueryCountAtTime(models.Model):
     """
-    How many queries to the server were present in a interval centered around a time.
-    This creates sort of a midpoint approximation of requests over time.
+    How many queries to the server there were in a bucket of time, starting at the time and as long as the width.
+    This makes a histogram of requests over time.
     """
+    WIDTH_HOUR = 'hour'
+    WIDTH_DAY = 'day'
+    WIDTH_WEEK = 'week'
+
     data_set = models.TextField(max_length=16)
+    width = models.TextField(
+        max_length=8,
+        default=WIDTH_DAY,
+        choices=[
+            (WIDTH_HOUR, 'Hour'),
+            (WIDTH_DAY, 'Day'),
+            (WIDTH_WEEK, 'Week')
+        ]
+    )
     time = models.DateTimeField(db_index=True)
     count = models.PositiveIntegerField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['data_set', 'width', 'time'], name='query_count_unique_bucket'),
+        ]
+
 
 class Lab(models.Model):
     name = models.TextField(max_length=16, unique=True)
@@ -64,6 +104,56 @@ class Item(models.Model):
     date_uploaded = models.DateField(null=True)
 
 
+class LogValue(models.Model):
+    """
+    A distinct value of one of the repetitive text columns of logs.
+    There are only a few thousand of each across millions of logs, so logs store the id of the value instead.
+    """
+    value = models.TextField(unique=True)
+
+    class Meta:
+        abstract = True
+
+
+class Bucket(LogValue):
+    pass
+
+
+class Requester(LogValue):
+    pass
+
+
+class Operation(LogValue):
+    pass
+
+
+class S3Key(LogValue):
+    pass
+
+
+class ErrorCode(LogValue):
+    pass
+
+
+class ClientLogValue(LogValue):
+    """
+    A value that is sent by clients, which can be longer than a btree index entry may be.
+    These are unique on the md5 hash of the value instead, see migration 0015, and are looked up by it.
+    """
+    value = models.TextField()
+
+    class Meta:
+        abstract = True
+
+
+class Referrer(ClientLogValue):
+    pass
+
+
+class UserAgent(ClientLogValue):
+    pass
+
+
 class Log(models.Model):
     """
     A raw log line. There can be multiple logs per file, so this represents those individual ones.
@@ -71,32 +161,45 @@ class Log(models.Model):
     """
     REQUESTER_DEFAULT = 0
     REQUESTER_ENCODED_INSTANCE = 1
+    # Foreign keys to LogValue tables, the text is at <field>__value
+    VALUE_FIELDS = ('bucket', 'requester', 'operation', 's3_key', 'error_code', 'referrer', 'user_agent')
 
     # Can be null since some requests have an invalid s3 key and thus no actual backing item
     item = models.ForeignKey(Item, null=True, on_delete=models.PROTECT)
-    bucket = models.TextField(max_length=16, null=True)
+    bucket = models.ForeignKey(Bucket, null=True, on_delete=models.PROTECT, db_index=False)
     # Time at which this log was created
-    time = models.DateTimeField(null=True, db_index=True)
+    time = models.DateTimeField()
     ip_address = models.GenericIPAddressField(null=True, db_index=True)
-    requester = models.TextField(max_length=64, null=True, db_index=True)
+    requester = models.ForeignKey(Requester, null=True, on_delete=models.PROTECT)
     # Easily have the ability to filter out encoded instances without having to use a string contains search
-    requester_type = models.PositiveSmallIntegerField(db_index=True)
-    request_id = models.TextField(max_length=16, db_index=True)
-    operation = models.TextField(max_length=16, null=True)
-    s3_key = models.TextField(max_length=64, null=True, db_index=True)
+    requester_type = models.PositiveSmallIntegerField()
+    request_id = models.TextField(max_length=16)
+    operation = models.ForeignKey(Operation, null=True, on_delete=models.PROTECT, db_index=False)
+    s3_key = models.ForeignKey(S3Key, null=True, on_delete=models.PROTECT)
     request_uri = models.TextField(max_length=1024, null=True)
     # 200 represents a full download, 206 is partial and most likely from a browser/visualizer
-    http_status = models.PositiveSmallIntegerField(null=True, db_index=True)
+    http_status = models.PositiveSmallIntegerField(null=True)
     # If non-None, provides information about why the request was denied
-    error_code = models.TextField(max_length=16, null=True, db_index=True)
+    error_code = models.ForeignKey(ErrorCode, null=True, on_delete=models.PROTECT, db_index=False)
     bytes_sent = models.BigIntegerField(null=True)
-    object_size = models.BigIntegerField(null=True, db_index=True)
+    object_size = models.BigIntegerField(null=True)
     total_time = models.PositiveIntegerField(null=True)
     turn_around_time = models.PositiveIntegerField(null=True)
-    referrer = models.TextField(null=True)
-    user_agent = models.TextField(max_length=128, null=True)
+    referrer = models.ForeignKey(Referrer, null=True, on_delete=models.PROTECT, db_index=False)
+    user_agent = models.ForeignKey(UserAgent, null=True, on_delete=models.PROTECT, db_index=False)
     version_id = models.TextField(max_length=128, null=True)
 
+    class Meta:
+        indexes = [
+            # Logs are appended in time order, so a tiny BRIN index is enough to find the pages of a time range
+            BrinIndex(fields=['time'], name='log_time_brin'),
+            # Every dashboard aggregate is over valid downloads in a time range grouped by key or IP address.
+            # All columns they read are in here, so they are answered from the index alone.
+            models.Index(fields=['time', 's3_key', 'ip_address', 'item', 'requester', 'object_size'],
+                         condition=models.Q(http_status=200) & ~models.Q(requester_type=1),
+                         name='log_download_covering'),
+        ]
+
     # Fields that are in log but we do not care about past here
 
     # host_id = models.TextField(max_length=1024)
@@ -135,6 +238,106 @@ class Log(models.Model):
     # )
 
 
+class DailyDownload(models.Model):
+    """
+    Rollup of valid downloads, how many times an IP address and requester downloaded a key on a day.
+    Kept up to date by the ingest, see dashboard/rollups.py. Queries over whole days read this instead of logs.
+    A unique index on the day, key, IP address and requester is created in the migration, since two are nullable.
+    """
+    day = models.DateField()
+    s3_key = models.ForeignKey(S3Key, on_delete=models.PROTECT)
+    item = models.ForeignKey(Item, null=True, on_delete=models.PROTECT)
+    ip_address = models.GenericIPAddressField(null=True, db_index=True)
+    requester = models.ForeignKey(Requester, null=True, on_delete=models.PROTECT)
+    downloads = models.PositiveIntegerField()
+
+
+class DailySketch(models.Model):
+    """
+    HyperLogLog sketch of the distinct values of a dimension of valid downloads on a day, see dashboard/sketches.py.
+    Sketches of several days are merged to estimate distinct counts over a range without going through the logs.
+    """
+    day = models.DateField()
+    # Which stat the sketch estimates, like unique_ips
+    dimension = models.TextField(max_length=32)
+    # Downloads that were counted, all of them or only those of an experiment
+    cohort = models.TextField(max_length=16)
+    registers = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'dimension', 'cohort'], name='daily_sketch_unique'),
+        ]
+
+
+class DailyHeavyHitter(models.Model):
+    """
+    Space-Saving summary of the keys with the highest counts of a dimension of valid downloads on a day,
+    see dashboard/heavy_hitters.py. Summaries of several days are merged to find the top items and IP addresses.
+    """
+    day = models.DateField()
+    # What is ranked, items or ip_addresses
+    dimension = models.TextField(max_length=32)
+    cohort = models.TextField(max_length=16)
+    # Maps keys to their count and how much the count may be too high by
+    counters = models.JSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'dimension', 'cohort'], name='daily_heavy_hitter_unique'),
+        ]
+
+
+class ItemCoDownload(models.Model):
+    """
+    How many IP addresses downloaded both an item and another one, see dashboard/co_downloads.py.
+    Only the other items that were downloaded together with the item the most are kept.
+    """
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='co_downloads')
+    other_item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['item', 'other_item'], name='item_co_download_unique'),
+        ]
+
+
+class LogFile(models.Model):
+    """
+    Ledger of the log files that were loaded into the Log table, one row per object in the bucket.
+    A file is marked as loaded in the same transaction as its logs, so it is never loaded twice after a crash.
+    """
+    STATUS_PENDING = 0
+    STATUS_LOADED = 1
+    STATUS_FAILED = 2
+
+    key = models.TextField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    # How many logs were loaded from this file, most lines in a file are not downloads
+    row_count = models.PositiveIntegerField(default=0)
+    status = models.PositiveSmallIntegerField(
+        default=STATUS_PENDING,
+        choices=[
+            (STATUS_PENDING, 'Pending'),
+            (STATUS_LOADED, 'Loaded'),
+            (STATUS_FAILED, 'Failed')
+        ],
+        db_index=True
+    )
+    time_updated = models.DateTimeField(auto_now=True)
+
+
+class SyncMarker(models.Model):
+    """
+    High-water mark of a kind of sync, so that the next run only has to look at what changed after it.
+    """
+    name = models.TextField(max_length=32, unique=True)
+    time = models.DateTimeField()
+    # For marks that are not a time, like the highest id that was processed
+    value = models.BigIntegerField(null=True)
+
+
 class AnalysisLabItem(models.Model):
     data_set = models.TextField(max_length=16)
     name = models.TextField(max_length=16, unique=True)
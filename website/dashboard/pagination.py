@@ -0,0 +1,163 @@
+"""
+Pagination of the ranked tables. Rankings are ordered by count and then by the fields of their key, so the page after a
+row is the rows that come after its count and key, taken with a keyset predicate and a LIMIT. Deep pages cost the same
+as the first one instead of an OFFSET that counts and throws away every row before. Rankings can also be
+materialized once per range and version of the data as the list of the count and key of every row, then every page
+after the first is a slice of that list whose rows are looked up by their keys instead of grouping every log again.
+Pages can be asked for by number or by an opaque cursor that holds the last row of the page before.
+"""
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from dashboard.caching import get_versioned_cache_key
+
+# Name of the annotation that rankings are ordered by, highest first
+COUNT_FIELD = 'count'
+RANKING_CACHE_PREFIX = 'ranking'
+
+
+def get_row_key(row, key_fields):
+    """
+    :param row: Row of a ranking, which starts with the values of the key fields and ends with its count
+    :return: Count of the row and the list of the values of its key, which is what cursors hold
+    """
+    return row[-1], list(row[:len(key_fields)])
+
+
+def encode_cursor(offset, count, key):
+    """
+    :param offset: Position in the ranking right after the row, only used to number the rows of the next page
+    """
+    return urlsafe_b64encode(json.dumps([offset, count, key]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :return: Tuple of the offset, count and key in the cursor
+    :raises ValueError: If the cursor was not made by encode_cursor
+    """
+    try:
+        offset, count, key = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError) as error:
+        raise ValueError(f'Invalid cursor {cursor}') from error
+    if not isinstance(offset, int) or not isinstance(count, int) or not isinstance(key, list):
+        raise ValueError(f'Invalid cursor {cursor}')
+    return offset, count, key
+
+
+def get_after_key_filter(key_fields, key):
+    """
+    Key fields are in ascending order with nulls last, like Postgres orders them.
+    :return: Filter of the rows whose key comes after the given one among rows with the same count,
+             None if no key can
+    """
+    if not key_fields:
+        return None
+    field, value = key_fields[0], key[0]
+    rest_filter = get_after_key_filter(key_fields[1:], key[1:])
+    if value is None:
+        # Nothing comes after null, only the rest of the key can
+        return None if rest_filter is None else Q(**{f'{field}__isnull': True}) & rest_filter
+    after_filter = Q(**{f'{field}__gt': value}) | Q(**{f'{field}__isnull': True})
+    if rest_filter is not None:
+        after_filter |= Q(**{field: value}) & rest_filter
+    return after_filter
+
+
+def get_after_filter(key_fields, count, key):
+    """
+    :return: Filter of the rows of a ranking that come after the row with the given count and key,
+             which is applied to the aggregate so it becomes part of the HAVING clause
+    :raises ValueError: If the key does not have a value for every key field
+    """
+    if len(key) != len(key_fields):
+        raise ValueError(f'Invalid key {key}')
+    after_filter = Q(**{f'{COUNT_FIELD}__lt': count})
+    after_key_filter = get_after_key_filter(key_fields, key)
+    if after_key_filter is not None:
+        after_filter |= Q(**{COUNT_FIELD: count}) & after_key_filter
+    return after_filter
+
+
+def get_ranking(ranked, key_fields):
+    """
+    The ranking is cached under its SQL, which holds its range and filters, for the current version of the data.
+    :param ranked: Ordered query set of every row of the table, see get_page
+    :return: List of the count and key of every row of the ranking in order
+    """
+    keys = ranked.values_list(*key_fields, COUNT_FIELD)
+    sql, params = keys.query.sql_with_params()
+    cache_key = get_versioned_cache_key(RANKING_CACHE_PREFIX, f'{sql} {params}')
+    ranking = cache.get(cache_key)
+    if ranking is None:
+        ranking = [get_row_key(row, key_fields) for row in keys]
+        cache.set(cache_key, ranking, settings.DATA_CACHE_TIME)
+    return ranking
+
+
+def get_key_filter(key_fields, key):
+    """
+    :return: Filter of the row with the given key, which is applied before the aggregate so only its logs are grouped
+    """
+    key_filter = Q()
+    for field, value in zip(key_fields, key):
+        key_filter &= Q(**{f'{field}__isnull': True}) if value is None else Q(**{field: value})
+    return key_filter
+
+
+def get_rows_for_keys(ranked, key_fields, keys):
+    """
+    :return: Rows of the ranking with the given keys, in the order of the keys
+    """
+    if not keys:
+        return []
+    rows = {tuple(row[:len(key_fields)]): row
+            for row in ranked.filter(reduce(or_, (get_key_filter(key_fields, key) for key in keys)))}
+    # A key is only missing if the data changed without bumping its version
+    return [rows[tuple(key)] for key in keys if tuple(key) in rows]
+
+
+def get_page(ranked, key_fields, page_size, page=0, cursor=None, get_top=None, cache_ranking=False):
+    """
+    :param ranked: Query set of every row of the table, the values of the key fields come first in every row
+                   and the count last. Keys have to be unique, it is ordered by count and then by them.
+    :param key_fields: Fields that tell rows with the same count apart, in the order they are sorted by
+    :param cursor: Cursor from the page before, used instead of the page number if given
+    :param get_top: Function that returns the rows of a page by size and number without going through every row,
+                    or None if it can not. Only used for numbered pages.
+    :param cache_ranking: Whether to take the page from the ranking cached by get_ranking. Cursors that do not point
+                          into it, because they are from another version of the data, fall back to a keyset query.
+    :return: Tuple of the rows of the page without their key, the position of the first one and
+             the cursor of the next page, which is None on the last page
+    :raises ValueError: If the cursor is invalid
+    """
+    ranked = ranked.order_by(f'-{COUNT_FIELD}', *key_fields)
+    rows = None
+    if cursor is None and get_top is not None:
+        rows = get_top(page_size, page)
+    if rows is not None:
+        rows, offset = list(rows), page * page_size
+        has_next = len(rows) == page_size
+    else:
+        # One more row than the page tells if there is a next one
+        if cursor:
+            offset, count, key = decode_cursor(cursor)
+        else:
+            offset = page * page_size
+        ranking = get_ranking(ranked, key_fields) if cache_ranking else None
+        if ranking is not None and (not cursor or 0 < offset <= len(ranking) and ranking[offset - 1] == (count, key)):
+            rows = get_rows_for_keys(ranked, key_fields, [key for _, key in ranking[offset:offset + page_size + 1]])
+        elif cursor:
+            rows = list(ranked.filter(get_after_filter(key_fields, count, key))[:page_size + 1])
+        else:
+            rows = list(ranked[offset:offset + page_size + 1])
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+    next_cursor = encode_cursor(offset + len(rows), *get_row_key(rows[-1], key_fields)) if has_next else None
+    return [row[len(key_fields):] for row in rows], offset, next_cursor
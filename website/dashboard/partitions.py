@@ -0,0 +1,81 @@
+"""
+The log table is partitioned by month on time, see the 0013 migration.
+Partitions are created here whenever logs for a new month are about to be loaded.
+"""
+from datetime import datetime, timezone
+
+from django.db import connection, transaction
+
+from dashboard.models import Log
+
+LOG_TABLE = Log._meta.db_table
+DEFAULT_PARTITION = f'{LOG_TABLE}_default'
+# Any number works, it just has to be the same for every process that creates partitions
+PARTITION_LOCK_ID = 7140
+
+# Months that are known to have a partition in this process, saves a query for every batch
+_known_months = set()
+
+
+def get_month(time):
+    return datetime(time.year, time.month, 1, tzinfo=timezone.utc)
+
+
+def get_next_month(month):
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+
+def get_partition_name(month):
+    return f'{LOG_TABLE}_{month:y%Ym%m}'
+
+
+def get_partition_month(name):
+    """
+    :return: Month of a partition by its name, see get_partition_name
+    """
+    return datetime.strptime(name, f'{LOG_TABLE}_y%Ym%m').replace(tzinfo=timezone.utc)
+
+
+def iter_months(start_time, end_time):
+    month = get_month(start_time)
+    while month <= end_time:
+        yield month
+        month = get_next_month(month)
+
+
+def get_partition_names():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass', [LOG_TABLE])
+        return {name for name, in cursor.fetchall()}
+
+
+def create_partition(cursor, month):
+    """
+    Create the partition for a month. Logs that were put in the default partition because there was no
+    partition for their month yet are moved into the new one, otherwise Postgres would refuse to attach it.
+    """
+    name, next_month = get_partition_name(month), get_next_month(month)
+    print(f'Creating log partition {name}')
+    cursor.execute(f'CREATE TABLE {name} (LIKE {LOG_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    cursor.execute(f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE time >= %s AND time < %s RETURNING *) '
+                   f'INSERT INTO {name} SELECT * FROM moved', [month, next_month])
+    cursor.execute(f'ALTER TABLE {LOG_TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)',
+                   [month, next_month])
+
+
+def ensure_log_partitions(months):
+    """
+    Make sure that every given month has a partition, creating the ones that are missing.
+    This runs in its own short transaction so that loading logs never waits on the locks it takes.
+    """
+    missing = set(months) - _known_months
+    if not missing:
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Only one process at a time, several workers can run into the same new month at once
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [PARTITION_LOCK_ID])
+        existing = get_partition_names()
+        for month in sorted(missing):
+            if get_partition_name(month) not in existing:
+                create_partition(cursor, month)
+    _known_months.update(missing)
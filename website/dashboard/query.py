@@ -1,24 +1,83 @@
 from datetime import timedelta, datetime
+from ipaddress import IPv4Address, ip_address as parse_ip_address
+from itertools import islice
 
 import pandas as pd
-import requests
-from django.db.models import Count, Avg
+from django.db import connection, models
+from django.db.models import Count, Sum, Max, Q, F, Window
+from django.db.models.functions import Trunc, RowNumber
 from django.utils import timezone
-
-from dashboard.models import Log, QueryCountAtTime, get_item_name, AnalysisLabItem, IpAddress, Item
+from psycopg2.extras import execute_values
+
+from dashboard.columnar import get_log_columns
+from dashboard.geoip import look_up_ip_address
+from dashboard.models import Log, QueryCountAtTime, get_item_name, AnalysisLabItem, IpAddress, Item, DailyDownload, \
+    Requester, ItemCoDownload, LogValue
+from dashboard.rollups import ROLLUP_FIELDS, is_rollup_ready, get_day_range
+from dashboard.heavy_hitters import DIMENSION_ITEMS, DIMENSION_IP_ADDRESSES, get_top_candidates, \
+    is_heavy_hitters_ready
+from dashboard.sketches import COHORT_ALL, COHORT_BERNSTEIN, DIMENSION_VALUES, RELATIVE_ERROR, estimate_distinct, \
+    is_sketches_ready
 from activity_viewer.util import time_this
 
 START_TIME = datetime(2019, 3, 1, tzinfo=timezone.get_current_timezone())
 END_TIME = timezone.now()
-INTERVAL_DELTA = timedelta(4)
+HISTOGRAM_WIDTHS = {
+    QueryCountAtTime.WIDTH_HOUR: timedelta(hours=1),
+    QueryCountAtTime.WIDTH_DAY: timedelta(days=1),
+    QueryCountAtTime.WIDTH_WEEK: timedelta(weeks=1),
+}
+BULK_PAGE_SIZE = 5000
+# Rows fetched from a server side cursor and turned into a DataFrame at once
+DATA_FRAME_CHUNK_SIZE = 100000
+# IPv4 addresses as their integer, UInt32 once converted
+IPV4_DTYPE = 'ipv4'
+# Nullable pandas types of integer fields, which are a lot smaller than the Python ints of the rows.
+# Subclasses come before the fields they extend
+INTEGER_DTYPES = {
+    models.PositiveSmallIntegerField: 'UInt16',
+    models.SmallIntegerField: 'Int16',
+    models.PositiveIntegerField: 'UInt32',
+    models.BigIntegerField: 'Int64',
+    models.IntegerField: 'Int32',
+}
+# Rankings down to this rank are taken from the heavy hitter summaries, deeper pages count every key
+HEAVY_HITTER_RANKS = 100
+# How many more candidates than ranks are counted, so that the page is rarely thrown away
+HEAVY_HITTER_CANDIDATE_FACTOR = 2
 
 ENCODE_URL_BASE = 'https://www.encodeproject.org'
 
 # Only valid file downloads
 GET_REQUESTS = Log.objects.filter(http_status=200).exclude(requester_type=1)
-GET_JSON_HEADERS = {'accept': 'application/json'}
 
-BERNSTEIN_EXPERIMENT_FILTER_KWARGS = {'item_name__in': AnalysisLabItem.objects.values_list('name', flat=True)}
+BERNSTEIN_EXPERIMENT_FILTER_KWARGS = {'item__name__in': AnalysisLabItem.objects.values_list('name', flat=True)}
+# Filters that have distinct count sketches and heavy hitter summaries of their own
+SUMMARY_COHORTS = {
+    COHORT_ALL: {},
+    COHORT_BERNSTEIN: BERNSTEIN_EXPERIMENT_FILTER_KWARGS,
+}
+
+UPSERT_QUERY_COUNTS_SQL = f'''
+INSERT INTO {QueryCountAtTime._meta.db_table} (data_set, width, time, count) VALUES %s
+ON CONFLICT (data_set, width, time) DO UPDATE SET count = excluded.count
+'''
+
+
+def get_log_filter(kwargs):
+    """
+    Filters on the text columns of logs are written as if they held their text, for example requester=<arn>.
+    Those columns only hold ids of values in lookup tables, so the filters are moved onto the value.
+    :param kwargs: Django filter of Log items
+    :return: The same filter that works on the lookup tables
+    """
+    log_filter = {}
+    for lookup, value in kwargs.items():
+        field, _, rest = lookup.partition('__')
+        if field in Log.VALUE_FIELDS and rest.split('__')[0] not in ('value', 'id', 'pk', 'isnull'):
+            lookup = f'{field}__value__{rest}' if rest else f'{field}__value'
+        log_filter[lookup] = value
+    return log_filter
 
 
 def get_header(s3_key):
@@ -38,70 +97,263 @@ def get_encode_url_from_s3(s3_key):
 
 def filter_from_time_range(start_time=START_TIME, end_time=END_TIME):
     is_default = start_time is START_TIME and end_time is END_TIME
+    # Logs are partitioned by month on time, filtering on it directly lets Postgres skip every other month
     return GET_REQUESTS if is_default else GET_REQUESTS.filter(time__range=(start_time, end_time))
 
 
+def get_cohort(kwargs):
+    """
+    :return: Name of the cohort that has the same filter, or None if there is none
+    """
+    return next((cohort for cohort, cohort_kwargs in SUMMARY_COHORTS.items() if cohort_kwargs == kwargs), None)
+
+
+def select_log_columns(start_time, end_time, kwargs):
+    """
+    Valid downloads from the in-memory columns, which answer aggregates without going to the database.
+    :return: Selection of the downloads in the range matching the filter, see dashboard/columnar.py,
+             or None if the columns are turned off or do not have the field of the filter
+    """
+    log_columns = get_log_columns()
+    if log_columns is None:
+        return None
+    is_default = start_time is START_TIME and end_time is END_TIME
+    start_time, end_time = (None, None) if is_default else (start_time, end_time)
+    cohort = get_cohort(kwargs)
+    if cohort is not None:
+        return log_columns.select(start_time, end_time, cohort)
+    if None in kwargs.values():
+        return None
+    if kwargs.keys() == {'requester'}:
+        requester_id = Requester.objects.filter(value=kwargs['requester']).values_list('id', flat=True).first()
+        # Ids start at one, so no download has the one of a requester that does not exist
+        return log_columns.select(start_time, end_time, requester_id=requester_id or -1)
+    if kwargs.keys() == {'ip_address'}:
+        return log_columns.select(start_time, end_time, ip_address=kwargs['ip_address'])
+    return None
+
+
+def get_daily_downloads(start_time, end_time, kwargs):
+    """
+    Valid downloads of whole days from the daily rollup, which is a lot faster than aggregating the logs.
+    The end time is exclusive here, while the logs include downloads at exactly the end time.
+    :return: Rollup rows in the range matching the filter,
+             or None if the logs have to be used because the range does not line up with days
+             or the filter is on a field that the rollup does not have
+    """
+    if not is_rollup_ready() or any(lookup.split('__')[0] not in ROLLUP_FIELDS for lookup in kwargs):
+        return None
+    day_range = get_day_range(start_time, end_time, start_time is START_TIME and end_time is END_TIME)
+    if day_range is None:
+        return None
+    downloads = DailyDownload.objects.filter(**get_log_filter(kwargs))
+    start_day, end_day = day_range
+    return downloads if start_day is None else downloads.filter(day__gte=start_day, day__lt=end_day)
+
+
+def get_most_queried_items(start_time=START_TIME, end_time=END_TIME, **kwargs):
+    """
+    :return: Query set of every key with an item and its unique downloads, most downloaded first
+    """
+    downloads = get_daily_downloads(start_time, end_time, kwargs)
+    if downloads is None:
+        downloads = filter_from_time_range(start_time, end_time).filter(**get_log_filter(kwargs))
+    # Ties are ordered by key so that every page of the ranking is taken from the same order
+    return (downloads
+            .values_list('s3_key')
+            .filter(item__isnull=False)
+            .annotate(count=Count('ip_address', distinct=True))
+            .order_by('-count', 's3_key'))
+
+
+def get_most_queried_items_from_summaries(amount, start_time=START_TIME, end_time=END_TIME, page=0, **kwargs):
+    return get_top_from_summaries(get_most_queried_items(start_time, end_time, **kwargs), 's3_key', DIMENSION_ITEMS,
+                                  amount, start_time, end_time, page, kwargs)
+
+
 def get_most_queried_items_limited(amount, start_time=START_TIME, end_time=END_TIME, page=0, **kwargs):
-    return take_page(filter_from_time_range(start_time, end_time)
-                     .filter(**kwargs)
-                     .values_list('s3_key')
-                     .filter(item__isnull=False)
-                     .annotate(count=Count('ip_address', distinct=True))
-                     .order_by('-count'), amount, page)
+    top = get_most_queried_items_from_summaries(amount, start_time, end_time, page, **kwargs)
+    return top if top is not None else take_page(get_most_queried_items(start_time, end_time, **kwargs), amount, page)
 
 
 def take_page(query_set, page_size, page):
     return query_set[page_size * page:page_size * (page + 1)]
 
 
-def get_most_active_users_limited(amount, start_time=START_TIME, end_time=END_TIME, page=0, **kwargs):
-    return take_page(filter_from_time_range(start_time, end_time)
-                     .filter(**kwargs)
-                     .exclude(requester_type=Log.REQUESTER_ENCODED_INSTANCE)
-                     .values_list('ip_address')
-                     .annotate(count=Count('ip_address'))
-                     .order_by('-count'), amount, page)
+def get_top_from_summaries(ranked, field, dimension, amount, start_time, end_time, page, kwargs):
+    """
+    Take a page of a ranking, but only count the candidates from the in-memory columns or the heavy hitter summaries.
+    The page is only used if every key outside the candidates has a lower count than the last one on it,
+    a key with the same count could come before it when ties are ordered by key.
+    :param ranked: Query set of keys and their counts in descending order
+    :param field: Field the ranking is grouped by
+    :return: Page of the ranking, or None if it has to be taken from every key
+    """
+    cohort = get_cohort(kwargs)
+    ranks = amount * (page + 1)
+    if cohort is None:
+        return None
+    log_selection = select_log_columns(start_time, end_time, kwargs)
+    if log_selection is not None:
+        # The columns have the exact top, which is still counted again for the rest of the row
+        candidates, other_count = log_selection.get_top_candidates(dimension, ranks)
+    else:
+        if ranks > HEAVY_HITTER_RANKS or not is_heavy_hitters_ready():
+            return None
+        day_range = get_day_range(start_time, end_time, start_time is START_TIME and end_time is END_TIME)
+        if day_range is None:
+            return None
+        candidates, other_count = get_top_candidates(dimension, cohort, ranks * HEAVY_HITTER_CANDIDATE_FACTOR,
+                                                     *day_range)
+    candidate_filter = Q(**{f'{field}__in': [key for key in candidates if key is not None]})
+    if None in candidates:
+        candidate_filter |= Q(**{f'{field}__isnull': True})
+    top = ranked.filter(candidate_filter)
+    counts = [count for *_, count in top[:ranks]]
+    if len(counts) == ranks and counts[-1] > other_count or len(counts) < ranks and other_count == 0:
+        return take_page(top, amount, page)
+    return None
+
+
+def get_most_active_users(start_time=START_TIME, end_time=END_TIME, **kwargs):
+    """
+    :return: Query set of every IP address and requester pair and its downloads, most downloads first
+    """
+    downloads = get_daily_downloads(start_time, end_time, kwargs)
+    # Ties are ordered by the whole pair so that every page of the ranking is taken from the same order
+    if downloads is not None:
+        return (downloads
+                .values_list('ip_address', 'requester')
+                .annotate(count=Sum('downloads'))
+                .order_by('-count', 'ip_address', 'requester'))
+    return (filter_from_time_range(start_time, end_time)
+            .filter(**get_log_filter(kwargs))
+            .exclude(requester_type=Log.REQUESTER_ENCODED_INSTANCE)
+            .values_list('ip_address', 'requester')
+            .annotate(count=Count('ip_address'))
+            .order_by('-count', 'ip_address', 'requester'))
 
 
-def calculate_query_count_intervals(start_time=START_TIME, **kwargs):
-    readings = []
-    logs = Log.objects.filter(**kwargs)
-    time = start_time
-    # Iterate in chunks across database and sum up request count for evenly sized intervals
-    while time < END_TIME:
-        print(f'At time: {time}, end time: {END_TIME}')
-        # Notice we filter data to left and right of the time
-        count = logs.filter(time__range=(time - INTERVAL_DELTA / 2, time + INTERVAL_DELTA / 2)).count()
-        time += INTERVAL_DELTA
-        readings.append((time, count))
-    return readings
+def get_most_active_users_from_summaries(amount, start_time=START_TIME, end_time=END_TIME, page=0, **kwargs):
+    return get_top_from_summaries(get_most_active_users(start_time, end_time, **kwargs), 'ip_address',
+                                  DIMENSION_IP_ADDRESSES, amount, start_time, end_time, page, kwargs)
+
+
+def get_last_log_id():
+    return Log.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+
+
+def calculate_query_counts(width=QueryCountAtTime.WIDTH_DAY, after_log_id=None, **kwargs):
+    """
+    Count requests in buckets of time with a single GROUP BY, no matter how long the history is.
+    :param width: Length of the buckets, hour, day or week
+    :param after_log_id: Only count the buckets that logs with a higher id are in, the others did not change.
+                         All buckets are counted if None.
+    :param kwargs: Passed to Django filter of Log items
+    :return: List of tuples of the start time of each bucket and its count, ordered by time
+    """
+    logs = Log.objects.filter(**get_log_filter(kwargs)).annotate(time_bucket=Trunc('time', width))
+    if after_log_id is not None:
+        changed_buckets = list(Log.objects
+                               .filter(id__gt=after_log_id)
+                               .annotate(time_bucket=Trunc('time', width))
+                               .values_list('time_bucket', flat=True)
+                               .distinct())
+        if not changed_buckets:
+            return []
+        # The time range lets Postgres skip the partitions and pages that are not in any of the buckets
+        logs = logs.filter(time__gte=min(changed_buckets), time__lt=max(changed_buckets) + HISTOGRAM_WIDTHS[width],
+                           time_bucket__in=changed_buckets)
+    return list(logs.values_list('time_bucket').annotate(count=Count('id')).order_by('time_bucket'))
+
+
+def save_query_counts(data_set, width, readings):
+    """
+    Insert the readings into QueryCountAtTime, replacing the counts of buckets that are already there.
+    """
+    with connection.cursor() as cursor:
+        execute_values(cursor.cursor, UPSERT_QUERY_COUNTS_SQL,
+                       [(data_set, width, time, count) for time, count in readings], page_size=BULK_PAGE_SIZE)
 
 
-def get_query_count_intervals(start_time=START_TIME, end_time=END_TIME, data_set='all'):
-    return QueryCountAtTime.objects.filter(data_set=data_set, time__gte=start_time, time__lte=end_time)
+def get_query_count_intervals(start_time=START_TIME, end_time=END_TIME, data_set='all',
+                              width=QueryCountAtTime.WIDTH_DAY):
+    return (QueryCountAtTime.objects
+            .filter(data_set=data_set, width=width, time__gte=start_time, time__lte=end_time)
+            .order_by('time'))
+
+
+def estimate_general_stat(stat_name, start_time=START_TIME, end_time=END_TIME, **kwargs):
+    """
+    Estimate a distinct count stat from the daily sketches instead of counting distinct values of the logs.
+    :return: Tuple of the estimate and its relative standard error,
+             or None if there is no sketch for the stat, filter or range
+    """
+    if stat_name not in DIMENSION_VALUES or not is_sketches_ready():
+        return None
+    cohort = get_cohort(kwargs)
+    day_range = get_day_range(start_time, end_time, start_time is START_TIME and end_time is END_TIME)
+    if cohort is None or day_range is None:
+        return None
+    return estimate_distinct(stat_name, cohort, *day_range), RELATIVE_ERROR
+
+
+def count_distinct(column):
+    """
+    Count distinct values of a column the way SELECT DISTINCT does, where NULL counts as a value of its own.
+    """
+    return f'COUNT(DISTINCT {column}) + COALESCE(MAX(CASE WHEN {column} IS NULL THEN 1 END), 0)'
+
+
+# Stat names to the SQL that computes them over the groups of get_download_groups. Distinct counts are the same as
+# over the logs, since every log is in the group of its key, size, IP address and requester.
+GENERAL_STAT_SQL = {
+    'total_downloads': 'SUM(downloads)',
+    'unique_request_count': 'COUNT(DISTINCT ROW(s3_key_id, ip_address))',
+    'unique_ips': count_distinct('ip_address'),
+    'unique_files': count_distinct('s3_key_id'),
+    'unique_requesters': count_distinct('requester_id'),
+    # Every size of a file only counts once, the first group with it is marked by size_row
+    'average_file_size': 'AVG(object_size) FILTER (WHERE size_row = 1)',
+}
+
+
+def get_download_groups(logs):
+    """
+    :return: Query set of the logs grouped by key, size, IP address and requester with their amount of downloads.
+             The groups of each key and size are numbered, which reuses the order that they were grouped in.
+    """
+    return (logs
+            .values('s3_key', 'object_size', 'ip_address', 'requester')
+            .annotate(downloads=Count('*'), size_row=Window(RowNumber(), partition_by=[F('s3_key'), F('object_size')])))
 
 
 @time_this
-def get_general_stat(stat_name, start_time=START_TIME, end_time=END_TIME, **kwargs):
-    log_range = (filter_from_time_range(start_time, end_time)
-                 .exclude(requester_type=Log.REQUESTER_ENCODED_INSTANCE)
-                 .filter(**kwargs))
-    # Total requests, unique requests, unique ips, unique files
-    key_and_ip = log_range.values_list('s3_key', 'ip_address')
-    distinct_keys = key_and_ip.values_list('s3_key').distinct()
-    # QuerySets are lazy so above is basically just setup for building query
-    if stat_name == 'total_downloads':
-        return log_range.count()
-    elif stat_name == 'unique_request_count':
-        return key_and_ip.distinct().count()
-    elif stat_name == 'unique_ips':
-        return key_and_ip.values_list('ip_address').distinct().count()
-    elif stat_name == 'unique_files':
-        return distinct_keys.count()
-    elif stat_name == 'unique_requesters':
-        return log_range.values_list('requester').distinct().count()
-    elif stat_name == 'average_file_size':
-        return int(distinct_keys.aggregate(average_size=Avg('object_size')).get('average_size', 0.0))
+def get_general_stats(start_time=START_TIME, end_time=END_TIME, exact=True, **kwargs):
+    """
+    Compute every general stat in one pass over the logs, which are grouped once and aggregated in the same statement,
+    or from the in-memory columns if they are turned on, which are always exact.
+    :param exact: Whether distinct counts have to be exact, otherwise they are estimated from sketches where possible
+    :return: Tuple of a dictionary of stat names to their values
+             and a dictionary of the names of estimated stats to their relative standard error
+    """
+    log_selection = select_log_columns(start_time, end_time, kwargs)
+    if log_selection is not None:
+        return log_selection.get_general_stats(), {}
+    estimates = {} if exact else {stat_name: estimate_general_stat(stat_name, start_time, end_time, **kwargs)
+                                  for stat_name in DIMENSION_VALUES}
+    estimates = {stat_name: estimate for stat_name, estimate in estimates.items() if estimate is not None}
+    stat_names = [stat_name for stat_name in GENERAL_STAT_SQL if stat_name not in estimates]
+    groups_sql, params = get_download_groups(
+        filter_from_time_range(start_time, end_time).filter(**get_log_filter(kwargs))).query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {", ".join(GENERAL_STAT_SQL[stat_name] for stat_name in stat_names)} '
+                       f'FROM ({groups_sql}) download_group', params)
+        stats = dict(zip(stat_names, cursor.fetchone()))
+    stats['total_downloads'] = stats['total_downloads'] or 0
+    stats['average_file_size'] = int(stats['average_file_size'] or 0)
+    stats.update({stat_name: round(estimate) for stat_name, (estimate, _) in estimates.items()})
+    return stats, {stat_name: relative_error for stat_name, (_, relative_error) in estimates.items()}
 
 
 def get_requesters_for_item(item, start_time=START_TIME, end_time=END_TIME):
@@ -109,8 +361,17 @@ def get_requesters_for_item(item, start_time=START_TIME, end_time=END_TIME):
     Given an item, find who downloaded it the most totally. This is not unique accesses.
     :return: Tuple containing requester access data and then ip address access data
     """
+    downloads = get_daily_downloads(start_time, end_time, {'s3_key': item.s3_key})
+    if downloads is not None:
+        return (downloads.values_list('requester')
+                .filter(requester__isnull=False)
+                .annotate(count=Sum('downloads'))
+                .order_by('-count'),
+                downloads.values_list('ip_address')
+                .annotate(count=Sum('downloads'))
+                .order_by('-count'))
     keys = (filter_from_time_range(start_time, end_time)
-            .filter(s3_key=item.s3_key))
+            .filter(s3_key__value=item.s3_key))
     return (keys.values_list('requester')
             .annotate(count=Count('requester'))
             .exclude(count=0)
@@ -120,12 +381,32 @@ def get_requesters_for_item(item, start_time=START_TIME, end_time=END_TIME):
             .order_by('-count'))
 
 
+def get_co_downloaded_items(item):
+    """
+    Items that the most IP addresses downloaded along with the given one, over all time.
+    Run the co_downloads command first, see dashboard/co_downloads.py.
+    :return: Query set of the other items and how many IP addresses downloaded both, most first
+    """
+    return (ItemCoDownload.objects
+            .filter(item=item)
+            .values_list('other_item__name', 'other_item__experiment__name', 'other_item__experiment__assay_title',
+                         'count')
+            .order_by('-count', 'other_item'))
+
+
 def get_stats_for_source(start_time=START_TIME, end_time=END_TIME, **kwargs):
     """
     :return: Tuple containing the number of file downloads, and the number of unique downloads
     """
+    log_selection = select_log_columns(start_time, end_time, kwargs)
+    if log_selection is not None:
+        return log_selection.get_source_stats()
+    downloads = get_daily_downloads(start_time, end_time, kwargs)
+    if downloads is not None:
+        return (downloads.aggregate(count=Sum('downloads'))['count'] or 0,
+                downloads.values_list('s3_key').distinct().count())
     reqs = (filter_from_time_range(start_time, end_time)
-            .filter(**kwargs))
+            .filter(**get_log_filter(kwargs)))
     return (reqs
             .count(),
             reqs
@@ -134,45 +415,153 @@ def get_stats_for_source(start_time=START_TIME, end_time=END_TIME, **kwargs):
             .count())
 
 
-def get_items_for_source_limited(amount, start_time=START_TIME, end_time=END_TIME, page=0, **kwargs):
+def get_items_for_source(start_time=START_TIME, end_time=END_TIME, **kwargs):
     """
     Get the most downloaded items for a given source by totals.
     The source should be a model fields that are passed to Django filter call, ex: requester or ip address
-    :param amount: How many results to return. There are usually too many to return all
     :param start_time: When to start looking in the database for downloads
     :param end_time: When to stop looking in the database for downloads
-    :param page: What page number. Default is zero,
     :param kwargs: Passed to Django filter of Log items
-    :return: Database items that were most downloaded by this source
+    :return: Query set of the keys of items that this source downloaded and how often, most downloaded first
     """
-    return take_page(filter_from_time_range(start_time, end_time)
-                     .filter(**kwargs)
-                     .values_list('s3_key')
-                     .filter(item__isnull=False)
-                     # Group by S3 key and see how many total downloads there were
-                     .annotate(count=Count('s3_key'))
-                     .order_by('-count'), amount, page)
+    downloads = get_daily_downloads(start_time, end_time, kwargs)
+    if downloads is not None:
+        return (downloads
+                .values_list('s3_key')
+                .filter(item__isnull=False)
+                .annotate(count=Sum('downloads'))
+                .order_by('-count', 's3_key'))
+    return (filter_from_time_range(start_time, end_time)
+            .filter(**get_log_filter(kwargs))
+            .values_list('s3_key')
+            .filter(item__isnull=False)
+            # Group by S3 key and see how many total downloads there were
+            .annotate(count=Count('s3_key'))
+            .order_by('-count', 's3_key'))
 
 
-def get_or_create_ip_info(ip_address):
-    # TODO load all ip information at insertion time?
+def get_value_field(model, field_name):
     """
-    Lazily get IP information for a given address. This contacts an IP API to get specific data.
-    :return: Retrieved or created ip information for this given address
+    :param field_name: Field like in values_list, can follow foreign keys
+    :return: Tuple of the field to fetch, which is the text of the value for foreign keys to lookup tables,
+             and the model field it ends at
     """
-    if IpAddress.objects.filter(ip_address=ip_address):
-        return IpAddress.objects.get(ip_address=ip_address)
-    else:
-        url = f'http://ip-api.com/json/{ip_address}'
-        result = requests.get(url, headers=GET_JSON_HEADERS).json()
-        return IpAddress.objects.create(
-            ip_address=ip_address,
-            isp=result['as'],
-            country=result['country'],
-            city=result['city'],
-            latitude=result['lat'],
-            longitude=result['lon']
-        )
+    field = None
+    for part in field_name.split('__'):
+        field = model._meta.get_field('id' if part == 'pk' else part)
+        model = field.related_model
+    if field.is_relation and issubclass(field.related_model, LogValue):
+        return f'{field_name}__value', field.related_model._meta.get_field('value')
+    if field.is_relation:
+        return field_name, field.target_field
+    return field_name, field
+
+
+def get_compact_dtype(field, ipv4_as_int=False):
+    """
+    :return: Name of the smallest pandas type that holds the values of a model field, None if pandas should infer it,
+             IPV4_DTYPE for IP addresses as integers
+    """
+    if isinstance(field, models.GenericIPAddressField):
+        return IPV4_DTYPE if ipv4_as_int else 'category'
+    if isinstance(field, models.TextField):
+        return 'category'
+    if isinstance(field, models.DateTimeField):
+        return 'datetime64[ns, UTC]'
+    if isinstance(field, models.DateField):
+        return 'datetime64[ns]'
+    return next((dtype for field_class, dtype in INTEGER_DTYPES.items() if isinstance(field, field_class)), None)
+
+
+def get_compact_column(values, dtype):
+    if dtype == IPV4_DTYPE:
+        return pd.array([None if pd.isna(ip) or ':' in ip else int(IPv4Address(ip)) for ip in values], dtype='UInt32')
+    return values.astype(dtype)
+
+
+def iter_log_data_frames(query_set, *fields, columns=None, chunk_size=DATA_FRAME_CHUNK_SIZE, ipv4_as_int=False):
+    """
+    Stream a query set as DataFrames of at most chunk_size rows, so that only one chunk is in memory at a time.
+    Rows come from a server side cursor and every column gets a compact type: text is categorical,
+    times are datetime64 and integers are as small as their field allows.
+    Foreign keys to lookup tables like s3_key and requester come as their text, like filters on them are written.
+    Example: for df in iter_log_data_frames(Log.objects.filter(http_status=200), 'time', 'ip_address', 's3_key'):
+    :param query_set: Query set of any model, usually logs
+    :param fields: Fields like in values_list, can follow foreign keys
+    :param columns: Names of the columns, the fields if None
+    :param ipv4_as_int: Whether IP addresses are UInt32 instead of categorical,
+                        IPv6 addresses do not fit and are missing then
+    :return: Iterable of DataFrames
+    """
+    value_fields = [get_value_field(query_set.model, field_name) for field_name in fields]
+    dtypes = [get_compact_dtype(field, ipv4_as_int) for _, field in value_fields]
+    columns = columns or list(fields)
+    rows = query_set.values_list(*(field_name for field_name, _ in value_fields)).iterator(chunk_size=chunk_size)
+    for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+        df = pd.DataFrame.from_records(chunk, columns=columns)
+        for column, dtype in zip(columns, dtypes):
+            if dtype is not None:
+                df[column] = get_compact_column(df[column], dtype)
+        yield df
+
+
+def reduce_groups(data_frames, by, aggregate='size', combine='sum'):
+    """
+    Group every chunk and combine the results as they come in, so only the groups are ever in memory.
+    The aggregate has to be one that can be combined from the aggregates of parts, like sizes, sums, minimums and
+    maximums. Distinct counts can be done by reducing to the distinct combinations first and then grouping those.
+    Example: reduce_groups(iter_log_data_frames(logs, 'ip_address'), 'ip_address') counts the logs of every address
+    :param data_frames: Iterable of DataFrames, like from iter_log_data_frames
+    :param by: Column or list of columns to group by
+    :param aggregate: How every chunk is aggregated per group, like in DataFrame.groupby(by).agg
+    :param combine: How the aggregates of the chunks are combined per group, sum for sizes, counts and sums
+    :return: Series or DataFrame of the aggregate of every group
+    """
+    reduced = None
+    for df in data_frames:
+        # Only the categories that are in the chunk, the same group is combined by its value
+        grouped = df.groupby(by, observed=True).agg(aggregate)
+        if reduced is None:
+            reduced = grouped
+        else:
+            combined = pd.concat([reduced, grouped])
+            reduced = combined.groupby(level=list(range(combined.index.nlevels))).agg(combine)
+    return reduced
+
+
+def get_ip_info(ip_address):
+    """
+    Get the location and ISP of an address. Syncs look up every new address, see dashboard/geoip.py,
+    so only addresses that were never in a sync are looked up here, from the ranges in the database without saving them.
+    :return: IP information of the address, None if it is not a valid address
+    """
+    try:
+        ip_address = str(parse_ip_address(ip_address))
+    except ValueError:
+        return None
+    return IpAddress.objects.filter(ip_address=ip_address).first() or look_up_ip_address(ip_address)
+
+
+def get_downloads_by_ip_info(field, start_time=START_TIME, end_time=END_TIME):
+    """
+    Count valid downloads by where they came from, with a join on the saved IP information instead of a lookup per log.
+    Example: get_downloads_by_ip_info('country')
+    :param field: Field of IpAddress, like country, city or isp
+    :return: List of tuples of the value of the field and the amount of downloads, highest first.
+             Addresses that are in no range have an empty value.
+    """
+    IpAddress._meta.get_field(field)
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+            SELECT ip.{field}, COUNT(*)
+            FROM {Log._meta.db_table} log
+            JOIN {IpAddress._meta.db_table} ip ON ip.ip_address = log.ip_address
+            WHERE log.http_status = 200 AND NOT log.requester_type = {Log.REQUESTER_ENCODED_INSTANCE}
+              AND log.time BETWEEN %s AND %s
+            GROUP BY 1
+            ORDER BY 2 DESC
+        ''', [start_time, end_time])
+        return cursor.fetchall()
 
 
 DATES_DF = None
@@ -183,9 +572,8 @@ def get_relative_access():
     Bernstein experiment. Run the analyze command first.
     """
     global DATES_DF
-    if not DATES_DF:
-        DATES_DF = pd.read_csv('access_creation_dates.csv', parse_dates=['created', 'accessed'],
-                               date_parser=pd.to_datetime)
+    if DATES_DF is None:
+        DATES_DF = pd.read_csv('access_creation_dates.csv', parse_dates=['created', 'accessed'])
     created_df = DATES_DF[['created']]
     accessed_by_year = created_df.groupby(created_df['created'].dt.year).size()
     return accessed_by_year
@@ -0,0 +1,180 @@
+"""
+Daily rollup of valid downloads into the DailyDownload table.
+The ingest adds the downloads of every batch in the same transaction as its logs, so the rollup never drifts.
+The sketches and heavy hitters of a day are built from its rows once the sync loaded and linked everything.
+Queries over whole days read the rollup instead of aggregating millions of logs, see dashboard/query.py.
+"""
+from collections import Counter
+from datetime import datetime, time as dt_time, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+from psycopg2.extras import execute_values
+from tqdm import tqdm
+
+from dashboard.metadata import get_sync_time, set_sync_time
+from dashboard.models import DailyDownload, Item, Log, S3Key
+
+DAILY_DOWNLOAD_TABLE = DailyDownload._meta.db_table
+# Set once the rollup was built from every log, queries only use it after that
+ROLLUP_MARKER = 'daily_downloads'
+# Fields of logs that the rollup has as well, filters on anything else have to use the logs
+ROLLUP_FIELDS = {'s3_key', 'item', 'ip_address', 'requester'}
+
+# Conflicts are found with the unique index from the migration, the expressions have to match it exactly
+UPSERT_SQL = f'''
+INSERT INTO {DAILY_DOWNLOAD_TABLE} (day, s3_key_id, ip_address, requester_id, item_id, downloads) VALUES %s
+ON CONFLICT (day, s3_key_id, (ip_address IS NULL), COALESCE(ip_address, '0.0.0.0'), COALESCE(requester_id, 0))
+DO UPDATE
+SET downloads = {DAILY_DOWNLOAD_TABLE}.downloads + excluded.downloads,
+    item_id = COALESCE(excluded.item_id, {DAILY_DOWNLOAD_TABLE}.item_id)
+'''
+# Logs that are counted in the rollup, see ingest.is_valid_download
+VALID_DOWNLOAD_SQL = f'''
+http_status = 200 AND NOT requester_type = {Log.REQUESTER_ENCODED_INSTANCE} AND s3_key_id IS NOT NULL
+'''
+REBUILD_SQL = f'''
+INSERT INTO {DAILY_DOWNLOAD_TABLE} (day, s3_key_id, ip_address, requester_id, item_id, downloads)
+SELECT (time AT TIME ZONE %s)::date, s3_key_id, ip_address, requester_id, MAX(item_id), COUNT(*)
+FROM {Log._meta.db_table}
+WHERE {VALID_DOWNLOAD_SQL} AND time >= %s AND time < %s
+GROUP BY 1, 2, 3, 4
+'''
+DOWNLOAD_DAYS_SQL = f'''
+SELECT DISTINCT (time AT TIME ZONE %s)::date FROM {Log._meta.db_table}
+WHERE {VALID_DOWNLOAD_SQL} AND id > %s AND id <= %s
+ORDER BY 1
+'''
+
+# Only ever goes from False to True, saves a query for every dashboard request after that
+_rollup_ready = False
+
+
+def get_day(time):
+    """
+    :return: Day of a time in the time zone of the dashboard, which is what the rollup is grouped by
+    """
+    return timezone.localtime(time, timezone.get_default_timezone()).date()
+
+
+def get_day_start(day):
+    return timezone.make_aware(datetime.combine(day, dt_time.min), timezone.get_default_timezone())
+
+
+def is_day_start(time):
+    return get_day_start(get_day(time)) == time
+
+
+def get_day_range(start_time, end_time, is_default):
+    """
+    :param is_default: Whether the range is the default one of the dashboard, which covers every day
+    :return: Tuple of the first day and the day after the last one, both None for every day,
+             or None if the range does not start and end on a day
+    """
+    if is_default:
+        return None, None
+    if not is_day_start(start_time) or not is_day_start(end_time):
+        return None
+    return get_day(start_time), get_day(end_time)
+
+
+def add_daily_downloads(cursor, downloads):
+    """
+    Add downloads to the rollup. Rows are sent in a fixed order so that parallel loads can not deadlock each other.
+    :param downloads: Iterable of (day, s3_key_id, ip_address, requester_id, item_id) of valid downloads
+    """
+    counts, item_ids = Counter(), {}
+    for day, s3_key_id, ip_address, requester_id, item_id in downloads:
+        counts[day, s3_key_id, ip_address, requester_id] += 1
+        if item_id is not None:
+            item_ids[s3_key_id] = item_id
+    rows = [(day, s3_key_id, ip_address, requester_id, item_ids.get(s3_key_id), count)
+            for (day, s3_key_id, ip_address, requester_id), count in counts.items()]
+    rows.sort(key=lambda row: (row[0], row[1], row[2] or '', row[3] or 0))
+    if rows:
+        execute_values(cursor.cursor, UPSERT_SQL, rows, page_size=len(rows))
+
+
+def link_daily_downloads_to_items(after_item_id=0):
+    """
+    Same as linking logs to items that were created after them, but for the rollup which is small enough for one update.
+    :return: Set of tuples of the day and the item id of the rows that were linked
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+            WITH linked AS (
+                UPDATE {DAILY_DOWNLOAD_TABLE} download SET item_id = item.id
+                FROM {Item._meta.db_table} item JOIN {S3Key._meta.db_table} s3_key ON s3_key.value = item.s3_key
+                WHERE download.item_id IS NULL AND download.s3_key_id = s3_key.id AND item.id > %s
+                RETURNING download.day, download.item_id
+            )
+            SELECT DISTINCT day, item_id FROM linked
+        ''', [after_item_id])
+        return set(cursor.fetchall())
+
+
+def get_download_days(after_log_id, last_log_id):
+    """
+    :return: Sorted list of the days of the valid downloads with ids in a range, the days whose rows they changed
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(DOWNLOAD_DAYS_SQL, [settings.TIME_ZONE, after_log_id, last_log_id])
+        return [day for day, in cursor.fetchall()]
+
+
+def get_rollup_days(start_day=None, end_day=None):
+    """
+    :param start_day: First day of the range, every day if None
+    :param end_day: Day after the last one of the range
+    :return: Sorted list of the days in a range that have any rows
+    """
+    days = DailyDownload.objects.values_list('day', flat=True).distinct().order_by('day')
+    if start_day is not None and end_day is not None:
+        days = days.filter(day__gte=start_day, day__lt=end_day)
+    return list(days)
+
+
+def iter_month_ranges(start_day, end_day):
+    """
+    Split days into ranges that end at the start of a month or the end day, so each is rebuilt in its own transaction.
+    """
+    while start_day < end_day:
+        next_month = start_day.replace(day=1, month=start_day.month % 12 + 1,
+                                       year=start_day.year + (start_day.month == 12))
+        yield start_day, min(next_month, end_day)
+        start_day = next_month
+
+
+def rebuild_daily_downloads(start_day=None, end_day=None):
+    """
+    Recompute the rollup from the logs. Should not run at the same time as a sync, which would count some logs twice.
+    :param start_day: First day to rebuild, defaults to the day of the first download
+    :param end_day: Day after the last one to rebuild, defaults to the day after the last download
+    """
+    if start_day is None or end_day is None:
+        first_time, last_time = (Log.objects
+                                 .filter(http_status=200)
+                                 .exclude(requester_type=Log.REQUESTER_ENCODED_INSTANCE)
+                                 .aggregate(Min('time'), Max('time'))
+                                 .values())
+        if first_time is None:
+            return
+        start_day = start_day or get_day(first_time)
+        end_day = end_day or get_day(last_time) + timedelta(days=1)
+    for range_start, range_end in tqdm(list(iter_month_ranges(start_day, end_day))):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {DAILY_DOWNLOAD_TABLE} WHERE day >= %s AND day < %s', [range_start, range_end])
+            cursor.execute(REBUILD_SQL, [settings.TIME_ZONE, get_day_start(range_start), get_day_start(range_end)])
+
+
+def set_rollup_ready():
+    set_sync_time(ROLLUP_MARKER, timezone.now())
+
+
+def is_rollup_ready():
+    global _rollup_ready
+    if not _rollup_ready:
+        _rollup_ready = get_sync_time(ROLLUP_MARKER) is not None
+    return _rollup_ready
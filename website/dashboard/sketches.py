@@ -0,0 +1,160 @@
+"""
+HyperLogLog sketches of distinct values of valid downloads, one per day, stat and cohort in the DailySketch table.
+A sketch is a fixed size array of registers that can estimate how many distinct values were added to it.
+Merging two sketches gives the sketch of both, so distinct counts over any range of days only take one merge per day
+instead of a sort over every log in the range. See https://en.wikipedia.org/wiki/HyperLogLog
+"""
+import math
+from collections import defaultdict
+from functools import lru_cache
+from hashlib import blake2b
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+from tqdm import tqdm
+
+from dashboard.metadata import get_sync_time, set_sync_time
+from dashboard.models import AnalysisLabItem, DailyDownload, DailySketch, Item
+from dashboard.rollups import get_rollup_days
+
+# Registers are addressed with this many bits of the hash, more is more accurate but bigger
+PRECISION = 14
+REGISTER_COUNT = 1 << PRECISION
+# Relative standard error of an estimate, about 0.8%
+RELATIVE_ERROR = 1.04 / math.sqrt(REGISTER_COUNT)
+HASH_BITS = 64
+ALPHA = 0.7213 / (1 + 1.079 / REGISTER_COUNT)
+
+COHORT_ALL = 'all'
+COHORT_BERNSTEIN = 'bernstein'
+# Item filters of the cohorts other than all downloads
+COHORT_ITEM_FILTERS = {
+    COHORT_BERNSTEIN: {'name__in': AnalysisLabItem.objects.values_list('name', flat=True)},
+}
+# What is counted for each stat, from the ids of the key and requester and the IP address of a download
+DIMENSION_VALUES = {
+    'unique_ips': lambda s3_key_id, ip_address, requester_id: ip_address,
+    'unique_files': lambda s3_key_id, ip_address, requester_id: s3_key_id,
+    'unique_requesters': lambda s3_key_id, ip_address, requester_id: requester_id,
+    'unique_request_count': lambda s3_key_id, ip_address, requester_id: (s3_key_id, ip_address),
+}
+# Set once the sketches were built from the whole rollup, stats only use them after that
+SKETCH_MARKER = 'daily_sketches'
+
+# Only ever goes from False to True
+_sketches_ready = False
+
+
+@lru_cache(maxsize=1 << 16)
+def get_register(value):
+    """
+    Hash a value into the register it goes in and the rank it sets, the position of the first one bit after the index.
+    Python's own hash is different in every process, so a stable one is used.
+    :return: Tuple of the register index and the rank
+    """
+    value_hash = int.from_bytes(blake2b(str(value).encode(), digest_size=HASH_BITS // 8).digest(), 'little')
+    remaining_bits = HASH_BITS - PRECISION
+    remaining = value_hash & ((1 << remaining_bits) - 1)
+    return value_hash >> remaining_bits, remaining_bits - remaining.bit_length() + 1
+
+
+class HyperLogLog:
+
+    def __init__(self, registers=None):
+        """
+        :param registers: Bytes of the registers from the database, empty if None
+        """
+        self.registers = bytearray(registers) if registers else bytearray(REGISTER_COUNT)
+
+    def add(self, value):
+        index, rank = get_register(value)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        merged = np.maximum(np.frombuffer(self.registers, np.uint8), np.frombuffer(other.registers, np.uint8))
+        self.registers = bytearray(merged.tobytes())
+
+    def estimate(self):
+        registers = np.frombuffer(self.registers, np.uint8)
+        raw_estimate = ALPHA * REGISTER_COUNT ** 2 / np.sum(np.exp2(-registers.astype(np.float64)))
+        zero_count = REGISTER_COUNT - np.count_nonzero(registers)
+        # Small counts leave many registers empty, linear counting is more accurate for those
+        if raw_estimate <= 2.5 * REGISTER_COUNT and zero_count:
+            return REGISTER_COUNT * math.log(REGISTER_COUNT / zero_count)
+        return float(raw_estimate)
+
+
+def get_cohort_item_ids():
+    """
+    :return: Dictionary of the cohorts other than all downloads to the set of their item ids
+    """
+    return {cohort: set(Item.objects.filter(**item_filter).values_list('id', flat=True))
+            for cohort, item_filter in COHORT_ITEM_FILTERS.items()}
+
+
+def build_sketches(downloads, cohort_item_ids):
+    """
+    :param downloads: Iterable of (day, s3_key_id, ip_address, requester_id, item_id) of valid downloads
+    :param cohort_item_ids: Item ids of the cohorts, see get_cohort_item_ids
+    :return: Dictionary of (day, dimension, cohort) to the sketch of those downloads
+    """
+    sketches = defaultdict(HyperLogLog)
+    for day, s3_key_id, ip_address, requester_id, item_id in downloads:
+        cohorts = [COHORT_ALL] + [cohort for cohort, item_ids in cohort_item_ids.items() if item_id in item_ids]
+        for dimension, get_value in DIMENSION_VALUES.items():
+            value = get_value(s3_key_id, ip_address, requester_id)
+            for cohort in cohorts:
+                sketches[day, dimension, cohort].add(value)
+    return sketches
+
+
+def rebuild_daily_sketches(start_day=None, end_day=None, days=None):
+    """
+    Build the sketches again from the daily rollup, which has every distinct download of a day in it.
+    :param start_day: First day to rebuild, every day if None
+    :param end_day: Day after the last one to rebuild
+    :param days: Days to rebuild instead of a range, like the ones a sync loaded logs for
+    """
+    if days is None:
+        days = get_rollup_days(start_day, end_day)
+    cohort_item_ids = get_cohort_item_ids()
+    for day in tqdm(days):
+        downloads = (DailyDownload.objects
+                     .filter(day=day)
+                     .values_list('day', 's3_key_id', 'ip_address', 'requester_id', 'item_id')
+                     .iterator())
+        sketches = build_sketches(downloads, cohort_item_ids)
+        with transaction.atomic():
+            DailySketch.objects.filter(day=day).delete()
+            DailySketch.objects.bulk_create([DailySketch(day=day, dimension=dimension, cohort=cohort,
+                                                         registers=bytes(sketch.registers))
+                                             for (day, dimension, cohort), sketch in sketches.items()])
+
+
+def estimate_distinct(dimension, cohort, start_day=None, end_day=None):
+    """
+    Merge the sketches of the days in a range and estimate the distinct count of a dimension over all of them.
+    :param start_day: First day of the range, every day if None
+    :param end_day: Day after the last one of the range
+    """
+    sketches = DailySketch.objects.filter(dimension=dimension, cohort=cohort)
+    if start_day is not None:
+        sketches = sketches.filter(day__gte=start_day, day__lt=end_day)
+    merged = np.zeros(REGISTER_COUNT, np.uint8)
+    for registers in sketches.values_list('registers', flat=True).iterator():
+        if registers:
+            np.maximum(merged, np.frombuffer(registers, np.uint8), out=merged)
+    return HyperLogLog(merged.tobytes()).estimate()
+
+
+def set_sketches_ready():
+    set_sync_time(SKETCH_MARKER, timezone.now())
+
+
+def is_sketches_ready():
+    global _sketches_ready
+    if not _sketches_ready:
+        _sketches_ready = get_sync_time(SKETCH_MARKER) is not None
+    return _sketches_ready
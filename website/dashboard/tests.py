@@ -1,3 +1,937 @@
-from django.test import TestCase
+import importlib.util
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import date, datetime, timezone as dt_timezone
+from decimal import Decimal
+from io import StringIO
+from itertools import combinations
+from unittest import skipUnless
 
-# Create your tests here.
+import numpy as np
+
+from django.db.models import Count, Sum
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from dashboard.caching import bump_data_version, compute_page, get_data_version, get_page_cache_key, \
+    get_refresh_request, get_versioned_cache_key, is_fresh
+from dashboard.co_downloads import build_download_matrix, get_co_download_matrix, iter_top_co_downloads
+from dashboard.columnar import KEPT_SNAPSHOT_COUNT, SNAPSHOT_PREFIX, LogColumns, LogSelection, get_epoch_microseconds, \
+    get_previous_rows, get_top
+from dashboard.export import get_linked_counts
+from dashboard.geoip import load_isps, load_locations, look_up_ip_address, look_up_ip_addresses
+from dashboard.heavy_hitters import CAPACITY, DIMENSION_IP_ADDRESSES, DIMENSION_ITEMS, SpaceSaving
+from dashboard.ingest import FIELD_PATTERN, LocalLogSource, LogObject, _value_ids, get_start_after, \
+    get_unfinished_objects, ingest_logs, link_logs_to_items, mark_pending, parse_log_line
+from dashboard.metadata import MetadataLoader, get_experiment_name, iter_graph, save_chunks
+from dashboard.models import Award, DailyDownload, Experiment, IpAddress, Item, ItemCoDownload, Lab, Log, LogFile, \
+    QueryCountAtTime, Referrer, Requester, S3Key, UserAgent
+from dashboard.partitions import _known_months
+from dashboard.query import HISTOGRAM_WIDTHS, calculate_query_counts, get_general_stats, get_last_log_id, \
+    save_query_counts
+from dashboard.pagination import decode_cursor, encode_cursor, get_after_filter, get_page
+from dashboard.sketches import HyperLogLog, REGISTER_COUNT, RELATIVE_ERROR
+from dashboard.views import USER_KEY_FIELDS, get_user_rows
+
+S3_KEY = '2019/02/05/0f1e2d3c/ENCFF001AAA.bam'
+LOG_LINE = (
+    '79a59df900b949e55d96a1e698fbacedfd6e09d98eacf8f8d5218e7cd47ef2be encode-public [06/Feb/2019:00:00:38 +0000] '
+    f'192.0.2.3 arn:aws:iam::123456789012:user/reader 3E57427F3EXAMPLE REST.GET.OBJECT {S3_KEY} '
+    f'"GET /encode-public/{S3_KEY} HTTP/1.1" 200 - 2662992 3462992 70 10 "-" "aws-cli/1.16.96 Python/3.7.2" -'
+)
+GRAPH = [{'accession': 'ENCFF001AAA', 'title': 'a [b] {c}'}, {'accession': 'ENCFF002BBB', 'quote': '"@graph": ['}, []]
+SEARCH_RESULT = json.dumps({'@context': '/terms/', '@graph': GRAPH, 'total': len(GRAPH)}, indent=1)
+
+
+def split_text(text, size):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+class ParseLogLineTests(SimpleTestCase):
+
+    def test_field_pattern(self):
+        fields = FIELD_PATTERN.findall('a [06/Feb/2019:00:00:38 +0000] "GET /b HTTP/1.1" "say \\"c d\\"" - ""')
+        self.assertEqual(fields, ['a', '[06/Feb/2019:00:00:38 +0000]', '"GET /b HTTP/1.1"', '"say \\"c d\\""', '-',
+                                  '""'])
+
+    def test_download(self):
+        row = parse_log_line(LOG_LINE, {S3_KEY: 7})
+        self.assertEqual(row.bucket, 'encode-public')
+        self.assertEqual(row.time, datetime(2019, 2, 6, 0, 0, 38, tzinfo=dt_timezone.utc))
+        self.assertEqual(row.ip_address, '192.0.2.3')
+        self.assertEqual(row.requester, 'arn:aws:iam::123456789012:user/reader')
+        self.assertEqual(row.requester_type, Log.REQUESTER_DEFAULT)
+        self.assertEqual(row.request_id, '3E57427F3EXAMPLE')
+        self.assertEqual(row.operation, 'REST.GET.OBJECT')
+        self.assertEqual(row.s3_key, S3_KEY)
+        self.assertEqual(row.item_id, 7)
+        self.assertEqual(row.request_uri, f'GET /encode-public/{S3_KEY} HTTP/1.1')
+        self.assertEqual(row.http_status, 200)
+        self.assertEqual((row.bytes_sent, row.object_size, row.total_time, row.turn_around_time),
+                         (2662992, 3462992, 70, 10))
+        self.assertEqual(row.user_agent, 'aws-cli/1.16.96 Python/3.7.2')
+
+    def test_missing_values(self):
+        row = parse_log_line(LOG_LINE, {})
+        self.assertIsNone(row.item_id)
+        self.assertIsNone(row.error_code)
+        self.assertIsNone(row.referrer)
+        self.assertIsNone(row.version_id)
+
+    def test_encoded_instance(self):
+        line = LOG_LINE.replace('user/reader', 'assumed-role/encoded-instance/i-0123')
+        self.assertEqual(parse_log_line(line, {}).requester_type, Log.REQUESTER_ENCODED_INSTANCE)
+
+    def test_not_a_download(self):
+        self.assertIsNone(parse_log_line(LOG_LINE.replace('REST.GET.OBJECT', 'REST.HEAD.OBJECT'), {}))
+        self.assertIsNone(parse_log_line(LOG_LINE.replace('REST.GET.OBJECT', 'REST.COPY.OBJECT_GET'), {}))
+
+    def test_short_line(self):
+        self.assertIsNone(parse_log_line(LOG_LINE.rsplit(' ', 1)[0], {}))
+        self.assertIsNone(parse_log_line('', {}))
+
+
+class UnreadableLogSource(LocalLogSource):
+    """
+    Local log files where some keys can not be read, like objects that disappear from the bucket while listing.
+    """
+
+    def __init__(self, directory, unreadable_keys):
+        super().__init__(directory)
+        self.unreadable_keys = unreadable_keys
+
+    def open_lines(self, log_object):
+        if log_object.key in self.unreadable_keys:
+            raise OSError(f'Can not read {log_object.key}')
+        return super().open_lines(log_object)
+
+
+class IngestTests(TestCase):
+
+    def setUp(self):
+        # Rows that other tests created are rolled back, the caches of this process would still point at them
+        _known_months.clear()
+        for value_ids in _value_ids.values():
+            value_ids.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_log(self, key, *lines):
+        with open(os.path.join(self.directory, key), 'w') as file:
+            file.writelines(f'{line}\n' for line in lines)
+
+    def ingest(self):
+        return ingest_logs(LocalLogSource(self.directory))
+
+    def get_statuses(self):
+        return dict(LogFile.objects.values_list('key', 'status'))
+
+    def test_loaded_once(self):
+        self.write_log('2019-02-06-00-00-00-A', LOG_LINE)
+        self.write_log('2019-02-06-00-00-00-B', LOG_LINE, 'not a download', LOG_LINE)
+        self.assertEqual(self.ingest(), 3)
+        self.assertEqual(dict(LogFile.objects.values_list('key', 'row_count')),
+                         {'2019-02-06-00-00-00-A': 1, '2019-02-06-00-00-00-B': 2})
+        self.assertEqual(self.ingest(), 0)
+        self.write_log('2019-02-06-00-00-00-C', LOG_LINE)
+        self.assertEqual(get_start_after(), '2019-02-06-00-00-00-B')
+        self.assertEqual(self.ingest(), 1)
+        self.assertEqual(Log.objects.count(), 4)
+        self.assertEqual(set(self.get_statuses().values()), {LogFile.STATUS_LOADED})
+        self.assertEqual(get_unfinished_objects(), [])
+
+    def test_crashed_run(self):
+        for key in ('2019-02-06-00-00-00-A', '2019-02-06-00-00-00-B', '2019-02-06-00-00-00-C'):
+            self.write_log(key, LOG_LINE)
+        # A run that stopped after handing out the task of A and B, but before loading it
+        crashed_objects = [LogObject('2019-02-06-00-00-00-A', 1), LogObject('2019-02-06-00-00-00-B', 1)]
+        mark_pending(crashed_objects)
+        self.assertEqual(set(self.get_statuses().values()), {LogFile.STATUS_PENDING})
+        self.assertEqual(get_unfinished_objects(), crashed_objects)
+        # Listing goes on after the pending objects, they are not listed a second time
+        self.assertEqual(get_start_after(), '2019-02-06-00-00-00-B')
+        self.assertEqual(self.ingest(), 3)
+        self.assertEqual(set(self.get_statuses().values()), {LogFile.STATUS_LOADED})
+        self.assertEqual(self.ingest(), 0)
+        self.assertEqual(Log.objects.count(), 3)
+
+    def test_failed_file(self):
+        self.write_log('2019-02-06-00-00-00-A', LOG_LINE)
+        self.write_log('2019-02-06-00-00-00-B', LOG_LINE, LOG_LINE)
+        self.write_log('2019-02-06-00-00-00-C', LOG_LINE)
+        unreadable_source = UnreadableLogSource(self.directory, {'2019-02-06-00-00-00-B'})
+        self.assertEqual(ingest_logs(unreadable_source), 2)
+        self.assertEqual(self.get_statuses(), {'2019-02-06-00-00-00-A': LogFile.STATUS_LOADED,
+                                               '2019-02-06-00-00-00-B': LogFile.STATUS_FAILED,
+                                               '2019-02-06-00-00-00-C': LogFile.STATUS_LOADED})
+        self.assertEqual(get_unfinished_objects(), [LogObject('2019-02-06-00-00-00-B', 2 * (len(LOG_LINE) + 1))])
+        # Still failing is retried again by the next run, the files that were loaded are not loaded again
+        self.assertEqual(ingest_logs(unreadable_source), 0)
+        self.assertEqual(self.get_statuses()['2019-02-06-00-00-00-B'], LogFile.STATUS_FAILED)
+        self.assertEqual(self.ingest(), 2)
+        self.assertEqual(set(self.get_statuses().values()), {LogFile.STATUS_LOADED})
+        self.assertEqual(Log.objects.count(), 4)
+
+    def test_long_headers(self):
+        # Longer than a btree index entry may be, these are only indexed by their hash
+        referrer = 'https://example.com/?q=' + 'a' * 3000
+        user_agent = 'Mozilla/5.0 ' + 'b' * 3000
+        line = LOG_LINE.replace('"-" "aws-cli/1.16.96 Python/3.7.2"', f'"{referrer}" "{user_agent}"')
+        self.write_log('2019-02-06-00-00-00-A', line)
+        self.write_log('2019-02-06-00-00-00-B', line, LOG_LINE)
+        self.assertEqual(self.ingest(), 3)
+        self.assertFalse(LogFile.objects.exclude(status=LogFile.STATUS_LOADED).exists())
+        self.assertEqual(list(Referrer.objects.values_list('value', flat=True)), [referrer])
+        self.assertEqual(sorted(UserAgent.objects.values_list('value', flat=True)),
+                         ['Mozilla/5.0 ' + 'b' * 3000, 'aws-cli/1.16.96 Python/3.7.2'])
+        self.assertEqual(Log.objects.filter(referrer__value=referrer, user_agent__value=user_agent).count(), 2)
+
+
+    def test_daily_downloads(self):
+        lines = [LOG_LINE, LOG_LINE, LOG_LINE.replace('192.0.2.3', '-'), LOG_LINE.replace('192.0.2.3', '0.0.0.0'),
+                 LOG_LINE.replace('user/reader', 'user/other'), LOG_LINE.replace(' 200 ', ' 206 '),
+                 LOG_LINE.replace('user/reader', 'assumed-role/encoded-instance/i-0123')]
+        # Each run adds to the rows of the same day that the one before created
+        for run, key in enumerate(('2019-02-06-00-00-00-A', '2019-02-06-00-00-00-B')):
+            self.write_log(key, *lines[:len(lines) - run])
+            self.ingest()
+        downloads = (Log.objects
+                     .filter(http_status=200)
+                     .exclude(requester_type=Log.REQUESTER_ENCODED_INSTANCE)
+                     .values_list('s3_key', 'ip_address', 'requester')
+                     .annotate(count=Count('id')))
+        self.assertEqual(len(downloads), 4)
+        self.assertEqual(DailyDownload.objects.values('day').distinct().count(), 1)
+        self.assertEqual(sorted(DailyDownload.objects.values_list('s3_key', 'ip_address', 'requester', 'downloads'),
+                                key=str),
+                         sorted(downloads, key=str))
+        self.assertEqual(DailyDownload.objects.get(ip_address=None).downloads, 2)
+        self.assertEqual(DailyDownload.objects.get(ip_address='0.0.0.0').downloads, 2)
+
+
+    def test_link_logs_to_items(self):
+        other_key = '2019/02/05/0f1e2d3c/ENCFF002BBB.bam'
+        self.write_log('2019-02-06-00-00-00-A', LOG_LINE, LOG_LINE, LOG_LINE.replace(S3_KEY, other_key))
+        self.ingest()
+        self.assertFalse(Log.objects.filter(item__isnull=False).exists())
+        item = Item.objects.create(s3_key=S3_KEY, name='ENCFF001AAA.bam', dataset='ENCSR000AAA',
+                                   dataset_type='experiments')
+        # Only items that are newer than the given one are linked to
+        self.assertEqual(link_logs_to_items(item.id), 0)
+        self.assertEqual(link_logs_to_items(item.id - 1, id_range=1), 2)
+        self.assertEqual(set(Log.objects.values_list('s3_key__value', 'item')), {(S3_KEY, item.id), (other_key, None)})
+        self.assertEqual(set(DailyDownload.objects.values_list('s3_key__value', 'item')),
+                         {(S3_KEY, item.id), (other_key, None)})
+        self.assertEqual(link_logs_to_items(), 0)
+        # The export notices the month changed from the count of linked logs, its highest log id is the same
+        self.assertEqual(get_linked_counts(), {'2019-02': 2})
+
+
+class IterGraphTests(SimpleTestCase):
+
+    def test_whole_text(self):
+        self.assertEqual(list(iter_graph([SEARCH_RESULT])), GRAPH)
+
+    def test_split_chunks(self):
+        # Every chunk size splits the key and the entries somewhere else
+        for size in range(1, len(SEARCH_RESULT)):
+            with self.subTest(size=size):
+                self.assertEqual(list(iter_graph(split_text(SEARCH_RESULT, size))), GRAPH)
+
+    def test_split_key(self):
+        key_index = SEARCH_RESULT.index('"@graph"')
+        chunks = [SEARCH_RESULT[:key_index + 3], SEARCH_RESULT[key_index + 3:]]
+        self.assertEqual(list(iter_graph(chunks)), GRAPH)
+
+    def test_empty_graph(self):
+        self.assertEqual(list(iter_graph(split_text('{"@graph": [], "total": 0}', 3))), [])
+
+    def test_no_graph(self):
+        self.assertEqual(list(iter_graph(split_text('{"notification": "No results found"}', 3))), [])
+
+    def test_cut_off(self):
+        entries = iter_graph(split_text(SEARCH_RESULT[:SEARCH_RESULT.index('ENCFF002BBB')], 5))
+        self.assertEqual(next(entries), GRAPH[0])
+        with self.assertRaises(json.JSONDecodeError):
+            next(entries)
+
+
+class SaveChunksTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.file_name = os.path.join(directory.name, 'search.json')
+
+    def test_saved_after_last_chunk(self):
+        chunks = save_chunks(split_text(SEARCH_RESULT, 10), self.file_name)
+        self.assertEqual(next(chunks), SEARCH_RESULT[:10])
+        self.assertFalse(os.path.exists(self.file_name))
+        self.assertEqual(SEARCH_RESULT[:10] + ''.join(chunks), SEARCH_RESULT)
+        with open(self.file_name) as file:
+            self.assertEqual(file.read(), SEARCH_RESULT)
+        self.assertFalse(os.path.exists(f'{self.file_name}.part'))
+
+    def test_cut_off(self):
+        def cut_off_chunks():
+            yield SEARCH_RESULT[:10]
+            raise ConnectionError
+
+        with self.assertRaises(ConnectionError):
+            list(save_chunks(cut_off_chunks(), self.file_name))
+        self.assertFalse(os.path.exists(self.file_name))
+
+    def test_parsed_while_saved(self):
+        self.assertEqual(list(iter_graph(save_chunks(split_text(SEARCH_RESULT, 7), self.file_name))), GRAPH)
+        with open(self.file_name) as file:
+            self.assertEqual(json.load(file)['@graph'], GRAPH)
+
+
+def get_sketch(values):
+    sketch = HyperLogLog()
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+def get_item_json(accession, experiment_name, file_format='bam', lab_name='j-michael-cherry'):
+    return {
+        's3_uri': f's3://encode-public/2019/02/05/0f1e2d3c/{accession}.bam',
+        'dataset': f'/experiments/{experiment_name}/',
+        'file_format': file_format,
+        'date_created': '2019-02-05T20:00:00.000000+00:00',
+        'award': {'name': 'U54HG006998', 'project': 'ENCODE', 'rfa': 'ENCODE3', 'status': 'current',
+                  'pi': {'title': 'J. Michael Cherry', 'lab': {'name': lab_name}}},
+    }
+
+
+def get_experiment_json(experiment_name, assay_title='ChIP-seq'):
+    return {'@id': f'/experiments/{experiment_name}/', 'assay_title': assay_title, 'assay_term_name': 'ChIP-seq',
+            'date_released': '2019-01-10'}
+
+
+class MetadataLoaderTests(TestCase):
+
+    def setUp(self):
+        self.requested_names = []
+
+    def get_experiment_results(self, names):
+        self.requested_names.extend(names)
+        return [get_experiment_json(name, 'DNase-seq') for name in names]
+
+    def load(self, item_results, experiment_results=(get_experiment_json('ENCSR000AAA'),)):
+        loader = MetadataLoader({get_experiment_name(result): result for result in experiment_results},
+                                self.get_experiment_results, batch_size=2)
+        loader.load(item_results)
+        return loader.created_count, loader.updated_count
+
+    def test_created_once(self):
+        item_results = [get_item_json('ENCFF001AAA', 'ENCSR000AAA'), {'accession': 'ENCFF002BBB'},
+                        get_item_json('ENCFF003CCC', 'ENCSR000BBB'), get_item_json('ENCFF004DDD', 'ENCSR000AAA')]
+        self.assertEqual(self.load(item_results), (3, 0))
+        # Only the experiment that was not in the search result is requested
+        self.assertEqual(self.requested_names, ['ENCSR000BBB'])
+        self.assertEqual(dict(Experiment.objects.values_list('name', 'assay_title')),
+                         {'ENCSR000AAA': 'ChIP-seq', 'ENCSR000BBB': 'DNase-seq'})
+        self.assertEqual((Award.objects.count(), Lab.objects.count()), (1, 1))
+        item = Item.objects.get(name='ENCFF001AAA.bam')
+        self.assertEqual((item.s3_key, item.dataset, item.dataset_type, item.experiment.name, item.lab.name),
+                         ('2019/02/05/0f1e2d3c/ENCFF001AAA.bam', 'ENCSR000AAA', 'experiments', 'ENCSR000AAA',
+                          'j-michael-cherry'))
+        self.assertEqual(self.load(item_results), (0, 0))
+        self.assertEqual(Item.objects.count(), 3)
+
+    def test_changed(self):
+        self.load([get_item_json('ENCFF001AAA', 'ENCSR000AAA'), get_item_json('ENCFF003CCC', 'ENCSR000AAA')])
+        self.assertEqual(self.load([get_item_json('ENCFF001AAA', 'ENCSR000AAA', 'bed', 'bradley-bernstein'),
+                                    get_item_json('ENCFF003CCC', 'ENCSR000AAA')],
+                                   [get_experiment_json('ENCSR000AAA', 'Mint-ChIP-seq')]), (0, 1))
+        item = Item.objects.get(name='ENCFF001AAA.bam')
+        self.assertEqual((item.file_format, item.lab.name), ('bed', 'bradley-bernstein'))
+        self.assertEqual(Item.objects.get(name='ENCFF003CCC.bam').file_format, 'bam')
+        self.assertEqual(Experiment.objects.get().assay_title, 'Mint-ChIP-seq')
+
+
+class HyperLogLogTests(SimpleTestCase):
+
+    def test_empty(self):
+        self.assertEqual(len(HyperLogLog().registers), REGISTER_COUNT)
+        self.assertEqual(HyperLogLog().estimate(), 0)
+
+    def test_repeated_values(self):
+        self.assertEqual(get_sketch(['192.0.2.3'] * 100).registers, get_sketch(['192.0.2.3']).registers)
+
+    def test_small_count(self):
+        self.assertAlmostEqual(get_sketch(range(100)).estimate(), 100, delta=1)
+
+    def test_error_bound(self):
+        # Three standard errors, the hash is stable so this never fails by chance
+        for count in (1000, 20000, 100000):
+            with self.subTest(count=count):
+                self.assertAlmostEqual(get_sketch(range(count)).estimate(), count, delta=3 * RELATIVE_ERROR * count)
+
+    def test_merge(self):
+        sketch, other_sketch = get_sketch(range(0, 30000)), get_sketch(range(20000, 50000))
+        sketch.merge(other_sketch)
+        self.assertEqual(sketch.registers, get_sketch(range(50000)).registers)
+        self.assertAlmostEqual(sketch.estimate(), 50000, delta=3 * RELATIVE_ERROR * 50000)
+
+    def test_saved_registers(self):
+        sketch = get_sketch(range(1000))
+        self.assertEqual(HyperLogLog(bytes(sketch.registers)).estimate(), sketch.estimate())
+
+
+class SpaceSavingTests(SimpleTestCase):
+
+    def setUp(self):
+        # Skewed like downloads, a few keys every day and a long tail of keys that only some days have
+        generator = random.Random(0)
+        keys = [f'ENCFF{number:06}' for number in range(CAPACITY * 6)]
+        weights = [1 / (rank + 1) for rank in range(len(keys))]
+        self.daily_counts = [Counter(generator.choices(keys, weights, k=5000)) for _ in range(20)]
+        self.total_counts = sum(self.daily_counts, Counter())
+
+    def get_merged(self):
+        merged = SpaceSaving()
+        for counts in self.daily_counts:
+            merged.merge(SpaceSaving.from_counts(counts))
+        return merged
+
+    def test_from_counts(self):
+        summary = SpaceSaving.from_counts(self.total_counts)
+        self.assertEqual(len(summary.counters), CAPACITY)
+        self.assertEqual(summary.get_floor(), min(count for count, _ in summary.counters.values()))
+        for key, count in self.total_counts.items():
+            if key in summary.counters:
+                self.assertEqual(summary.counters[key], [count, 0])
+            else:
+                self.assertLessEqual(count, summary.get_floor())
+
+    def test_few_keys(self):
+        summary = SpaceSaving.from_counts(Counter({'a': 3, 'b': 1}))
+        self.assertEqual(summary.get_floor(), 0)
+        summary.merge(SpaceSaving.from_counts(Counter({'b': 2, 'c': 5})))
+        self.assertEqual(summary.counters, {'a': [3, 0], 'b': [3, 0], 'c': [5, 0]})
+
+    def test_merge_bounds(self):
+        merged = self.get_merged()
+        self.assertEqual(len(merged.counters), CAPACITY)
+        floor = merged.get_floor()
+        for key, count in self.total_counts.items():
+            if key in merged.counters:
+                # The count is an upper bound and the error says by how much it can be too high
+                upper_bound, error = merged.counters[key]
+                self.assertLessEqual(count, upper_bound)
+                self.assertLessEqual(upper_bound - error, count)
+            else:
+                self.assertLessEqual(count, floor)
+
+    def test_merge_keeps_heavy_hitters(self):
+        merged = self.get_merged()
+        heavy_hitters = {key for key, count in self.total_counts.items() if count > merged.get_floor()}
+        self.assertTrue(heavy_hitters)
+        self.assertLessEqual(heavy_hitters, merged.counters.keys())
+
+
+@skipUnless(importlib.util.find_spec('scipy'), 'scipy is needed to build co-downloads')
+class CoDownloadTests(SimpleTestCase):
+
+    def setUp(self):
+        random.seed(19)
+        pairs = {(random.randrange(40), random.choice((3, 5, 8, 13, 21, 34))) for _ in range(150)}
+        # One address downloads everything, like a mirror
+        pairs.update((40, item_id) for item_id in range(3, 35))
+        self.ip_codes, self.item_ids = (np.array(values, np.int64) for values in zip(*sorted(pairs)))
+
+    def get_counts(self, max_items_per_ip):
+        """
+        :return: How many IP addresses downloaded each pair of items, counted one address at a time
+        """
+        items_by_ip = defaultdict(set)
+        for ip_code, item_id in zip(self.ip_codes, self.item_ids):
+            items_by_ip[ip_code].add(int(item_id))
+        counts = Counter()
+        for item_ids in items_by_ip.values():
+            if len(item_ids) <= max_items_per_ip:
+                for item_id, other_item_id in combinations(sorted(item_ids), 2):
+                    counts[item_id, other_item_id] += 1
+                    counts[other_item_id, item_id] += 1
+        return counts
+
+    def test_matrix(self):
+        matrix, column_item_ids = build_download_matrix(self.ip_codes, self.item_ids, max_items_per_ip=None)
+        self.assertEqual(column_item_ids.tolist(), list(range(3, 35)))
+        self.assertEqual(matrix.shape, (41, 32))
+        self.assertEqual(matrix.sum(), len(self.ip_codes))
+        matrix, column_item_ids = build_download_matrix(self.ip_codes, self.item_ids, max_items_per_ip=6)
+        self.assertEqual(column_item_ids.tolist(), [3, 5, 8, 13, 21, 34])
+        self.assertEqual(matrix.sum(), len(self.ip_codes) - 32)
+
+    def test_top_co_downloads(self):
+        counts = self.get_counts(6)
+        matrix, column_item_ids = build_download_matrix(self.ip_codes, self.item_ids, max_items_per_ip=6)
+        for block_size in (1, 4, 100):
+            with self.subTest(block_size=block_size):
+                top = defaultdict(list)
+                for column, other, count in iter_top_co_downloads(matrix, 3, 2, block_size):
+                    top[column_item_ids[column]].append((column_item_ids[other], count))
+                for item_id in column_item_ids:
+                    expected = sorted(((other_item_id, count) for (pair_item_id, other_item_id), count
+                                       in counts.items() if pair_item_id == item_id and count >= 2),
+                                      key=lambda pair: (-pair[1], pair[0]))[:3]
+                    self.assertEqual(top[item_id], expected)
+
+
+@skipUnless(importlib.util.find_spec('scipy'), 'scipy is needed to build co-downloads')
+class CoDownloadMatrixTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.items = [Item.objects.create(s3_key=f'2019/02/05/0f1e2d3c/ENCFF00{number}AAA.bam',
+                                         name=f'ENCFF00{number}AAA.bam', dataset='ENCSR000AAA',
+                                         dataset_type='experiments') for number in range(1, 4)]
+        # The first address downloads one item more than the others, which is not asked for
+        for ip_address, items in (('192.0.2.3', cls.items), ('192.0.2.4', cls.items[:2]),
+                                  ('192.0.2.5', cls.items[:2])):
+            for item in items:
+                Log.objects.create(time=get_day(1), ip_address=ip_address, item=item, http_status=200,
+                                   requester_type=Log.REQUESTER_DEFAULT, request_id='3E57427F3EXAMPLE')
+
+    def test_items_per_ip_of_every_item(self):
+        item_ids = [item.id for item in self.items[:2]]
+        self.assertEqual(get_co_download_matrix(item_ids, max_items_per_ip=None).values.tolist(), [[0, 3], [3, 0]])
+        self.assertEqual(get_co_download_matrix(item_ids, max_items_per_ip=2).values.tolist(), [[0, 2], [2, 0]])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('co_downloads', max_items_per_ip=2, stdout=out)
+        self.assertIn('Saved 2 pairs of items', out.getvalue())
+        self.assertEqual(set(ItemCoDownload.objects.values_list('item', 'other_item', 'count')),
+                         {(self.items[0].id, self.items[1].id, 2), (self.items[1].id, self.items[0].id, 2)})
+
+
+class CursorTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        for key in ([], ['192.0.2.3', 7], [None, None], ['2019/02/05/a b+c/ENCFF001AAA.bam']):
+            with self.subTest(key=key):
+                cursor = encode_cursor(40, 12, key)
+                self.assertNotIn('=', cursor)
+                self.assertEqual(decode_cursor(cursor), (40, 12, key))
+
+    def test_invalid(self):
+        for cursor in ('', 'not a cursor', encode_cursor(40, 12, ['a'])[:-2], encode_cursor('40', 12, ['a']),
+                       encode_cursor(40, None, ['a']), encode_cursor(40, 12, 'a')):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    decode_cursor(cursor)
+
+    def test_key_length(self):
+        with self.assertRaises(ValueError):
+            get_after_filter(USER_KEY_FIELDS, 12, ['192.0.2.3'])
+
+
+class TiedPageTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        s3_key = S3Key.objects.create(value='2019/02/05/0f1e2d3c/ENCFF001AAA.bam')
+        requesters = [Requester.objects.create(value=f'arn:aws:iam::123456789012:user/{name}') for name in 'abc']
+        # Most users tie with others, some without an IP address, a requester or both
+        users = [('192.0.2.3', requesters[0], 5), ('192.0.2.3', requesters[1], 2), ('192.0.2.3', None, 2),
+                 ('192.0.2.10', requesters[0], 2), ('2001:db8::1', None, 2), (None, requesters[2], 2),
+                 (None, requesters[0], 2), (None, None, 3), ('192.0.2.4', requesters[2], 1)]
+        for ip_address, requester, downloads in users:
+            # Downloads of a user on several days are one row of the ranking
+            for day in range(1, downloads + 1):
+                DailyDownload.objects.create(day=date(2019, 2, day), s3_key=s3_key, ip_address=ip_address,
+                                             requester=requester, downloads=1)
+
+    def get_ranked(self):
+        return get_user_rows(DailyDownload.objects.values(*USER_KEY_FIELDS).annotate(count=Sum('downloads')))
+
+    def get_pages(self, page_size, cache_ranking=False):
+        """
+        :return: Rows of every page in order, following the cursors
+        """
+        rows, cursor = [], None
+        while True:
+            page_rows, offset, cursor = get_page(self.get_ranked(), USER_KEY_FIELDS, page_size, cursor=cursor,
+                                                 cache_ranking=cache_ranking)
+            self.assertEqual(offset, len(rows))
+            rows.extend(page_rows)
+            if cursor is None:
+                return rows
+
+    def test_every_row_once(self):
+        all_rows = [row[len(USER_KEY_FIELDS):]
+                    for row in self.get_ranked().order_by('-count', *USER_KEY_FIELDS)]
+        self.assertEqual(len(all_rows), 9)
+        self.assertEqual([row[-1] for row in all_rows], [5, 3, 2, 2, 2, 2, 2, 2, 1])
+        for page_size in range(1, len(all_rows) + 2):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self.get_pages(page_size), all_rows)
+
+    def test_numbered_pages(self):
+        cursor_rows = self.get_pages(2)
+        for page in range(5):
+            rows, offset, _ = get_page(self.get_ranked(), USER_KEY_FIELDS, 2, page)
+            self.assertEqual(rows, cursor_rows[offset:offset + 2])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_cached_ranking(self):
+        cache.clear()
+        all_rows = self.get_pages(9)
+        for page_size in range(1, len(all_rows) + 2):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self.get_pages(page_size, cache_ranking=True), all_rows)
+        for page in range(5):
+            rows, offset, _ = get_page(self.get_ranked(), USER_KEY_FIELDS, 2, page, cache_ranking=True)
+            self.assertEqual(rows, all_rows[offset:offset + 2])
+        # The ranking is only grouped once, pages after it only look up their rows
+        with self.assertNumQueries(2):
+            get_page(self.get_ranked(), USER_KEY_FIELDS, 2, 3, cache_ranking=True)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_stale_cursor(self):
+        cache.clear()
+        _, _, cursor = get_page(self.get_ranked(), USER_KEY_FIELDS, 2)
+        _, count, key = decode_cursor(cursor)
+        rows, offset, _ = get_page(self.get_ranked(), USER_KEY_FIELDS, 2, cursor=encode_cursor(5, count, key),
+                                   cache_ranking=True)
+        self.assertEqual((rows, offset), (self.get_pages(9)[2:4], 5))
+
+    def test_top_pages(self):
+        rows, offset, cursor = get_page(self.get_ranked(), USER_KEY_FIELDS, 2, 1,
+                                        get_top=lambda page_size, page: [('192.0.2.3', 1, 'a', '192.0.2.3', 5)] * 2)
+        self.assertEqual((rows, offset), ([('a', '192.0.2.3', 5)] * 2, 2))
+        self.assertEqual(decode_cursor(cursor), (4, 5, ['192.0.2.3', 1]))
+
+
+def get_day(day, hour=0):
+    return datetime(2019, 2, day, hour, tzinfo=dt_timezone.utc)
+
+
+def get_log_columns():
+    """
+    :return: Columns of a few downloads, IP address code 0 and requester 0 are missing ones
+    """
+    times = np.array([get_epoch_microseconds(time) for time in
+                      (get_day(1), get_day(1, 12), get_day(2), get_day(3), get_day(4), get_day(5))], np.int64)
+    s3_keys = np.array([1, 1, 2, 1, 2, 1], np.int32)
+    ip_addresses = np.array([1, 1, 2, 2, 0, 1], np.uint32)
+    requesters = np.array([1, 1, 2, 0, 2, 1], np.int32)
+    object_sizes = np.array([100, 100, 200, 150, -1, 100], np.int64)
+    return LogColumns(times, s3_keys, ip_addresses, requesters, object_sizes,
+                      get_previous_rows(s3_keys, ip_addresses), get_previous_rows(s3_keys, object_sizes),
+                      np.array(['', '192.0.2.3', '192.0.2.4']), np.array([0, 10, 0], np.int32), 6, 10)
+
+
+class QueryCountTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for day, hour in ((1, 0), (1, 0), (1, 23), (2, 5), (4, 12), (9, 1), (9, 1), (20, 18)):
+            cls.create_log(day, hour)
+
+    @staticmethod
+    def create_log(day, hour):
+        Log.objects.create(time=get_day(day, hour), requester_type=Log.REQUESTER_DEFAULT, request_id='3E57427F3EXAMPLE')
+
+    def get_interval_count(self, time, width):
+        """
+        :return: Count of the logs in a bucket, the way they were counted with one query per interval
+        """
+        return Log.objects.filter(time__gte=time, time__lt=time + HISTOGRAM_WIDTHS[width]).count()
+
+    def get_saved_counts(self, width):
+        return dict(QueryCountAtTime.objects.filter(data_set='all', width=width).values_list('time', 'count'))
+
+    def test_interval_counts(self):
+        for width in HISTOGRAM_WIDTHS:
+            with self.subTest(width=width):
+                readings = calculate_query_counts(width)
+                self.assertEqual([bucket_time for bucket_time, _ in readings],
+                                 sorted(bucket_time for bucket_time, _ in readings))
+                self.assertEqual(sum(count for _, count in readings), Log.objects.count())
+                for bucket_time, count in readings:
+                    self.assertEqual(count, self.get_interval_count(bucket_time, width))
+
+    def test_changed_buckets(self):
+        width = QueryCountAtTime.WIDTH_DAY
+        save_query_counts('all', width, calculate_query_counts(width))
+        saved_counts = self.get_saved_counts(width)
+        after_log_id = get_last_log_id()
+        self.assertEqual(calculate_query_counts(width, after_log_id), [])
+        self.create_log(9, 3)
+        self.create_log(21, 0)
+        readings = calculate_query_counts(width, after_log_id)
+        self.assertEqual(len(readings), 2)
+        # Buckets without new logs are left alone, even if their saved count is off
+        unchanged_time = min(saved_counts)
+        QueryCountAtTime.objects.filter(time=unchanged_time).update(count=100)
+        save_query_counts('all', width, readings)
+        new_counts = self.get_saved_counts(width)
+        self.assertEqual(new_counts[unchanged_time], 100)
+        self.assertEqual(len(new_counts), len(saved_counts) + 1)
+        for bucket_time, count in readings:
+            self.assertEqual(new_counts[bucket_time], self.get_interval_count(bucket_time, width))
+            self.assertEqual(count, self.get_interval_count(bucket_time, width))
+
+
+LOCATION_CSV = """192.0.2.0,192.0.2.255,NA,US,California,Stanford,37.4241,-122.166
+198.51.100.0,198.51.100.127,EU,DE,Berlin,Berlin,52.52,13.405
+2001:db8::,2001:db8::ffff,NA,US,California,Palo Alto,37.4419,-122.143
+"""
+ISP_CSV = """192.0.2.0,192.0.2.127,32,Stanford University
+"""
+
+
+class GeoIpTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.assertEqual(load_locations(self.write_csv('locations.csv', LOCATION_CSV)), 3)
+        self.assertEqual(load_isps(self.write_csv('isps.csv', ISP_CSV)), 1)
+        for ip_address in ('192.0.2.3', '192.0.2.200', '198.51.100.200', '2001:db8::1', '203.0.113.5', '192.0.2.3'):
+            self.create_log(ip_address)
+
+    def write_csv(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as file:
+            file.write(text)
+        return path
+
+    @staticmethod
+    def create_log(ip_address):
+        return Log.objects.create(time=get_day(6), ip_address=ip_address, requester_type=Log.REQUESTER_DEFAULT,
+                                  request_id='3E57427F3EXAMPLE')
+
+    def get_saved(self):
+        return {ip_address: (isp, country, city) for ip_address, isp, country, city in
+                IpAddress.objects.values_list('ip_address', 'isp', 'country', 'city')}
+
+    def test_look_up(self):
+        self.assertEqual(look_up_ip_addresses(), 5)
+        # Addresses after the end of the range that starts before them are in no range
+        self.assertEqual(self.get_saved(), {
+            '192.0.2.3': ('AS32 Stanford University', 'US', 'Stanford'),
+            '192.0.2.200': ('', 'US', 'Stanford'),
+            '198.51.100.200': ('', '', ''),
+            '2001:db8::1': ('', 'US', 'Palo Alto'),
+            '203.0.113.5': ('', '', ''),
+        })
+        self.assertEqual(IpAddress.objects.get(ip_address='192.0.2.3').latitude, Decimal('37.4241'))
+
+    def test_only_new(self):
+        look_up_ip_addresses()
+        last_log_id = self.create_log('198.51.100.1').id - 1
+        self.create_log('192.0.2.3')
+        self.assertEqual(look_up_ip_addresses(last_log_id), 1)
+        self.assertEqual(self.get_saved()['198.51.100.1'], ('', 'DE', 'Berlin'))
+        self.assertEqual(look_up_ip_addresses(), 0)
+        load_locations(self.write_csv('locations.csv', LOCATION_CSV.replace('Stanford', 'Palo Alto')))
+        self.assertEqual(look_up_ip_addresses(update=True), 6)
+        self.assertEqual(self.get_saved()['192.0.2.3'], ('AS32 Stanford University', 'US', 'Palo Alto'))
+
+    def test_single_address(self):
+        ip_info = look_up_ip_address('192.0.2.4')
+        self.assertIsNone(ip_info.pk)
+        self.assertEqual((ip_info.isp, ip_info.country, ip_info.city), ('AS32 Stanford University', 'US', 'Stanford'))
+        self.assertFalse(IpAddress.objects.exists())
+
+
+class LogColumnsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.log_columns = get_log_columns()
+
+    def test_previous_rows(self):
+        self.assertEqual(self.log_columns.previous_requests.tolist(), [-1, 0, -1, -1, -1, 1])
+        self.assertEqual(self.log_columns.previous_sizes.tolist(), [-1, 0, -1, -1, -1, 1])
+
+    def test_every_download(self):
+        self.assertEqual(self.log_columns.select().get_general_stats(), {
+            'total_downloads': 6,
+            'unique_request_count': 4,
+            'unique_ips': 3,
+            'unique_files': 2,
+            'unique_requesters': 3,
+            'average_file_size': 150,
+        })
+
+    def test_time_range(self):
+        # Both ends are included, the first row of a pair in the range can have rows of the pair before the range
+        selection = self.log_columns.select(get_day(1, 12), get_day(3))
+        self.assertEqual(selection.get_source_stats(), (3, 2))
+        stats = selection.get_general_stats()
+        self.assertEqual((stats['unique_request_count'], stats['average_file_size']), (3, 150))
+        self.assertEqual(self.log_columns.select(get_day(6), get_day(7)).get_general_stats()['total_downloads'], 0)
+
+    def test_range_same_as_filter(self):
+        for start_day, end_day in ((1, 5), (1, 2), (2, 5), (3, 4), (5, 5)):
+            with self.subTest(start_day=start_day, end_day=end_day):
+                rows = self.log_columns.get_rows(get_day(start_day), get_day(end_day))
+                self.assertEqual(self.log_columns.select(get_day(start_day), get_day(end_day)).get_general_stats(),
+                                 LogSelection(self.log_columns, np.arange(6)[rows]).get_general_stats())
+
+    def test_requester(self):
+        stats = self.log_columns.select(requester_id=1).get_general_stats()
+        self.assertEqual((stats['total_downloads'], stats['unique_request_count'], stats['unique_ips']), (3, 1, 1))
+        stats = self.log_columns.select(get_day(2), get_day(5), requester_id=2).get_general_stats()
+        self.assertEqual((stats['total_downloads'], stats['unique_files'], stats['average_file_size']), (2, 1, 200))
+
+    def test_ip_address(self):
+        stats = self.log_columns.select(ip_address='192.0.2.4').get_general_stats()
+        self.assertEqual((stats['total_downloads'], stats['unique_request_count'], stats['unique_requesters']),
+                         (2, 2, 2))
+        stats = self.log_columns.select(ip_address='198.51.100.1').get_general_stats()
+        self.assertEqual((stats['total_downloads'], stats['average_file_size']), (0, 0))
+
+    def test_top_candidates(self):
+        # Only keys with an item count, by the IP addresses that downloaded them
+        self.assertEqual(self.log_columns.select().get_top_candidates(DIMENSION_ITEMS, 5), ([1], 0))
+        self.assertEqual(self.log_columns.select().get_top_candidates(DIMENSION_IP_ADDRESSES, 1), (['192.0.2.3'], 2))
+        self.assertEqual(self.log_columns.select(get_day(2), get_day(4)).get_top_candidates(DIMENSION_IP_ADDRESSES, 1),
+                         (['192.0.2.4'], 1))
+
+    def test_top_ties(self):
+        counts = np.array([0, 3, 2, 2, 1])
+        self.assertEqual((get_top(counts, 1)[0].tolist(), get_top(counts, 1)[1]), ([1], 2))
+        self.assertEqual((get_top(counts, 2)[0].tolist(), get_top(counts, 2)[1]), ([1, 2, 3], 1))
+        self.assertEqual((get_top(counts, 9)[0].tolist(), get_top(counts, 9)[1]), ([1, 2, 3, 4], 0))
+        self.assertEqual(get_top(counts, 2, np.array([0, 0, 1, 0, 0]))[0].tolist(), [1, 3, 2])
+
+    def test_saved_snapshot(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for _ in range(KEPT_SNAPSHOT_COUNT + 1):
+            self.log_columns.save(directory.name)
+        snapshot_names = [name for name in os.listdir(directory.name) if name.startswith(SNAPSHOT_PREFIX)]
+        self.assertEqual(len(snapshot_names), KEPT_SNAPSHOT_COUNT)
+        loaded = LogColumns.load(directory.name, 'r')
+        self.assertFalse(loaded.times.flags.writeable)
+        self.assertEqual((loaded.last_log_id, loaded.last_item_id), (6, 10))
+        for log_columns in (loaded, self.log_columns):
+            stats = log_columns.select(get_day(1, 12), get_day(3), ip_address='192.0.2.4').get_general_stats()
+            self.assertEqual((stats['total_downloads'], stats['unique_files'], stats['average_file_size']), (2, 2, 175))
+
+
+class GeneralStatsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # The downloads of get_log_columns, so both give the same stats
+        s3_keys = [S3Key.objects.create(value=f'2019/02/05/0f1e2d3c/ENCFF00{key}AAA.bam') for key in (1, 2)]
+        requesters = [Requester.objects.create(value=f'arn:aws:iam::123456789012:user/{name}') for name in 'ab']
+        downloads = [(get_day(1), 0, '192.0.2.3', 0, 100), (get_day(1, 12), 0, '192.0.2.3', 0, 100),
+                     (get_day(2), 1, '192.0.2.4', 1, 200), (get_day(3), 0, '192.0.2.4', None, 150),
+                     (get_day(4), 1, None, 1, None), (get_day(5), 0, '192.0.2.3', 0, 100)]
+        for log_time, s3_key, ip_address, requester, object_size in downloads:
+            Log.objects.create(time=log_time, s3_key=s3_keys[s3_key], ip_address=ip_address,
+                               requester=None if requester is None else requesters[requester], object_size=object_size,
+                               http_status=200, requester_type=Log.REQUESTER_DEFAULT, request_id='3E57427F3EXAMPLE')
+
+    def test_same_as_columns(self):
+        log_columns = get_log_columns()
+        self.assertEqual(get_general_stats(exact=True), (log_columns.select().get_general_stats(), {}))
+        self.assertEqual(get_general_stats(get_day(1, 12), get_day(3), exact=True)[0],
+                         log_columns.select(get_day(1, 12), get_day(3)).get_general_stats())
+
+    def test_no_downloads(self):
+        stats, _ = get_general_stats(get_day(6), get_day(7), exact=True)
+        self.assertEqual((stats['total_downloads'], stats['unique_ips'], stats['average_file_size']), (0, 0, 0))
+
+
+class VersionedCacheKeyTests(TestCase):
+
+    def test_key(self):
+        key = get_versioned_cache_key('ranking', '/dashboard/users/', 3)
+        self.assertEqual(key, get_versioned_cache_key('ranking', '/dashboard/users/', 3))
+        self.assertTrue(key.startswith('ranking:3:'))
+        self.assertNotEqual(key, get_versioned_cache_key('ranking', '/dashboard/users/', 4))
+        self.assertNotEqual(key, get_versioned_cache_key('ranking', '/dashboard/items/', 3))
+        self.assertNotEqual(key, get_versioned_cache_key('page', '/dashboard/users/', 3))
+        # Names can be any path, they are hashed so keys stay short and valid for every cache backend
+        self.assertNotIn(' ', get_versioned_cache_key('ranking', '/dashboard/users/?q=a b' + 'c' * 500, 3))
+        self.assertLess(len(get_versioned_cache_key('ranking', 'c' * 500, 3)), 64)
+
+    def test_data_version(self):
+        self.assertEqual(get_data_version(), 0)
+        key = get_versioned_cache_key('ranking', '/dashboard/users/')
+        self.assertEqual(key, get_versioned_cache_key('ranking', '/dashboard/users/', 0))
+        bump_data_version()
+        bump_data_version()
+        self.assertEqual(get_data_version(), 2)
+        self.assertEqual(get_versioned_cache_key('ranking', '/dashboard/users/'),
+                         get_versioned_cache_key('ranking', '/dashboard/users/', 2))
+
+
+@override_settings(CACHE_TIME=60)
+class IsFreshTests(SimpleTestCase):
+
+    def test_fresh(self):
+        self.assertTrue(is_fresh((3, time.time(), None), 3))
+        self.assertTrue(is_fresh((3, time.time() - 59, None), 3))
+
+    def test_new_data(self):
+        self.assertFalse(is_fresh((3, time.time(), None), 4))
+        self.assertFalse(is_fresh((0, time.time(), None), 1))
+
+    def test_old(self):
+        self.assertFalse(is_fresh((3, time.time() - 61, None), 3))
+
+
+def page_view(request):
+    return HttpResponse('Most Uniquely Downloaded')
+
+
+def csrf_page_view(request):
+    return HttpResponse(f'<input name="csrfmiddlewaretoken" value="{get_token(request)}">')
+
+
+def cookie_page_view(request):
+    response = page_view(request)
+    response.set_cookie('seen', '1')
+    return response
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ComputePageTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def compute(self, view):
+        request = RequestFactory().get('/dashboard/')
+        response = compute_page(view, request, (), {}, 3)
+        self.assertEqual(response.status_code, 200)
+        return cache.get(get_page_cache_key(request))
+
+    def test_shared_page(self):
+        data_version, _, response = self.compute(page_view)
+        self.assertEqual((data_version, response.content), (3, b'Most Uniquely Downloaded'))
+
+    def test_visitor_page(self):
+        # The token only matches the cookie of the visitor that the page was made for
+        self.assertIsNone(self.compute(csrf_page_view))
+        self.assertIsNone(self.compute(cookie_page_view))
+
+    def test_refresh_request(self):
+        request = RequestFactory().get('/dashboard/stats/?exact', HTTP_COOKIE='csrftoken=abc; sessionid=def',
+                                       HTTP_HOST='testserver', HTTP_USER_AGENT='Mozilla/5.0', SCRIPT_NAME='/encode')
+        refresh_request = get_refresh_request(request)
+        self.assertEqual(refresh_request.get_full_path(), '/encode/dashboard/stats/?exact')
+        self.assertEqual(get_page_cache_key(refresh_request), get_page_cache_key(request))
+        self.assertEqual((refresh_request.COOKIES, 'exact' in refresh_request.GET), ({}, True))
+        self.assertNotIn('HTTP_USER_AGENT', refresh_request.META)
@@ -50,7 +50,7 @@ def add_urls(path_names, view, name):
 def add_urls_with_stats(path_names, view, stats_view, name):
     add_urls(path_names, view, name)
     stats_name = f'{name}_stats'
-    stats_paths = [path(f'{base_path}stats/<str:stat_name>/', stats_view, name=stats_name) for base_path in path_names]
+    stats_paths = [path(f'{base_path}stats/', stats_view, name=stats_name) for base_path in path_names]
     urlpatterns.extend(stats_paths)
 
 
@@ -67,10 +67,12 @@ def get_ranged(base_path):
 def get_table(base_path):
     """
     Add a pagination ability to a table in addition to a default page.
+    Pages are either numbered or come after the cursor of the page before, see dashboard/pagination.py
     :param base_path: URL to build from, must include <page>
     :return: URLs that allow pagination. Still need to be added, as they are still just strings.
     """
-    return [base_path.replace('<page>', 'page/<int:page>'), base_path.replace('<page>/', '')]
+    return [base_path.replace('<page>', 'page/<int:page>'), base_path.replace('<page>', 'after/<str:cursor>'),
+            base_path.replace('<page>/', '')]
 
 
 def get_table_ranged(base_path):
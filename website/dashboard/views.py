@@ -1,12 +1,11 @@
 import json
 
-from django.conf import settings
-from django.http import HttpResponse
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, redirect
-from django.views.decorators.cache import cache_page
 
 from activity_viewer.util import time_this
-from . import query
+from . import pagination, query
+from .caching import cache_data_page
 from .forms import SelectTimeRangeForm
 from .query import START_TIME, END_TIME, BERNSTEIN_EXPERIMENT_FILTER_KWARGS
 
@@ -35,10 +34,16 @@ def add_ranged_table_context(context, start_time, end_time, page, page_size):
     return context
 
 
-def add_table_context(context, page, page_size):
+def add_table_context(context, page, page_size, offset=None, next_cursor=None):
+    """
+    :param offset: Position of the first row of the page in the whole table, the start of the page if None
+    :param next_cursor: Cursor of the page after, None on the last page
+    """
     context.update({
         'table_page': page,
-        'table_page_size': page_size
+        'table_page_size': page_size,
+        'table_offset': page * page_size if offset is None else offset,
+        'table_next_cursor': next_cursor
     })
     return context
 
@@ -65,8 +70,9 @@ def add_most_queried_graph_context(context, graph_most_queried):
 
 
 def get_time_range_form(request):
-    if request.method == 'POST':
-        time_range_form = SelectTimeRangeForm(request.POST)
+    # The range is sent as GET parameters, so pages need no CSRF token and every visitor can share them
+    if 'start_time' in request.GET or 'end_time' in request.GET:
+        time_range_form = SelectTimeRangeForm(request.GET)
         if time_range_form.is_valid():
             return time_range_form
     return SelectTimeRangeForm()
@@ -79,7 +85,7 @@ def redirect_from_form(request, time_range_form, **kwargs):
                     end_time=time_range_form.cleaned_data['end_time'])
 
 
-@cache_page(settings.CACHE_TIME)
+@cache_data_page
 def dashboard(request, start_time=START_TIME, end_time=END_TIME):
     time_range_form = get_time_range_form(request)
     if time_range_form.is_valid():
@@ -93,7 +99,7 @@ def dashboard(request, start_time=START_TIME, end_time=END_TIME):
     return render(request, 'dashboard.html', context)
 
 
-@cache_page(settings.CACHE_TIME)
+@cache_data_page
 def item_dashboard(request, item_name, start_time=START_TIME, end_time=END_TIME):
     time_range_form = get_time_range_form(request)
     if time_range_form.is_valid():
@@ -102,8 +108,9 @@ def item_dashboard(request, item_name, start_time=START_TIME, end_time=END_TIME)
     request_breakdown, ip_breakdown = query.get_requesters_for_item(item, start_time, end_time)
     return render(request, 'item_dashboard.html', add_range_context({
         'item': item,
-        'request_breakdown': request_breakdown.values_list('requester', 'count'),
-        'ip_breakdown': ip_breakdown.values_list('requester', 'ip_address', 'count')
+        'request_breakdown': request_breakdown.values_list('requester__value', 'count'),
+        'ip_breakdown': ip_breakdown.values_list('requester__value', 'ip_address', 'count'),
+        'co_downloads': query.get_co_downloaded_items(item)
     }, time_range_form, start_time, end_time))
 
 
@@ -120,7 +127,7 @@ def add_source_context(context, unique_downloads, total_downloads, **kwargs):
     return context
 
 
-@cache_page(settings.CACHE_TIME)
+@cache_data_page
 def requester_dashboard(request, requester, start_time=START_TIME, end_time=END_TIME):
     time_range_form = get_time_range_form(request)
     if time_range_form.is_valid():
@@ -132,75 +139,109 @@ def requester_dashboard(request, requester, start_time=START_TIME, end_time=END_
     return render(request, 'user_dashboard.html', context)
 
 
-@cache_page(settings.CACHE_TIME)
+@cache_data_page
 def ip_address_dashboard(request, ip_address, start_time=START_TIME, end_time=END_TIME):
     time_range_form = get_time_range_form(request)
     if time_range_form.is_valid():
         return redirect_from_form(request, time_range_form, ip_address=ip_address)
     total_downloads, unique_downloads = query.get_stats_for_source(start_time, end_time, ip_address=ip_address)
-    ip_info = query.get_or_create_ip_info(ip_address)
+    ip_info = query.get_ip_info(ip_address)
     context = {
-        'ip_isp': ip_info.isp
+        'ip_isp': ip_info.isp if ip_info else None
     }
     add_source_context(context, unique_downloads, total_downloads, ip_address=ip_address)
     add_range_context(context, time_range_form, start_time, end_time)
     return render(request, 'ip_address_dashboard.html', context)
 
 
-def render_table(request, data, name, template_name, page, start_time=None, end_time=None, page_size=DEFAULT_PAGE_SIZE,
-                 **kwargs):
+def render_table(request, data, key_fields, name, template_name, page, cursor=None, start_time=None, end_time=None,
+                 page_size=DEFAULT_PAGE_SIZE, get_top=None, **kwargs):
+    """
+    :param data: Query set of every row of the table, starting with the values of the key fields,
+                 see dashboard/pagination.py
+    :param get_top: Function that takes a page size and number and returns the rows from the summaries or None
+    """
+    try:
+        rows, offset, next_cursor = pagination.get_page(data, key_fields, page_size, page, cursor, get_top,
+                                                        cache_ranking=True)
+    except ValueError:
+        raise Http404('Invalid cursor')
     context = {
-        'table_data': data,
+        'table_data': rows,
         'table_name': name,
         'kwargs': kwargs
     }
-    add_table_context(context, page, page_size)
+    add_table_context(context, offset // page_size, page_size, offset, next_cursor)
     if start_time and end_time:
         add_range_context(context, None, start_time, end_time)
     return render(request, template_name, context)
 
 
+# Fields that rows of the tables are told apart by when their counts are the same, see dashboard/pagination.py
+ITEM_KEY_FIELDS = ['s3_key']
+USER_KEY_FIELDS = ['ip_address', 'requester']
+
+
+def get_item_rows(data):
+    return data.values_list(*ITEM_KEY_FIELDS, 'item__name', 'item__experiment__name', 'item__experiment__assay_title',
+                            'count')
+
+
+def get_user_rows(data):
+    return data.values_list(*USER_KEY_FIELDS, 'requester__value', 'ip_address', 'count')
+
+
+def get_top_rows(get_top, get_rows, start_time, end_time, **kwargs):
+    """
+    :return: Function that takes a page size and number and returns the rows from the heavy hitter summaries or None
+    """
+
+    def get_page_rows(page_size, page):
+        top = get_top(page_size, start_time, end_time, page, **kwargs)
+        return None if top is None else get_rows(top)
+
+    return get_page_rows
+
+
 @time_this
-def render_item_table(request, data, page, start_time=None, end_time=None, page_size=DEFAULT_PAGE_SIZE, **kwargs):
-    return render_table(request,
-                        data.values_list('item__name', 'item__experiment__name', 'item__experiment__assay_title',
-                                         'count'),
-                        'Most Uniquely Downloaded', 'ajax_item_table.html', page, start_time, end_time, page_size,
-                        **kwargs)
+def render_item_table(request, data, page, cursor=None, start_time=None, end_time=None, get_top=None, **kwargs):
+    return render_table(request, get_item_rows(data), ITEM_KEY_FIELDS, 'Most Uniquely Downloaded',
+                        'ajax_item_table.html', page, cursor, start_time, end_time, get_top=get_top, **kwargs)
 
 
-def render_user_table(request, data, page, start_time=None, end_time=None, page_size=DEFAULT_PAGE_SIZE, **kwargs):
-    return render_table(request,
-                        data.values_list('requester', 'ip_address', 'count'),
-                        'Most Active Downloaders', 'ajax_user_table.html', page, start_time, end_time,
-                        page_size, **kwargs)
+def render_user_table(request, data, page, cursor=None, start_time=None, end_time=None, get_top=None, **kwargs):
+    return render_table(request, get_user_rows(data), USER_KEY_FIELDS, 'Most Active Downloaders',
+                        'ajax_user_table.html', page, cursor, start_time, end_time, get_top=get_top, **kwargs)
 
 
-@cache_page(settings.CACHE_TIME)
-def most_queried_data_table(request, start_time=START_TIME, end_time=END_TIME, page=0):
-    most_queried = query.get_most_queried_items_limited(DEFAULT_PAGE_SIZE, start_time, end_time, page)
-    return render_item_table(request, most_queried, page, start_time, end_time)
+@cache_data_page
+def most_queried_data_table(request, start_time=START_TIME, end_time=END_TIME, page=0, cursor=None):
+    most_queried = query.get_most_queried_items(start_time, end_time)
+    get_top = get_top_rows(query.get_most_queried_items_from_summaries, get_item_rows, start_time, end_time)
+    return render_item_table(request, most_queried, page, cursor, start_time, end_time, get_top)
 
 
-@cache_page(settings.CACHE_TIME)
-def biggest_users_data_table(request, start_time=START_TIME, end_time=END_TIME, page=0):
-    biggest_requesters = query.get_most_active_users_limited(DEFAULT_PAGE_SIZE, start_time, end_time, page)
-    return render_user_table(request, biggest_requesters, page, start_time, end_time)
+@cache_data_page
+def biggest_users_data_table(request, start_time=START_TIME, end_time=END_TIME, page=0, cursor=None):
+    biggest_requesters = query.get_most_active_users(start_time, end_time)
+    get_top = get_top_rows(query.get_most_active_users_from_summaries, get_user_rows, start_time, end_time)
+    return render_user_table(request, biggest_requesters, page, cursor, start_time, end_time, get_top)
 
 
-@cache_page(settings.CACHE_TIME)
-def items_for_requester_data_table(request, requester, start_time=START_TIME, end_time=END_TIME, page=0):
-    items = query.get_items_for_source_limited(DEFAULT_PAGE_SIZE, start_time, end_time, page, requester=requester)
-    return render_item_table(request, items, page, start_time, end_time, requester=requester)
+@cache_data_page
+def items_for_requester_data_table(request, requester, start_time=START_TIME, end_time=END_TIME, page=0, cursor=None):
+    items = query.get_items_for_source(start_time, end_time, requester=requester)
+    return render_item_table(request, items, page, cursor, start_time, end_time, requester=requester)
 
 
-@cache_page(settings.CACHE_TIME)
-def items_for_ip_address_data_table(request, ip_address, start_time=START_TIME, end_time=END_TIME, page=0):
-    items = query.get_items_for_source_limited(DEFAULT_PAGE_SIZE, start_time, end_time, page, ip_address=ip_address)
-    return render_item_table(request, items, page, start_time, end_time, ip_address=ip_address)
+@cache_data_page
+def items_for_ip_address_data_table(request, ip_address, start_time=START_TIME, end_time=END_TIME, page=0,
+                                    cursor=None):
+    items = query.get_items_for_source(start_time, end_time, ip_address=ip_address)
+    return render_item_table(request, items, page, cursor, start_time, end_time, ip_address=ip_address)
 
 
-@cache_page(settings.CACHE_TIME)
+@cache_data_page
 def bernstein_experiment(request, start_time=START_TIME, end_time=END_TIME):
     relative_access = query.get_relative_access()
     time_range_form = get_time_range_form(request)
@@ -218,27 +259,38 @@ def bernstein_experiment(request, start_time=START_TIME, end_time=END_TIME):
     return render(request, 'bernstein_experiment.html', context)
 
 
-@cache_page(settings.CACHE_TIME)
-def bernstein_experiment_most_queried_data_table(request, start_time=START_TIME, end_time=END_TIME, page=0):
-    most_queried = query.get_most_queried_items_limited(DEFAULT_PAGE_SIZE, start_time, end_time,
-                                                        **BERNSTEIN_EXPERIMENT_FILTER_KWARGS)
-    return render_item_table(request, most_queried, page, start_time, end_time)
+@cache_data_page
+def bernstein_experiment_most_queried_data_table(request, start_time=START_TIME, end_time=END_TIME, page=0,
+                                                 cursor=None):
+    most_queried = query.get_most_queried_items(start_time, end_time, **BERNSTEIN_EXPERIMENT_FILTER_KWARGS)
+    get_top = get_top_rows(query.get_most_queried_items_from_summaries, get_item_rows, start_time, end_time,
+                           **BERNSTEIN_EXPERIMENT_FILTER_KWARGS)
+    return render_item_table(request, most_queried, page, cursor, start_time, end_time, get_top)
+
+
+@cache_data_page
+def bernstein_experiment_biggest_users_data_table(request, start_time=START_TIME, end_time=END_TIME, page=0,
+                                                  cursor=None):
+    biggest_users = query.get_most_active_users(start_time, end_time, **BERNSTEIN_EXPERIMENT_FILTER_KWARGS)
+    get_top = get_top_rows(query.get_most_active_users_from_summaries, get_user_rows, start_time, end_time,
+                           **BERNSTEIN_EXPERIMENT_FILTER_KWARGS)
+    return render_user_table(request, biggest_users, page, cursor, start_time, end_time, get_top)
 
 
-@cache_page(settings.CACHE_TIME)
-def bernstein_experiment_biggest_users_data_table(request, start_time=START_TIME, end_time=END_TIME, page=0):
-    biggest_users = query.get_most_active_users_limited(DEFAULT_PAGE_SIZE, start_time, end_time, page,
-                                                        **BERNSTEIN_EXPERIMENT_FILTER_KWARGS)
-    return render_user_table(request, biggest_users, page, start_time, end_time)
+@cache_data_page
+def dashboard_stats(request, start_time=START_TIME, end_time=END_TIME):
+    return get_stats_response(request, start_time, end_time)
 
 
-@cache_page(settings.CACHE_TIME)
-def dashboard_stats(request, stat_name, start_time=START_TIME, end_time=END_TIME):
-    stat = query.get_general_stat(stat_name, start_time, end_time)
-    return HttpResponse(str(stat))
+@cache_data_page
+def bernstein_experiment_stats(request, start_time=START_TIME, end_time=END_TIME):
+    return get_stats_response(request, start_time, end_time, **BERNSTEIN_EXPERIMENT_FILTER_KWARGS)
 
 
-@cache_page(settings.CACHE_TIME)
-def bernstein_experiment_stats(request, stat_name, start_time=START_TIME, end_time=END_TIME):
-    stat = query.get_general_stat(stat_name, start_time, end_time, **BERNSTEIN_EXPERIMENT_FILTER_KWARGS)
-    return HttpResponse(str(stat))
+def get_stats_response(request, start_time, end_time, **kwargs):
+    """
+    Every general stat at once. Distinct counts are estimated from sketches unless ?exact is in the URL,
+    the relative standard error of each estimated one is under relative_errors.
+    """
+    stats, relative_errors = query.get_general_stats(start_time, end_time, exact='exact' in request.GET, **kwargs)
+    return JsonResponse({'stats': stats, 'relative_errors': relative_errors})
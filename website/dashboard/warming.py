@@ -0,0 +1,89 @@
+"""
+Warming of the shared page cache after new data arrived, see dashboard/caching.py.
+The pages of the whole time range, their stats and the first pages of their tables are requested like a visitor would,
+a few at a time, so the first visitor after a sync does not wait minutes for them.
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+
+from dashboard import urls
+from dashboard.caching import computing_stale_pages
+
+# Pages of every table that are requested, following the Next button
+TABLE_PAGE_COUNT = 3
+# Pages that are computed at once, every one of them holds a database connection
+WORKER_COUNT = 4
+TABLE_SUFFIX = '_data_table'
+NEXT_CURSOR_PATTERN = re.compile(r"next-cursor='([^']+)'")
+
+
+def get_default_url_names():
+    """
+    :return: Names of the dashboard views that have a URL without any parameters, which shows the whole time range
+    """
+    names = []
+    for pattern in urls.urlpatterns:
+        if not pattern.pattern.converters and pattern.name not in names:
+            names.append(pattern.name)
+    return names
+
+
+def request_page(url):
+    """
+    :return: Response of the page, which is in the cache after this if it was successful
+    """
+    try:
+        # Through every middleware, so the page is cached under the same key as for a visitor.
+        # Stale pages are computed before the response instead of in a thread that would end with the command.
+        with computing_stale_pages():
+            return Client(raise_request_exception=False, HTTP_HOST=settings.ALLOWED_HOSTS[0]).get(url)
+    finally:
+        # Every thread opens its own connections
+        connections.close_all()
+
+
+def get_status(url):
+    return url, request_page(url).status_code
+
+
+def warm_table(name, page_count):
+    """
+    Request the first pages of a table like the Next and Previous buttons do, the former by cursor and
+    the latter by page number.
+    :return: List of tuples of the URL and the status code of every page that was requested
+    """
+    statuses = []
+    url = reverse(f'dashboard:{name}')
+    for page in range(page_count):
+        if page:
+            statuses.append(get_status(reverse(f'dashboard:{name}', kwargs={'page': page})))
+        response = request_page(url)
+        statuses.append((url, response.status_code))
+        next_cursor = NEXT_CURSOR_PATTERN.search(response.content.decode()) if response.status_code == 200 else None
+        if next_cursor is None:
+            break
+        url = reverse(f'dashboard:{name}', kwargs={'cursor': next_cursor.group(1)})
+    return statuses
+
+
+def warm_cache(table_page_count=TABLE_PAGE_COUNT, worker_count=WORKER_COUNT):
+    """
+    Compute the default pages, their stats and the first pages of their tables into the shared cache.
+    Pages that are in the cache for the current data already are only read from it.
+    :return: List of tuples of the URL and the status code of every page that was requested
+    """
+    names = get_default_url_names()
+    with ThreadPoolExecutor(worker_count) as executor:
+        # Tables go first, they are what takes the longest
+        table_futures = [executor.submit(warm_table, name, table_page_count)
+                         for name in names if name.endswith(TABLE_SUFFIX)]
+        page_futures = [executor.submit(get_status, reverse(f'dashboard:{name}'))
+                        for name in names if not name.endswith(TABLE_SUFFIX)]
+        statuses = [status for future in table_futures for status in future.result()]
+        statuses.extend(future.result() for future in page_futures)
+    return statuses
@@ -45,51 +45,85 @@ function formatCount(number, formatType) {
     }
 }
 
+// Pages that another request computes are answered with 503 until they are ready, see dashboard/caching.py
+function retryWhenComputed(xhr, retry) {
+    if (xhr.status !== 503) return false;
+    setTimeout(retry, (parseInt(xhr.getResponseHeader('Retry-After')) || 5) * 1000);
+    return true;
+}
+
 $(document).ready(function () {
-    $('.counter[data-url]').each(function () {
-        const $this = $(this), dataUrl = $this.attr('data-url'), formatType = $this.attr('format');
-        $.ajax({
-            url: dataUrl,
-            success: function (result) {
-                $({finalNumber: $this.text()}).animate({
-                        count: result
-                    },
-                    {
-                        duration: 1500,
-                        easing: 'swing',
-                        step: function () {
-                            $this.text(formatCount(this.count, formatType))
-                        },
-                        complete: this.step
-                    });
-            },
-            error: function (result) {
-                $this.text('Error')
-            }
+    // Counters with the same URL get all of their stats from one request
+    const counterUrls = new Set($('.counter[data-url]').map(function () {
+        return $(this).attr('data-url');
+    }).get());
+    counterUrls.forEach(function (dataUrl) {
+        const $counters = $('.counter[data-url]').filter(function () {
+            return $(this).attr('data-url') === dataUrl;
         });
+        const requestStats = function () {
+            $.ajax({
+                url: dataUrl,
+                success: function (result) {
+                    $counters.each(function () {
+                        const $this = $(this), formatType = $this.attr('format'), statName = $this.attr('data-stat'),
+                            relativeError = result.relative_errors[statName];
+                        if (relativeError) {
+                            $this.attr('title', 'Estimate, within ' + (relativeError * 100).toFixed(1) + '% most of the time');
+                        }
+                        $({finalNumber: $this.text()}).animate({
+                                count: result.stats[statName]
+                            },
+                            {
+                                duration: 1500,
+                                easing: 'swing',
+                                step: function () {
+                                    $this.text(formatCount(this.count, formatType))
+                                },
+                                complete: this.step
+                            });
+                    });
+                },
+                error: function (xhr) {
+                    if (!retryWhenComputed(xhr, requestStats)) {
+                        $counters.text('Error')
+                    }
+                }
+            });
+        };
+        requestStats();
     });
 
     function getCurrentPage(tableControlElement) {
         return parseInt(tableControlElement.parent('#table-buttons').attr('page'));
     }
 
-    function makeRequest(tableControlElement, page) {
+    function makeRequest(tableControlElement, page, cursor) {
         if (page < 0) return;
         const tableButtons = tableControlElement.parent('#table-buttons');
-        let url = tableButtons.attr('info-source') + 'page/' + page.toString();
+        // Pages after a cursor cost the same no matter how deep they are
+        let url = tableButtons.attr('info-source') + (cursor ? 'after/' + cursor : 'page/' + page.toString());
         tableControlElement.siblings().addBack().attr('disabled', true);
         tableControlElement.children('.spinner-border').removeAttr('hidden');
-        $.ajax({
-            url: url,
-            success: function (result) {
-                console.log('Got response for page: ' + page.toString());
-                tableButtons.parent().parent().html(result);
-            }
-        })
+        const requestTable = function () {
+            $.ajax({
+                url: url,
+                success: function (result) {
+                    console.log('Got response for page: ' + page.toString());
+                    tableButtons.parent().parent().html(result);
+                },
+                error: function (xhr) {
+                    retryWhenComputed(xhr, requestTable);
+                }
+            });
+        };
+        requestTable();
     }
 
     $(document).on('click', '#table-next', function () {
-        makeRequest($(this), getCurrentPage($(this)) + 1);
+        const nextCursor = $(this).parent('#table-buttons').attr('next-cursor');
+        if (!nextCursor) return;
+        makeRequest($(this), getCurrentPage($(this)) + 1, nextCursor);
     });
     $(document).on('click', '#table-previous', function () {
         makeRequest($(this), getCurrentPage($(this)) - 1);